@@ -0,0 +1,284 @@
+import argparse
+import hashlib
+import http.server
+import os
+import re
+import shutil
+import sys
+import tarfile
+import tempfile
+import urllib.error
+import urllib.request
+
+
+# An HTTP cache of finished checkouts. Most fetches are for the same few
+# boards and library selections, so the first fetch of a combination
+# publishes its pruned checkout (the sparse working tree, the submodules it
+# needs and the shallow .git directory) as a compressed archive, and later
+# fetches download and extract that archive instead of talking to git. The
+# archive is extracted while it streams in, so it never has to fit in memory
+# or on disk twice. Archives are named after a hash of everything that
+# changes their contents (see fetchSource.getArtifactKey). Running this file
+# starts a small cache server that stores the archives in a directory; any
+# server that answers GET and PUT for "<url>/<key>.tar.gz" works as well.
+
+
+# Ending of the archive names
+ARTIFACT_SUFFIX = ".tar.gz"
+
+# Names the server accepts, which keeps requests inside of its directory
+ARTIFACT_NAME_PATTERN = re.compile(r"^[0-9a-f]{64}\.tar\.gz$")
+
+# Bytes read or written at once while an archive is streamed
+CHUNK_SIZE = 1024 * 1024
+
+# Seconds to wait for the cache server before falling back to git
+REQUEST_TIMEOUT = 30
+
+# Ending of the directory an archive is extracted into before it is moved
+# into place, so a download that breaks off never leaves half a checkout
+PARTIAL_SUFFIX = ".artifact-partial"
+
+# Files of a git directory that make git run commands (hooks, and config
+# settings like core.fsmonitor or core.hooksPath) or point it at another git
+# directory. Archives never carry them, the client recreates its config.
+GIT_CONTROL_FILES = ["config", "config.worktree", "commondir", "gitdir"]
+GIT_CONTROL_DIRECTORIES = ["hooks"]
+
+# Parts of a git directory that only hold objects and refs, whose names are
+# never control files
+GIT_DATA_DIRECTORIES = ["objects", "refs", "logs"]
+
+
+# getArtifactKey: Hashes the parts of a fetch that decide what the checkout
+# holds.
+# Returns: the hex sha256 of "parts"
+def getArtifactKey(parts):
+    key_hash = hashlib.sha256()
+    for part in parts:
+        key_hash.update(str(part).encode("utf-8") + b"\0")
+    return key_hash.hexdigest()
+
+
+# getArtifactUrl: Returns: the url of the archive called "key"
+def getArtifactUrl(cache_url, key):
+    return cache_url.rstrip("/") + "/" + key + ARTIFACT_SUFFIX
+
+
+# isInsideArchive: Returns: whether the archive relative "path" stays inside
+# of the directory the archive is extracted into
+def isInsideArchive(path):
+    path = os.path.normpath(path)
+    return not (os.path.isabs(path) or path == os.pardir or
+                path.startswith(os.pardir + os.sep))
+
+
+# isGitControlFile: Returns: whether the archive relative "path" is one of
+# the GIT_CONTROL_FILES or inside of GIT_CONTROL_DIRECTORIES of a git
+# directory (.git or one of the submodule git directories below it)
+def isGitControlFile(path):
+    parts = os.path.normpath(path).split(os.sep)
+    if ".git" not in parts:
+        return False
+    git_parts = parts[parts.index(".git") + 1:]
+    if set(git_parts) & set(GIT_DATA_DIRECTORIES):
+        return False
+    return (bool(set(git_parts) & set(GIT_CONTROL_DIRECTORIES)) or
+            bool(git_parts) and git_parts[-1] in GIT_CONTROL_FILES)
+
+
+# extractArchive: Extracts a gzipped tar stream into "directory" as it is
+# read. Members that would end up outside of "directory", and links that
+# point outside of it, are refused. Git control files (see
+# isGitControlFile) are skipped.
+def extractArchive(stream, directory):
+    with tarfile.open(fileobj=stream, mode="r|gz") as archive:
+        if hasattr(tarfile, "data_filter"):
+            archive.extractall(directory, filter=lambda member, path: None
+                               if isGitControlFile(member.name) else
+                               tarfile.data_filter(member, path))
+        else:
+            for member in archive:
+                if isGitControlFile(member.name):
+                    continue
+                if not isInsideArchive(member.name):
+                    raise tarfile.TarError("unsafe path %s" % member.name)
+                # Symbolic links are relative to their own directory, hard
+                # links to the top of the archive
+                if member.issym() and not isInsideArchive(os.path.join(
+                        os.path.dirname(member.name), member.linkname)) or \
+                        member.islnk() and \
+                        not isInsideArchive(member.linkname):
+                    raise tarfile.TarError("unsafe link %s -> %s" %
+                                           (member.name, member.linkname))
+                archive.extract(member, directory)
+
+
+# downloadArtifact: Downloads the archive called "key" from the cache at
+# "cache_url" and extracts it into "directory", which must not exist yet.
+# Returns: True if the archive was in the cache, False if it wasn't or if it
+# couldn't be downloaded
+def downloadArtifact(cache_url, key, directory):
+    partial_directory = directory + PARTIAL_SUFFIX
+    shutil.rmtree(partial_directory, ignore_errors=True)
+    try:
+        with urllib.request.urlopen(getArtifactUrl(cache_url, key),
+                                    timeout=REQUEST_TIMEOUT) as response:
+            extractArchive(response, partial_directory)
+        os.rename(partial_directory, directory)
+        return True
+    except urllib.error.HTTPError as error:
+        if error.code != 404:
+            print("warning: artifact cache: %s" % error)
+    except (urllib.error.URLError, tarfile.TarError, OSError) as error:
+        print("warning: artifact cache: %s" % error)
+    shutil.rmtree(partial_directory, ignore_errors=True)
+    return False
+
+
+# publishArtifact: Archives "directory" without its git control files (see
+# isGitControlFile) and uploads it to the cache at "cache_url" as "key". The
+# archive is written to a temporary file first so the upload has a known
+# length.
+# Returns: True if the cache stored the archive, False if it failed or if the
+# cache already had an archive called "key"
+def publishArtifact(cache_url, key, directory):
+    with tempfile.TemporaryFile() as archive_file:
+        with tarfile.open(fileobj=archive_file, mode="w:gz") as archive:
+            archive.add(directory, arcname=".", filter=lambda member: None
+                        if isGitControlFile(member.name) else member)
+        archive_size = archive_file.tell()
+        archive_file.seek(0)
+
+        request = urllib.request.Request(
+            getArtifactUrl(cache_url, key), data=archive_file, method="PUT",
+            headers={"Content-Length": str(archive_size),
+                     "Content-Type": "application/gzip"})
+        try:
+            with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT):
+                return True
+        except urllib.error.HTTPError as error:
+            if error.code != 409:
+                print("warning: artifact cache: %s" % error)
+            return False
+        except (urllib.error.URLError, OSError) as error:
+            print("warning: artifact cache: %s" % error)
+            return False
+
+
+# ArtifactCacheHandler: Serves the archives in the "cache_directory" of its
+# server. GET and HEAD download an archive, PUT stores one. An upload is
+# written to a temporary file and linked into place once it is complete, so
+# a download never sees half an archive. Archives are never replaced: a PUT
+# of a name that is already stored is answered with 409.
+class ArtifactCacheHandler(http.server.BaseHTTPRequestHandler):
+    # _getArtifactFilename: Returns: the file of the requested archive, or
+    # None (after answering 400) if the name isn't the name of an archive
+    def _getArtifactFilename(self):
+        name = self.path.rsplit("/", 1)[-1]
+        if not ARTIFACT_NAME_PATTERN.match(name):
+            self.send_error(400, "not an archive name")
+            return None
+        return os.path.join(self.server.cache_directory, name)
+
+    def _sendArtifact(self, send_body):
+        artifact_filename = self._getArtifactFilename()
+        if artifact_filename is None:
+            return
+        try:
+            artifact_file = open(artifact_filename, "rb")
+        except IOError:
+            self.send_error(404)
+            return
+        with artifact_file:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/gzip")
+            self.send_header("Content-Length",
+                             str(os.fstat(artifact_file.fileno()).st_size))
+            self.end_headers()
+            if send_body:
+                shutil.copyfileobj(artifact_file, self.wfile, CHUNK_SIZE)
+
+    def do_GET(self):
+        self._sendArtifact(True)
+
+    def do_HEAD(self):
+        self._sendArtifact(False)
+
+    def do_PUT(self):
+        artifact_filename = self._getArtifactFilename()
+        if artifact_filename is None:
+            return
+        try:
+            remaining = int(self.headers["Content-Length"])
+        except (TypeError, ValueError):
+            self.send_error(411)
+            return
+
+        temporary_file = tempfile.NamedTemporaryFile(
+            dir=self.server.cache_directory, suffix=PARTIAL_SUFFIX,
+            delete=False)
+        try:
+            with temporary_file:
+                while remaining > 0:
+                    chunk = self.rfile.read(min(remaining, CHUNK_SIZE))
+                    if not chunk:
+                        raise IOError("upload ended early")
+                    temporary_file.write(chunk)
+                    remaining -= len(chunk)
+        except IOError:
+            os.remove(temporary_file.name)
+            self.send_error(400, "incomplete upload")
+            return
+        try:
+            os.link(temporary_file.name, artifact_filename)
+        except FileExistsError:
+            self.send_error(409, "archive already stored")
+            return
+        finally:
+            os.remove(temporary_file.name)
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+# createServer: Returns: a server (not yet serving) for the archives in
+# "cache_directory". Port 0 picks a free port, see server_address. The
+# server only listens on the loopback interface unless another "host" is
+# given, because anyone who can upload archives decides what the clients
+# check out.
+def createServer(cache_directory, host="127.0.0.1", port=8000):
+    os.makedirs(cache_directory, exist_ok=True)
+    server = http.server.ThreadingHTTPServer((host, port),
+                                             ArtifactCacheHandler)
+    server.cache_directory = os.path.abspath(cache_directory)
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serve the checkout archives of fetchSource "
+                    "--artifact-cache from a directory.")
+    parser.add_argument("directory", help="directory the archives are kept in")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address to listen on (default: 127.0.0.1, "
+                             "use 0.0.0.0 for all)")
+    parser.add_argument("--port", type=int, default=8000,
+                        help="port to listen on (default: 8000)")
+    arguments = parser.parse_args(argv)
+
+    server = createServer(arguments.directory, arguments.host, arguments.port)
+    print("Serving %s on port %d" % (server.cache_directory,
+                                     server.server_address[1]))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
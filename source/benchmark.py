@@ -0,0 +1,414 @@
+from contextlib import contextmanager
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from fileUtils import SOURCE_DIRECTORY
+from gitUtils import runGit
+import fetchSource
+import kconfigCache
+import merge_config
+
+
+# Benchmarks the latency of a merge with a cold Kconfig cache (the tree has to
+# be parsed), a warm on disk cache (a new process that finds the pickled tree)
+# and a hot in memory cache (a second merge in the same process). The suite
+# also builds a stand-in for the FreeRTOS repository around every tree (a
+# local bare repository with library directories and submodules of a chosen
+# size) and times findAllKConfigFiles, the clone and the board merge against
+# it. Everything is generated, so the benchmark runs offline and can be
+# scaled. The results of a run are saved per commit for comparing later.
+
+
+# Directory the results are saved in, one file per commit, next to this
+# script whatever the working directory is
+RESULTS_DIRECTORY = os.path.join(SOURCE_DIRECTORY, "benchmarkResults")
+
+# Vendor and board of the synthetic repositories
+BENCHMARK_VENDOR = "benchmark"
+BENCHMARK_BOARD = "board"
+
+# Size of the generated source files
+DATA_FILE_SIZE = 64 * 1024
+
+# The synthetic repositories (and the fixture repositories of test.py) are
+# committed and cloned over file://, which needs an identity and permission
+# to clone file:// submodules
+FIXTURE_GIT_ENVIRONMENT = {"GIT_CONFIG_COUNT": "2",
+                           "GIT_CONFIG_KEY_0": "protocol.file.allow",
+                           "GIT_CONFIG_VALUE_0": "always",
+                           "GIT_CONFIG_KEY_1": "uploadpack.allowFilter",
+                           "GIT_CONFIG_VALUE_1": "true",
+                           "GIT_AUTHOR_NAME": "fixture",
+                           "GIT_AUTHOR_EMAIL": "fixture@example.com",
+                           "GIT_COMMITTER_NAME": "fixture",
+                           "GIT_COMMITTER_EMAIL": "fixture@example.com"}
+
+
+# isIntSymbol: Every third symbol of the synthetic trees is an int, except
+# the first symbol of every group which the rest of the group depends on
+def isIntSymbol(symbol):
+    return symbol % 3 == 2 and symbol % 10 != 0
+
+
+# createSyntheticKconfigTree: Writes a Kconfig tree with "symbol_count"
+# symbols to "directory". The symbols are spread over "file_count" files
+# that source each other in a chain, so the deepest file is nested
+# "file_count" levels deep. Symbols come in groups of ten where every symbol
+# depends on the (bool) first symbol of its group.
+# Returns: the path of a configuration fragment that assigns every tenth
+# symbol (written next to the top level file "top_filename")
+def createSyntheticKconfigTree(directory, symbol_count, file_count=10,
+                               top_filename="Kconfig"):
+    file_count = max(1, min(file_count, symbol_count))
+    symbols_per_file = -(-symbol_count // file_count)
+    relative_directory = ""
+
+    for file_index in range(file_count):
+        if file_index == 0:
+            filename = top_filename
+        else:
+            filename = os.path.join(relative_directory,
+                                    "Kconfig.level%d" % file_index)
+        os.makedirs(os.path.join(directory, relative_directory), exist_ok=True)
+
+        with open(os.path.join(directory, filename), "w") as kconfig_file:
+            kconfig_file.write('menu "Level %d"\n' % file_index)
+            first_symbol = file_index * symbols_per_file
+            for symbol in range(first_symbol,
+                                min(first_symbol + symbols_per_file,
+                                    symbol_count)):
+                kconfig_file.write("config SYMBOL_%d\n" % symbol)
+                if isIntSymbol(symbol):
+                    kconfig_file.write('    int "Symbol %d"\n' % symbol)
+                    kconfig_file.write("    default %d\n" % symbol)
+                else:
+                    kconfig_file.write('    bool "Symbol %d"\n' % symbol)
+                    kconfig_file.write("    default y\n")
+                if symbol % 10:
+                    kconfig_file.write("    depends on SYMBOL_%d\n" %
+                                       (symbol - symbol % 10))
+            kconfig_file.write("endmenu\n")
+
+            if file_index + 1 < file_count:
+                relative_directory = os.path.join(relative_directory,
+                                                  "level%d" % (file_index + 1))
+                kconfig_file.write('source "%s"\n' % os.path.join(
+                    relative_directory, "Kconfig.level%d" % (file_index + 1)))
+
+    fragment_filename = os.path.join(directory, "fragment")
+    with open(fragment_filename, "w") as fragment_file:
+        for symbol in range(0, symbol_count, 10):
+            if isIntSymbol(symbol):
+                fragment_file.write("CONFIG_SYMBOL_%d=%d\n" % (symbol,
+                                                               symbol + 1))
+            else:
+                fragment_file.write("# CONFIG_SYMBOL_%d is not set\n" % symbol)
+    return fragment_filename
+
+
+# timeMerge: Returns: the time (in seconds) to get the Kconfig object of the
+# tree in "srctree" from kconfigCache and merge "fragment" with it
+def timeMerge(srctree, fragment):
+    start_time = time.perf_counter()
+    kconf = kconfigCache.getKconfig("Kconfig", srctree)
+    merge_config.mergeConfig(kconf, os.path.join(srctree, ".config"),
+                             [fragment])
+    return time.perf_counter() - start_time
+
+
+# benchmarkMerge: Times cold, warm and hot merges of a synthetic tree.
+# Returns: a dict with the median time of each kind of merge
+def benchmarkMerge(symbol_count, file_count, repeat):
+    timings = {"cold": [], "warm": [], "hot": []}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        srctree = os.path.join(temp_dir, "tree")
+        cache_directory = os.path.join(temp_dir, "cache")
+        fragment = createSyntheticKconfigTree(srctree, symbol_count,
+                                              file_count)
+
+        old_cache_directory = kconfigCache.KCONFIG_CACHE_DIRECTORY
+        kconfigCache.KCONFIG_CACHE_DIRECTORY = cache_directory
+        try:
+            for _ in range(repeat):
+                shutil.rmtree(cache_directory, ignore_errors=True)
+                kconfigCache.clearKconfigCache()
+                timings["cold"].append(timeMerge(srctree, fragment))
+
+                # A fresh process only has the on disk cache
+                kconfigCache.clearKconfigCache()
+                timings["warm"].append(timeMerge(srctree, fragment))
+
+                timings["hot"].append(timeMerge(srctree, fragment))
+        finally:
+            kconfigCache.KCONFIG_CACHE_DIRECTORY = old_cache_directory
+            kconfigCache.clearKconfigCache()
+
+    return dict((kind, statistics.median(times))
+                for kind, times in timings.items())
+
+
+# gitEnvironment: Context manager that sets FIXTURE_GIT_ENVIRONMENT for the
+# git commands run inside of it
+@contextmanager
+def gitEnvironment():
+    old_environment = dict(os.environ)
+    os.environ.update(FIXTURE_GIT_ENVIRONMENT)
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(old_environment)
+
+
+# writeDataFiles: Fills "directory" with "size" bytes of random (so not
+# compressible) data split into files of DATA_FILE_SIZE bytes
+def writeDataFiles(directory, size):
+    os.makedirs(directory, exist_ok=True)
+    file_index = 0
+    while True:
+        file_size = min(DATA_FILE_SIZE, size)
+        with open(os.path.join(directory, "data%d.c" % file_index),
+                  "wb") as data_file:
+            data_file.write(os.urandom(file_size))
+        size -= file_size
+        file_index += 1
+        if size <= 0:
+            break
+
+
+# commitDirectory: Turns "directory" into a git repository on the FreeRTOS
+# branch with everything in it committed (with FIXTURE_GIT_ENVIRONMENT)
+def commitDirectory(directory):
+    subprocess.run(["git", "init", "-q", "-b", fetchSource.FREERTOS_BRANCH,
+                    directory], check=True)
+    subprocess.run(["git", "add", "-A"], cwd=directory, check=True)
+    subprocess.run(["git", "commit", "-q", "-m", "fixture"], cwd=directory,
+                   check=True)
+
+
+# createSyntheticRepository: Creates a stand-in for the FreeRTOS repository
+# in "directory": the core and library directories of fetchSource hold
+# "library_size" bytes each, the third party libraries are submodules of
+# "submodule_size" bytes each, tools/configuration holds a synthetic Kconfig
+# tree with "symbol_count" symbols in "file_count" nested files and the
+# benchmark board assigns every tenth symbol.
+# Returns: the file:// url of the bare repository
+def createSyntheticRepository(directory, symbol_count, file_count,
+                              library_size, submodule_size):
+    work_directory = os.path.join(directory, "work")
+    fragment = createSyntheticKconfigTree(
+        os.path.join(work_directory, "tools/configuration"), symbol_count,
+        file_count, "KConfig")
+    board_directory = os.path.join(work_directory, "vendors",
+                                   BENCHMARK_VENDOR, "boards",
+                                   BENCHMARK_BOARD)
+    os.makedirs(os.path.join(board_directory, "aws_demos/config_files"))
+    shutil.move(fragment, os.path.join(board_directory, "Kconfig"))
+    with open(os.path.join(board_directory, "aws_demos/config_files",
+                           "library_Kconfig"), "w") as library_file:
+        library_file.write("CONFIG_SYMBOL_0=y\n")
+
+    submodule_paths = []
+    paths = list(fetchSource.CORE_PATHS)
+    for library_paths in fetchSource.LIBRARY_PATHS.values():
+        paths.extend(library_paths)
+    for path in paths:
+        if path.startswith("libraries/3rdparty/"):
+            submodule_paths.append(path)
+        elif path != "tools":
+            writeDataFiles(os.path.join(work_directory, path), library_size)
+    commitDirectory(work_directory)
+
+    for path in submodule_paths:
+        submodule_directory = os.path.join(directory, "submodules",
+                                           os.path.basename(path))
+        writeDataFiles(os.path.join(submodule_directory, "src"),
+                       submodule_size)
+        commitDirectory(submodule_directory)
+        subprocess.run(["git", "submodule", "add", "-q",
+                        "file://" + submodule_directory, path],
+                       cwd=work_directory, check=True)
+    subprocess.run(["git", "commit", "-q", "-m", "submodules"],
+                   cwd=work_directory, check=True)
+
+    bare_directory = os.path.join(directory, "amazon-freertos.git")
+    subprocess.run(["git", "clone", "-q", "--bare", work_directory,
+                    bare_directory], check=True)
+    return "file://" + bare_directory
+
+
+# benchmarkRepository: Times findAllKConfigFiles, a clone with every library
+# enabled and the board merge (with a cold and a hot Kconfig cache) against
+# a synthetic repository.
+# Returns: a dict with the median time of each step
+def benchmarkRepository(symbol_count, file_count, library_size,
+                        submodule_size, repeat):
+    timings = {"find_kconfig_files": [], "clone": [], "board_merge_cold": [],
+               "board_merge_hot": []}
+    with tempfile.TemporaryDirectory() as temp_dir, gitEnvironment():
+        repository_url = createSyntheticRepository(
+            os.path.join(temp_dir, "remote"), symbol_count, file_count,
+            library_size, submodule_size)
+        config_filename = os.path.join(temp_dir, ".config")
+        with open(config_filename, "w") as config_file:
+            for library in fetchSource.LIBRARY_PATHS:
+                config_file.write("%s%s=y\n" % (fetchSource.CONFIG_PREFIX,
+                                                library))
+
+        old_repository_url = fetchSource.FREERTOS_REPOSITORY_URL
+        old_cache_directory = kconfigCache.KCONFIG_CACHE_DIRECTORY
+        fetchSource.FREERTOS_REPOSITORY_URL = repository_url
+        kconfigCache.KCONFIG_CACHE_DIRECTORY = os.path.join(temp_dir, "cache")
+        try:
+            for run in range(repeat):
+                output_dir = os.path.join(temp_dir, "output%d" % run)
+                with fetchSource.redirectOutput(output_dir + ".log"):
+                    start_time = time.perf_counter()
+                    fetchSource.cloneFreeRTOSRepository(output_dir,
+                                                        config_filename)
+                    timings["clone"].append(time.perf_counter() - start_time)
+
+                    start_time = time.perf_counter()
+                    fetchSource.findAllKConfigFiles(
+                        BENCHMARK_VENDOR, BENCHMARK_BOARD, output_dir)
+                    timings["find_kconfig_files"].append(
+                        time.perf_counter() - start_time)
+
+                    shutil.rmtree(kconfigCache.KCONFIG_CACHE_DIRECTORY,
+                                  ignore_errors=True)
+                    kconfigCache.clearKconfigCache()
+                    for kind in ["board_merge_cold", "board_merge_hot"]:
+                        start_time = time.perf_counter()
+                        fetchSource.updateBoardChosen(
+                            BENCHMARK_VENDOR, BENCHMARK_BOARD, output_dir)
+                        timings[kind].append(time.perf_counter() - start_time)
+        finally:
+            fetchSource.FREERTOS_REPOSITORY_URL = old_repository_url
+            kconfigCache.KCONFIG_CACHE_DIRECTORY = old_cache_directory
+            kconfigCache.clearKconfigCache()
+
+    return dict((kind, statistics.median(times))
+                for kind, times in timings.items())
+
+
+# runBenchmarks: Runs the merge and repository benchmarks for every tree
+# size in "symbol_counts".
+# Returns: a list with one dict of timings (in seconds) per tree size
+def runBenchmarks(symbol_counts, file_count, library_size, submodule_size,
+                  repeat):
+    results = []
+    for symbol_count in symbol_counts:
+        result = {"symbols": symbol_count}
+        for kind, seconds in benchmarkMerge(symbol_count, file_count,
+                                            repeat).items():
+            result["merge_" + kind] = seconds
+        result.update(benchmarkRepository(symbol_count, file_count,
+                                          library_size, submodule_size,
+                                          repeat))
+        results.append(result)
+    return results
+
+
+# getCommit: Returns: the abbreviated commit the benchmark runs on, with
+# "-dirty" appended if the working tree has changes, or "unknown" outside of
+# a git repository
+def getCommit():
+    result = runGit(["rev-parse", "--short", "HEAD"], cwd=SOURCE_DIRECTORY,
+                    capture_output=True)
+    if result.returncode != 0:
+        return "unknown"
+    commit = result.stdout.strip()
+    status = runGit(["status", "--porcelain", "--untracked-files=no"],
+                    cwd=SOURCE_DIRECTORY, capture_output=True)
+    if status.stdout.strip():
+        commit += "-dirty"
+    return commit
+
+
+# saveResults: Writes the results of a run, along with the commit and the
+# parameters they were measured with, to "<results_directory>/<commit>.json"
+# Returns: the name of the written file
+def saveResults(results, parameters, results_directory=RESULTS_DIRECTORY):
+    os.makedirs(results_directory, exist_ok=True)
+    commit = getCommit()
+    results_filename = os.path.join(results_directory, commit + ".json")
+    with open(results_filename, "w") as results_file:
+        json.dump({"commit": commit,
+                   "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   "python": platform.python_version(),
+                   "parameters": parameters,
+                   "results": results}, results_file, indent=1,
+                  sort_keys=True)
+        results_file.write("\n")
+    return results_filename
+
+
+# printResults: Prints one line per tree size. With "baseline" (the results
+# of an earlier run) every time is followed by its ratio to the baseline.
+def printResults(results, baseline=None):
+    columns = [key for key in results[0] if key != "symbols"]
+    baseline_results = dict((result["symbols"], result)
+                            for result in (baseline or {}).get("results", []))
+
+    print("%8s" % "symbols" + "".join(" %18s" % column[:18]
+                                      for column in columns))
+    for result in results:
+        line = "%8d" % result["symbols"]
+        for column in columns:
+            cell = "%.2fms" % (result[column] * 1000)
+            old_result = baseline_results.get(result["symbols"], {})
+            if old_result.get(column):
+                cell += " (%.2fx)" % (result[column] / old_result[column])
+            line += " %18s" % cell
+        print(line)
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time merge_config, findAllKConfigFiles, the clone and "
+                    "the board merge against generated Kconfig trees and "
+                    "repositories")
+    parser.add_argument("--symbols", type=int, nargs="+",
+                        default=[10, 100, 1000, 10000],
+                        help="number of symbols of the synthetic trees")
+    parser.add_argument("--files", type=int, default=10,
+                        help="number of nested Kconfig files per tree")
+    parser.add_argument("--library-size", type=int, default=256 * 1024,
+                        help="bytes of source code per library directory")
+    parser.add_argument("--submodule-size", type=int, default=1024 * 1024,
+                        help="bytes of source code per submodule")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of runs per tree (the median is shown)")
+    parser.add_argument("--results-directory", default=RESULTS_DIRECTORY,
+                        help="directory the results are saved in")
+    parser.add_argument("--compare", metavar="RESULTS",
+                        help="results file of an earlier run to compare to")
+    arguments = parser.parse_args()
+
+    results = runBenchmarks(arguments.symbols, arguments.files,
+                            arguments.library_size, arguments.submodule_size,
+                            arguments.repeat)
+    results_filename = saveResults(results, {
+        "files": arguments.files, "library_size": arguments.library_size,
+        "submodule_size": arguments.submodule_size,
+        "repeat": arguments.repeat}, arguments.results_directory)
+
+    baseline = None
+    if arguments.compare:
+        with open(arguments.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+    printResults(results, baseline)
+    print("\nResults saved to %s" % results_filename)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+from collections import OrderedDict, namedtuple
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from fileUtils import CACHE_DIRECTORY, SOURCE_DIRECTORY, writeFileAtomically
+import kconfigCache
+import libraryManifest
+
+
+# The vendors and boards that the menus offer and that the batch mode runs
+# are the directories of vendors/ with a KConfig (the defaults of the board).
+# This module lists them into a catalog together with, for every board, its
+# defaults file, the libraries its defaults enable and the estimated download
+# size of those libraries. The catalog is kept in the on disk cache with the
+# modification times of the directories and files it was built from, so
+# later runs load it with a stat call per input instead of walking vendors/
+# and merging every board, and rebuild it as soon as a board is added,
+# removed or edited, or KConfig or the library manifest change.
+
+
+# Directory of the on disk cache. None disables the on disk cache.
+BOARD_CATALOG_DIRECTORY = os.path.join(CACHE_DIRECTORY, "boards")
+
+# Catalogs written by another version of this module are rebuilt
+CATALOG_VERSION = 1
+
+# Name of the defaults file of every board
+BOARD_DEFAULTS_FILENAME = "KConfig"
+
+# What the catalog knows about one board. "defaults_filename" is absolute,
+# "enabled_libraries" is sorted and "estimated_size" (in bytes) is None
+# while the library manifest has no sizes.
+BoardInfo = namedtuple("BoardInfo", ["vendor", "board", "defaults_filename",
+                                     "enabled_libraries", "estimated_size"])
+
+# Catalogs loaded by this process keyed by their vendors directory
+_board_catalogs = {}
+_board_catalogs_lock = threading.Lock()
+
+
+# getCatalogFilename: Every vendors directory gets its own catalog
+# Returns: the path of the catalog of "vendors_directory"
+def getCatalogFilename(vendors_directory, cache_directory):
+    directory_hash = hashlib.sha1(
+        vendors_directory.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(cache_directory, "catalog-%s.json" % directory_hash)
+
+
+# findBoards: Walks "vendors_directory" for boards with a defaults file.
+# Returns: a sorted list of (vendor, board) tuples
+def findBoards(vendors_directory):
+    boards = []
+    with os.scandir(vendors_directory) as vendor_entries:
+        for vendor_entry in vendor_entries:
+            if not vendor_entry.is_dir():
+                continue
+            with os.scandir(vendor_entry.path) as board_entries:
+                for board_entry in board_entries:
+                    if board_entry.is_dir() and os.path.isfile(
+                            os.path.join(board_entry.path,
+                                         BOARD_DEFAULTS_FILENAME)):
+                        boards.append((vendor_entry.name, board_entry.name))
+    return sorted(boards)
+
+
+# getDefaultLibraries: Merges the defaults of a board on top of KConfig.
+# Returns: the sorted library symbols of "manifest" that the defaults enable
+def getDefaultLibraries(kconf, kconfig_filename, defaults_filename,
+                        manifest):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        result = kconfigCache.mergeConfig(kconfig_filename, SOURCE_DIRECTORY,
+                                          os.path.join(temp_dir, ".config"),
+                                          [defaults_filename])
+    finally:
+        shutil.rmtree(temp_dir)
+    enabled_lines = set(result.config.splitlines())
+    return sorted(library for library in manifest["libraries"]
+                  if "%s%s=y" % (kconf.config_prefix, library) in
+                  enabled_lines)
+
+
+# buildBoardCatalog: Lists every board of "vendors_directory" with its
+# defaults file, the libraries its defaults enable and the estimated download
+# size of those and of the libraries they need (see
+# libraryManifest.getLibraryClosure) according to "manifest".
+# Returns: the catalog, a dict with the "boards" and the modification times
+# of its "inputs"
+def buildBoardCatalog(vendors_directory, manifest,
+                      kconfig_filename="KConfig"):
+    kconf = kconfigCache.getKconfig(kconfig_filename, SOURCE_DIRECTORY)
+    boards = findBoards(vendors_directory)
+
+    # Adding or removing a board changes the mtime of its vendor directory,
+    # adding or removing a vendor the mtime of the vendors directory
+    inputs = [vendors_directory]
+    inputs += sorted(set(os.path.join(vendors_directory, vendor)
+                         for vendor, board in boards))
+    inputs += [os.path.join(SOURCE_DIRECTORY, filename)
+               for filename in kconf.kconfig_filenames]
+    inputs.append(libraryManifest.getManifestFilename())
+
+    catalog_boards = []
+    for vendor, board in boards:
+        defaults_filename = os.path.join(vendors_directory, vendor, board,
+                                         BOARD_DEFAULTS_FILENAME)
+        inputs.append(defaults_filename)
+        enabled_libraries = getDefaultLibraries(kconf, kconfig_filename,
+                                                defaults_filename, manifest)
+        estimated_size = libraryManifest.estimateDownloadSize(
+            libraryManifest.getLibraryClosure(enabled_libraries, kconf,
+                                              manifest), manifest)
+        catalog_boards.append(BoardInfo(vendor, board, defaults_filename,
+                                        enabled_libraries, estimated_size))
+
+    return {"version": CATALOG_VERSION,
+            "inputs": kconfigCache.getModificationTimes(inputs),
+            "boards": [board_info._asdict() for board_info in catalog_boards]}
+
+
+# isCatalogCurrent: Returns: whether none of the inputs of "catalog" changed
+# since it was built
+def isCatalogCurrent(catalog):
+    return (catalog.get("version") == CATALOG_VERSION and
+            kconfigCache.getModificationTimes(catalog["inputs"]) ==
+            catalog["inputs"])
+
+
+# readCatalog: Returns: the catalog in "catalog_filename", or None
+def readCatalog(catalog_filename):
+    try:
+        with open(catalog_filename) as catalog_file:
+            return json.load(catalog_file)
+    except (IOError, ValueError):
+        return None
+
+
+# writeCatalog: Writes "catalog" to the cache. The file is replaced with a
+# rename so other processes never read half of it.
+def writeCatalog(catalog, catalog_filename):
+    os.makedirs(os.path.dirname(catalog_filename), exist_ok=True)
+    writeFileAtomically(catalog_filename,
+                        json.dumps(catalog, indent=1, sort_keys=True))
+
+
+# loadBoardCatalog: Loads the catalog of "vendors_directory" from memory or
+# from the on disk cache, and builds it (see buildBoardCatalog) only if it
+# isn't there or one of its inputs changed.
+# Returns: an OrderedDict mapping every vendor to an OrderedDict mapping its
+# boards to their BoardInfo, both sorted by name
+def loadBoardCatalog(vendors_directory, manifest):
+    vendors_directory = os.path.abspath(vendors_directory)
+    with _board_catalogs_lock:
+        catalog = _board_catalogs.get(vendors_directory)
+        if catalog is None or not isCatalogCurrent(catalog):
+            catalog_filename = None
+            if BOARD_CATALOG_DIRECTORY is not None:
+                catalog_filename = getCatalogFilename(
+                    vendors_directory, BOARD_CATALOG_DIRECTORY)
+                catalog = readCatalog(catalog_filename)
+            if catalog is None or not isCatalogCurrent(catalog):
+                catalog = buildBoardCatalog(vendors_directory, manifest)
+                if catalog_filename is not None:
+                    writeCatalog(catalog, catalog_filename)
+            _board_catalogs[vendors_directory] = catalog
+
+    boards = OrderedDict()
+    for board_info in catalog["boards"]:
+        board_info = BoardInfo(**board_info)
+        boards.setdefault(board_info.vendor, OrderedDict())[
+            board_info.board] = board_info
+    return boards
+
+
+# clearBoardCatalogs: Forgets the catalogs loaded by this process
+def clearBoardCatalogs():
+    with _board_catalogs_lock:
+        _board_catalogs.clear()
@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from fileUtils import SOURCE_DIRECTORY
+import kconfigCache
+import merge_config
+
+
+# The board defaults that setLibraryDefaults shows in the GUI only depend on
+# KConfig and the KConfig of the board, which rarely change. This module
+# precomputes the merged .config of every board into one index so that
+# choosing a board only copies a few lines instead of running kconfiglib.
+# Every entry records the hash of its inputs and is only used while they are
+# unchanged.
+
+
+# Location of the index, relative to this scripts directory like KConfig
+BOARD_DEFAULTS_INDEX = "boardDefaults.json"
+
+
+# getIndexFilename: Returns: the path of the index to use
+def getIndexFilename(index_filename=None):
+    return index_filename or os.path.join(SOURCE_DIRECTORY,
+                                          BOARD_DEFAULTS_INDEX)
+
+
+# getBoardDefaultsFilename: Returns: the path of the defaults of a board,
+# relative to SOURCE_DIRECTORY
+def getBoardDefaultsFilename(vendor, board):
+    return "../vendors/" + vendor + "/" + board + "/KConfig"
+
+
+# getInputHash: Hashes everything the merged defaults of a board depend on:
+# the files of the Kconfig tree and the KConfig of the board.
+# Returns: the hex digest, or None if one of the files is missing
+def getInputHash(kconfig_filenames, vendor, board):
+    tree_hash = kconfigCache.getTreeHash(kconfig_filenames, SOURCE_DIRECTORY)
+    board_hash = kconfigCache.getTreeHash(
+        [getBoardDefaultsFilename(vendor, board)], SOURCE_DIRECTORY)
+    if tree_hash is None or board_hash is None:
+        return None
+    return hashlib.sha256((tree_hash + board_hash).encode("utf-8")).hexdigest()
+
+
+# buildDefaultsIndex: Merges the defaults of every board in "boards" (a list
+# of (vendor, board) tuples) and stores the results in the index.
+# Returns: the number of boards in the index
+def buildDefaultsIndex(boards, kconfig_filename="KConfig",
+                       index_filename=None):
+    index_filename = getIndexFilename(index_filename)
+    kconf = kconfigCache.getKconfig(kconfig_filename, SOURCE_DIRECTORY)
+    index = {"kconfig_filenames": kconf.kconfig_filenames, "boards": {}}
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for vendor, board in boards:
+            merged_config = os.path.join(temp_dir, vendor + "_" + board)
+            result = merge_config.mergeConfig(
+                kconf, merged_config,
+                [os.path.join(SOURCE_DIRECTORY,
+                              getBoardDefaultsFilename(vendor, board))])
+            index["boards"][vendor + "/" + board] = {
+                "input_hash": getInputHash(kconf.kconfig_filenames, vendor,
+                                           board),
+                "config": result.config,
+                "warnings": result.warnings}
+    finally:
+        shutil.rmtree(temp_dir)
+
+    with open(index_filename, "w") as index_file:
+        json.dump(index, index_file, indent=1, sort_keys=True)
+        index_file.write("\n")
+    return len(index["boards"])
+
+
+# lookupDefaults: Finds the precomputed defaults of a board whose inputs are
+# unchanged since the index was built.
+# Returns: the index entry (a dict with "config" and "warnings"), or None
+def lookupDefaults(vendor, board, index_filename=None):
+    index_filename = getIndexFilename(index_filename)
+    try:
+        with open(index_filename) as index_file:
+            index = json.load(index_file)
+        entry = index["boards"][vendor + "/" + board]
+        kconfig_filenames = index["kconfig_filenames"]
+    except (IOError, ValueError, KeyError):
+        return None
+
+    input_hash = getInputHash(kconfig_filenames, vendor, board)
+    if input_hash is None or input_hash != entry["input_hash"]:
+        return None
+    return entry
+
+
+# writeDefaults: Writes a precomputed configuration to "config_filename"
+# (see merge_config.writeMergedConfig).
+# Returns: a MergeResult, like merge_config.mergeConfig
+def writeDefaults(entry, config_filename):
+    return merge_config.writeMergedConfig(entry["config"], entry["warnings"],
+                                          config_filename)
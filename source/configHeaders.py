@@ -0,0 +1,144 @@
+from collections import OrderedDict
+import glob
+import os
+import sys
+
+from kconfiglib import BOOL, TRISTATE, STRING, HEX, escape
+
+from fileUtils import writeFileIfChanged
+import merge_config
+
+
+# Turns the .config of a checkout into C headers straight from the Kconfig
+# object that merged it, without starting another process: one header with
+# every symbol (KConfig.h), one header per Kconfig file with the symbols
+# defined in it (<name>_config.h) and the per-symbol dependency files of
+# kconfiglib's sync_deps(). They are written where configure.py has genconfig
+# write them, and genconfig (like this module) only rewrites a header whose
+# contents change, so configure.py finds them current. A dependency file is
+# only touched when its symbol changes, so a build after a reconfiguration
+# only recompiles what the change affects.
+
+
+# Name of the header with every symbol, the one genconfig writes for
+# configure.py
+AUTOCONF_HEADER = "KConfig.h"
+
+# Directory of the per-symbol dependency files, relative to the header
+# directory (the default of genconfig --sync-deps)
+DEPS_DIRECTORY = "deps"
+
+# Ending of the per-Kconfig-file headers
+HEADER_SUFFIX = "_config.h"
+
+# First line of the per-Kconfig-file headers. Only headers starting with it
+# are removed when their Kconfig file no longer defines any symbols.
+HEADER_MARKER = "/* Generated from "
+
+
+# getHeaderName: Names the header of the symbols defined in a Kconfig file
+# after the file ("ota_Kconfig" gives "ota_config.h") or, for files only
+# called Kconfig, after their directory.
+# Returns: the file name of the header
+def getHeaderName(kconfig_filename):
+    name = os.path.basename(kconfig_filename)
+    if name.lower().endswith("kconfig"):
+        name = name[:-len("kconfig")]
+    name = name.strip("_.")
+    if not name:
+        name = os.path.basename(os.path.dirname(kconfig_filename)) or "kconfig"
+    return name.lower() + HEADER_SUFFIX
+
+
+# getDefine: Returns: the #define line of a symbol, like write_autoconf()
+# writes it, or None if the symbol isn't written to headers
+def getDefine(kconf, sym):
+    if not sym.config_string:
+        return None
+    value = sym.str_value
+    if sym.orig_type in (BOOL, TRISTATE):
+        if value == "y":
+            return "#define %s%s 1\n" % (kconf.config_prefix, sym.name)
+        if value == "m":
+            return "#define %s%s_MODULE 1\n" % (kconf.config_prefix, sym.name)
+        return None
+    if sym.orig_type is STRING:
+        return '#define %s%s "%s"\n' % (kconf.config_prefix, sym.name,
+                                        escape(value))
+    if sym.orig_type is HEX and not value.startswith(("0x", "0X")):
+        value = "0x" + value
+    return "#define %s%s %s\n" % (kconf.config_prefix, sym.name, value)
+
+
+# getHeaderContents: Groups the symbols of "kconf" by the Kconfig file that
+# defines them.
+# Returns: an OrderedDict mapping header names to their contents
+def getHeaderContents(kconf):
+    headers = OrderedDict()
+    for sym in kconf.unique_defined_syms:
+        kconfig_filename = sym.nodes[0].filename
+        header_name = getHeaderName(kconfig_filename)
+        if header_name not in headers:
+            guard = header_name.upper().replace(".", "_").replace("-", "_")
+            headers[header_name] = [
+                "%s%s, do not edit */\n" % (HEADER_MARKER, kconfig_filename),
+                "#ifndef %s\n" % guard,
+                "#define %s\n\n" % guard]
+        define = getDefine(kconf, sym)
+        if define:
+            headers[header_name].append(define)
+
+    return OrderedDict((header_name, "".join(lines) + "\n#endif\n")
+                       for header_name, lines in headers.items())
+
+
+# isGeneratedHeader: Returns: whether "header_filename" was written by
+# generateHeaders
+def isGeneratedHeader(header_filename):
+    try:
+        with open(header_filename) as header_file:
+            return header_file.readline().startswith(HEADER_MARKER)
+    except IOError:
+        return False
+
+
+# generateHeaders: Loads "config_filename" into "kconf" and writes the
+# headers and dependency files into "header_directory". Generated headers of
+# Kconfig files that no longer define any symbols are removed. A header that
+# wasn't generated (like one written by hand) is never overwritten, a
+# warning is printed instead.
+# Returns: the paths of the headers that were written or removed
+def generateHeaders(kconf, config_filename, header_directory):
+    os.makedirs(header_directory, exist_ok=True)
+    changed_headers = []
+
+    # The Kconfig object may be shared with merges in other threads
+    with merge_config.getMergeLock(kconf):
+        kconf.load_config(config_filename)
+
+        autoconf_header = os.path.join(header_directory, AUTOCONF_HEADER)
+        message = kconf.write_autoconf(autoconf_header)
+        if not message.startswith("No change"):
+            changed_headers.append(autoconf_header)
+        kconf.sync_deps(os.path.join(header_directory, DEPS_DIRECTORY))
+
+        headers = getHeaderContents(kconf)
+
+    for header_name, contents in headers.items():
+        header_filename = os.path.join(header_directory, header_name)
+        if (os.path.exists(header_filename) and
+                not isGeneratedHeader(header_filename)):
+            print("warning: %s wasn't generated from Kconfig, not "
+                  "overwriting it" % header_filename, file=sys.stderr)
+            continue
+        if writeFileIfChanged(header_filename, contents):
+            changed_headers.append(header_filename)
+
+    for header_filename in glob.glob(os.path.join(header_directory,
+                                                  "*" + HEADER_SUFFIX)):
+        if (os.path.basename(header_filename) not in headers and
+                isGeneratedHeader(header_filename)):
+            os.remove(header_filename)
+            changed_headers.append(header_filename)
+
+    return changed_headers
@@ -0,0 +1,81 @@
+import fnmatch
+import os
+import threading
+
+
+# Looking up the configuration fragments of a board globs the vendors tree of
+# a checkout, and a batch looks up every board of the same tree. This module
+# lists a directory with os.scandir the first time it is looked up and
+# answers later lookups from the stored listing, so only the directories of
+# the boards that are used are ever listed. Every directory keeps the mtime
+# it had when it was listed, so a lookup costs one stat and a directory that
+# changed since (files added or removed) is listed again. The indexes are
+# shared by every thread of the process.
+
+
+# Indexes keyed by the absolute path of their root directory
+_directory_indexes = {}
+_directory_indexes_lock = threading.Lock()
+
+
+class DirectoryIndex(object):
+    def __init__(self, root):
+        self.root = root
+        # Maps a root relative directory to (mtime_ns, file names)
+        self._directories = {}
+        self._lock = threading.Lock()
+
+    # _scanDirectory: Lists the files of one directory (with its mtime
+    # "mtime") and stores them in the index
+    def _scanDirectory(self, relative_directory, mtime):
+        with os.scandir(os.path.join(self.root, relative_directory)) as \
+                entries:
+            filenames = [entry.name for entry in entries
+                         if not entry.is_dir()]
+        self._directories[relative_directory] = (mtime, sorted(filenames))
+
+    # listFiles: Lists a root relative directory unless the index has a
+    # listing of it that is still current.
+    # Returns: the sorted names of its files, or an empty list if it doesn't
+    # exist
+    def listFiles(self, relative_directory):
+        relative_directory = os.path.normpath(relative_directory)
+        if relative_directory == ".":
+            relative_directory = ""
+        with self._lock:
+            try:
+                mtime = os.stat(os.path.join(self.root,
+                                             relative_directory)).st_mtime_ns
+                entry = self._directories.get(relative_directory)
+                if entry is None or entry[0] != mtime:
+                    self._scanDirectory(relative_directory, mtime)
+            except OSError:
+                self._directories.pop(relative_directory, None)
+                return []
+            return list(self._directories[relative_directory][1])
+
+    # findFiles: Matches the files of a root relative directory against a
+    # glob "pattern". Like glob, "*" doesn't match names starting with a dot.
+    # Returns: the sorted matching file names
+    def findFiles(self, relative_directory, pattern):
+        return [filename for filename in
+                fnmatch.filter(self.listFiles(relative_directory), pattern)
+                if not filename.startswith(".") or pattern.startswith(".")]
+
+
+# getDirectoryIndex: Returns: the DirectoryIndex of the tree below "root"
+def getDirectoryIndex(root):
+    root = os.path.abspath(root)
+    with _directory_indexes_lock:
+        directory_index = _directory_indexes.get(root)
+        if directory_index is None:
+            directory_index = DirectoryIndex(root)
+            _directory_indexes[root] = directory_index
+        return directory_index
+
+
+# clearDirectoryIndexes: Forgets every DirectoryIndex, for example after a
+# checkout was deleted
+def clearDirectoryIndexes():
+    with _directory_indexes_lock:
+        _directory_indexes.clear()
@@ -1,8 +1,131 @@
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+import argparse
+import concurrent.futures
 import sys
 import subprocess
 import os
-import glob
+import json
+import shutil
+import threading
+import time
+
+from gitUtils import runGit, runGitWithRetry, getDirectorySize, quietGit
+from gitUtils import GitError, getGitDirectory, isMissingRef
+from gitUtils import getDepthArguments
+from gitUtils import GitCancellation, cancellableGit
+from fileUtils import SOURCE_DIRECTORY
+from fileUtils import writeFileAtomically, writeFileIfChanged
+import artifactCache
+import boardCatalog
+import boardDefaults
+import configHeaders
+import directoryIndex
+import kconfigCache
+import libraryManifest
+import librarySelector
+import mirrorCache
+import phaseTrace
+import workspace
+
+
+# Directory that holds the defaults of every vendor and board
+VENDORS_DIRECTORY = os.path.normpath(os.path.join(SOURCE_DIRECTORY,
+                                                  "../vendors"))
+
+# Directory that relative output directories are created in (next to this
+# repository)
+OUTPUT_BASE_DIRECTORY = os.path.normpath(os.path.join(SOURCE_DIRECTORY,
+                                                      "../.."))
+
+# The top level Kconfig file, in SOURCE_DIRECTORY and in the configuration
+# directory of the FreeRTOS repository
+KCONFIG_FILENAME = "KConfig"
+
+# The repository (and branch) that the FreeRTOS source code is cloned from
+FREERTOS_REPOSITORY_URL = "https://github.com/ethan-tucker/amazon-freertos.git"
+FREERTOS_BRANCH = "EthanDev"
+
+# Environment variable that points cloneFreeRTOSRepository at a local
+# mirror cache (see mirrorCache.py). Unset means fetch straight from GitHub.
+MIRROR_CACHE_ENVIRONMENT_VARIABLE = "FETCHSOURCE_MIRROR_CACHE"
+
+# Environment variable with the url of an artifact cache (see
+# artifactCache.py) that finished checkouts are downloaded from and
+# published to. Unset means every checkout is fetched with git.
+ARTIFACT_CACHE_ENVIRONMENT_VARIABLE = "FETCHSOURCE_ARTIFACT_CACHE"
+
+# Environment variable with the workspace directory (see workspace.py) that
+# new checkouts are added to as worktrees. Unset means every checkout is a
+# repository of its own.
+WORKSPACE_ENVIRONMENT_VARIABLE = "FETCHSOURCE_WORKSPACE"
+
+# Name (plus the process id) of the directory that a speculative fetch
+# downloads into before the output directory is known
+STAGING_DIRECTORY_PREFIX = ".fetchSource-staging-"
+
+# Seconds a cancelled speculative fetch gets to notice that its git command
+# was killed and to delete its staging directory before cancel returns
+CANCEL_TIMEOUT = 5
+
+# Number of commits of history that are fetched. Steps that need more
+# history can call deepenRepository. 0 fetches the full history.
+FETCH_DEPTH = 1
+
+# Name of the copy of the users .config that a checkout was fetched with,
+# kept in its .git directory to find out what changed when it is reconfigured
+FETCHED_CONFIG_FILENAME = "fetchSource.config"
+
+# Name of the file in the .git directory of a checkout that records which
+# steps of its fetch completed (see FetchState)
+FETCH_STATE_FILENAME = "fetchSource-state.json"
+
+# Prefix that kconfiglib puts in front of every symbol in the .config file
+CONFIG_PREFIX = "CONFIG_"
+
+# Directories of the FreeRTOS repository that are always checked out no
+# matter which libraries the user has enabled.
+CORE_PATHS = ["freertos_kernel",
+              "demos/include",
+              "demos/common",
+              "demos/demo_runner",
+              "libraries/abstractions/platform",
+              "libraries/abstractions/pkcs11",
+              "libraries/abstractions/secure_sockets",
+              "libraries/c_sdk/standard/common",
+              "libraries/freertos_plus/standard/crypto",
+              "libraries/freertos_plus/standard/pkcs11",
+              "libraries/freertos_plus/standard/tls",
+              "libraries/freertos_plus/standard/utils",
+              "libraries/3rdparty/mbedtls",
+              "libraries/3rdparty/pkcs11",
+              "tools"]
+
+# Directory of the FreeRTOS repository with a directory of board support
+# code (and its submodules) for every vendor. Only the directory of the
+# chosen vendor is checked out.
+VENDORS_PATH = "vendors"
+
+# Maps every library symbol in KConfig to the directories of the FreeRTOS
+# repository that hold its source code (and demos). These and CORE_PATHS are
+# the only list of directories, the library manifest (see
+# libraryManifest.py) only adds their measured sizes.
+LIBRARY_PATHS = OrderedDict(
+        [("OTA_ENABLED", ["libraries/freertos_plus/aws/ota",
+                          "libraries/3rdparty/jsmn",
+                          "libraries/3rdparty/tinycbor",
+                          "demos/ota"]),
+         ("MQTT_ENABLED", ["libraries/c_sdk/standard/mqtt",
+                           "demos/mqtt"]),
+         ("TCP_ENABLED", ["libraries/freertos_plus/standard/freertos_plus_tcp",
+                          "demos/tcp"])])
+
+# Time (in seconds) and bytes received by one phase of the clone
+PhaseStats = namedtuple("PhaseStats", ["name", "seconds", "bytes_received"])
+
+# Outcome of configuring one board in batch mode. "error" is None on success.
+BatchResult = namedtuple("BatchResult", ["vendor", "board", "output_dir",
+                                         "seconds", "error", "trace_events"])
 
 
 # This script is a portion of the configure.py located in the
@@ -83,11 +206,55 @@ def boardChoiceMenu(boards_dict):
 # KConfig with the defaults for the board the user chose located at
 #  '"../vendors/" + vendor_name + "/" + board + "/KConfig"'. This merged
 # configuration is what is inevitably shown to the user in the GUI.
-def setLibraryDefaults(vendor_name, board):
-    board_default_properties = ("../vendors/" + vendor_name + "/" + board +
-                                "/KConfig")
-    subprocess.run(["python3", "merge_config.py", "KConfig", ".config",
-                    board_default_properties])
+# Any "extra_config_files" (for example a preset) are merged on top of the
+# board defaults. Without them the merged configuration is copied from the
+# precomputed index (see boardDefaults.py) as long as its inputs haven't
+# changed, and only merged when they have.
+# Returns: the MergeResult of the merge
+def setLibraryDefaults(vendor_name, board, config_filename=".config",
+                       extra_config_files=()):
+    if not extra_config_files:
+        entry = boardDefaults.lookupDefaults(vendor_name, board)
+        if entry is not None:
+            result = boardDefaults.writeDefaults(entry, config_filename)
+            printMergeResult(result)
+            return result
+
+    board_default_properties = os.path.join(VENDORS_DIRECTORY, vendor_name,
+                                            board, "KConfig")
+    return runMergeConfig(KCONFIG_FILENAME, SOURCE_DIRECTORY, config_filename,
+                          [board_default_properties] +
+                          list(extra_config_files))
+
+
+# getRepositoryDirectory: Returns: the path of the FreeRTOS repository in
+# "output_dir_name", which is relative to OUTPUT_BASE_DIRECTORY unless it is
+# absolute
+def getRepositoryDirectory(output_dir_name):
+    return os.path.join(OUTPUT_BASE_DIRECTORY, output_dir_name)
+
+
+# runMergeConfig: Runs merge_config in this process. The Kconfig tree is only
+# parsed if it hasn't been parsed before, and a merge whose inputs haven't
+# changed reuses its earlier result (see kconfigCache.py). The messages
+# are printed to stdout and the warnings to stderr just like merge_config.py
+# does when it is run as a script.
+# Returns: the MergeResult of the merge
+def runMergeConfig(kconfig_filename, srctree, merged_config, config_files):
+    result = kconfigCache.mergeConfig(kconfig_filename, srctree,
+                                      merged_config, config_files)
+    printMergeResult(result)
+    return result
+
+
+# printMergeResult: Prints the messages of a merge to stdout and its warnings
+# to stderr
+def printMergeResult(result):
+    for message in result.messages:
+        print(message)
+    for warning in result.warnings:
+        print(warning, file=sys.stderr)
+    sys.stdout.flush()
 
 
 # enableLibraries: Calls guiconfig which is what takes the Kconfig file and
@@ -98,6 +265,20 @@ def enableLibraries():
     subprocess.run(["guiconfig"])
 
 
+# chooseLibraries: The terminal alternative to enableLibraries that needs
+# neither Tk nor a display (see librarySelector.py). "overrides" are
+# (symbol name, value) tuples applied before the user gets to choose, and
+# without "interactive" they are all that is applied.
+def chooseLibraries(config_filename=".config", overrides=(),
+                    interactive=True):
+    kconf = kconfigCache.getKconfig(KCONFIG_FILENAME, SOURCE_DIRECTORY)
+    message = librarySelector.selectLibraries(kconf, config_filename,
+                                              overrides, interactive)
+    if message:
+        print(message)
+    sys.stdout.flush()
+
+
 # getOutputDirectory: Asks the user to name the directory that the FreeRTOS
 # source code will end up cloning in to.
 # Returns: The string they entered to be their "output_dir"
@@ -107,34 +288,1019 @@ def getOutputDirectory():
     return output_dir
 
 
+# getEnabledLibraries: Reads the .config file produced by merge_config or
+# guiconfig and collects every symbol that the user left enabled.
+# Returns: a set of symbol names (without the "CONFIG_" prefix)
+def getEnabledLibraries(config_filename=".config"):
+    enabled_libraries = set()
+    with open(config_filename) as config_file:
+        for line in config_file:
+            line = line.strip()
+            if line.startswith(CONFIG_PREFIX) and line.endswith("=y"):
+                enabled_libraries.add(line[len(CONFIG_PREFIX):-len("=y")])
+    return enabled_libraries
+
+
+# getLibraryManifest: Returns: the library manifest of CORE_PATHS and
+# LIBRARY_PATHS (see libraryManifest.getLibraryManifest)
+def getLibraryManifest():
+    return libraryManifest.getLibraryManifest(CORE_PATHS, LIBRARY_PATHS)
+
+
+# getRequiredLibraries: Collects the libraries whose source code is needed
+# for the configuration in "config_filename": the enabled ones plus every
+# library they depend on, select or require (see
+# libraryManifest.getLibraryClosure).
+# Returns: a set of symbol names
+def getRequiredLibraries(config_filename=".config"):
+    kconf = kconfigCache.getKconfig(KCONFIG_FILENAME, SOURCE_DIRECTORY)
+    return libraryManifest.getLibraryClosure(
+        getEnabledLibraries(config_filename), kconf, getLibraryManifest())
+
+
+# printDownloadEstimate: Prints which libraries are fetched for the
+# configuration in "config_filename", including the ones only needed by
+# other libraries, and how much the manifest expects that to download.
+def printDownloadEstimate(config_filename=".config"):
+    manifest = getLibraryManifest()
+    enabled_libraries = getEnabledLibraries(config_filename)
+    required_libraries = getRequiredLibraries(config_filename)
+    for library in sorted(required_libraries - enabled_libraries):
+        print("%s is fetched as well, another library needs it" % library)
+
+    download_size = libraryManifest.estimateDownloadSize(required_libraries,
+                                                         manifest)
+    if download_size is None:
+        print("Estimated download size: unknown (rebuild %s with "
+              "--build-library-manifest)" % libraryManifest.LIBRARY_MANIFEST)
+    else:
+        print("Estimated download size: %.1f MiB" %
+              (download_size / (1024.0 * 1024.0)))
+    sys.stdout.flush()
+
+
+# getSparseCheckoutPaths: Builds the list of directories that should be
+# checked out. The core tree and the directory of "vendor" (of every vendor
+# if it isn't known) are always needed, the library directories are only
+# added when the library is required by the users configuration (see
+# getRequiredLibraries).
+# Returns: a sorted list of repository relative directories
+def getSparseCheckoutPaths(required_libraries, vendor=None):
+    manifest = getLibraryManifest()
+    sparse_paths = set(manifest["core"]["paths"])
+    sparse_paths.add(VENDORS_PATH if vendor is None else
+                     VENDORS_PATH + "/" + vendor)
+    for library, entry in manifest["libraries"].items():
+        if library in required_libraries:
+            sparse_paths.update(entry["paths"])
+    return sorted(sparse_paths)
+
+
+# isPathWithin: Checks whether a repository relative path lives inside (or
+# is equal to) one of the given directories.
+def isPathWithin(path, directories):
+    for directory in directories:
+        if path == directory or path.startswith(directory + "/"):
+            return True
+    return False
+
+
+# resolveSubmoduleUrl: Submodule urls starting with "./" or "../" are
+# relative to the url of the superproject, which git treats like a directory
+# ("../foo.git" next to ".../amazon-freertos.git" is ".../foo.git").
+# Returns: the absolute url of the submodule
+def resolveSubmoduleUrl(url, superproject_url):
+    if not url.startswith(("./", "../")):
+        return url
+    resolved_url = superproject_url.rstrip("/")
+    for part in url.split("/"):
+        if part == "..":
+            # scp-like urls ("host:path") have no "/" before the first part
+            if "/" in resolved_url.split("://")[-1]:
+                resolved_url = resolved_url.rsplit("/", 1)[0]
+            else:
+                resolved_url = resolved_url.rsplit(":", 1)[0] + ":"
+        elif part and part != ".":
+            if not resolved_url.endswith(":"):
+                resolved_url += "/"
+            resolved_url += part
+    return resolved_url
+
+
+# getSubmodules: Reads the .gitmodules file of the cloned repository.
+# Returns: an OrderedDict mapping the repository relative path of every
+# submodule to its url. Relative urls are resolved against
+# FREERTOS_REPOSITORY_URL (see resolveSubmoduleUrl).
+def getSubmodules(repo_directory):
+    result = runGit(["config", "--file", ".gitmodules", "--get-regexp",
+                     r"^submodule\..*\.(path|url)$"], cwd=repo_directory,
+                    capture_output=True)
+    submodule_paths = OrderedDict()
+    submodule_urls = {}
+    for line in result.stdout.splitlines():
+        key, value = line.split(" ", 1)
+        name, setting = key[len("submodule."):].rsplit(".", 1)
+        if setting == "path":
+            submodule_paths[name] = value
+        else:
+            submodule_urls[name] = value
+
+    submodules = OrderedDict()
+    for name, path in submodule_paths.items():
+        url = submodule_urls.get(name)
+        submodules[path] = url and resolveSubmoduleUrl(
+            url, FREERTOS_REPOSITORY_URL)
+    return submodules
+
+
+# measurePhase: Context manager that times one phase of the fetch and counts
+# the bytes that the phase added to the git directory of the repository (the
+# objects that were received), or to "git_directory" if one is given. The
+# result is appended to "phase_stats".
+@contextmanager
+def measurePhase(name, repo_directory, phase_stats, git_directory=None):
+    git_directory = git_directory or getGitDirectory(repo_directory)
+    start_size = getDirectorySize(git_directory)
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        phase_stats.append(PhaseStats(name,
+                                      time.perf_counter() - start_time,
+                                      getDirectorySize(git_directory) -
+                                      start_size))
+
+
+# printPhaseSummary: Prints the time and bytes received of every phase
+def printPhaseSummary(phase_stats):
+    print("\n-----FETCH SUMMARY-----\n")
+    print("%-12s %10s %14s" % ("phase", "time (s)", "bytes"))
+    for stats in phase_stats:
+        print("%-12s %10.2f %14d" % (stats.name, stats.seconds,
+                                     stats.bytes_received))
+    print("%-12s %10.2f %14d" % ("total",
+                                 sum(stats.seconds for stats in phase_stats),
+                                 sum(stats.bytes_received
+                                     for stats in phase_stats)))
+    sys.stdout.flush()
+
+
+# getPhaseStatsTraceArgs: Returns: the PhaseStats of a clone as a dict that
+# can be stored with its trace event
+def getPhaseStatsTraceArgs(phase_stats):
+    return {"clone_phases": [stats._asdict() for stats in phase_stats]}
+
+
+# getFetchedRefType: git records in FETCH_HEAD whether the ref that was
+# fetched is a branch, a tag or a plain commit.
+# Returns: "branch", "tag" or "commit"
+def getFetchedRefType(repo_directory):
+    with open(os.path.join(repo_directory, ".git", "FETCH_HEAD")) as \
+            fetch_head:
+        description = fetch_head.readline().split("\t")[-1]
+    if description.startswith("branch "):
+        return "branch"
+    if description.startswith("tag "):
+        return "tag"
+    return "commit"
+
+
+# deepenRepository: The clone is shallow by default. Steps that need more
+# history can deepen it by "depth" commits, or fetch all of the remaining
+# history when no depth is given.
+def deepenRepository(repo_directory, depth=None):
+    if depth:
+        runGitWithRetry(["fetch", "--deepen=%d" % depth, "origin"],
+                        cwd=repo_directory)
+    else:
+        runGitWithRetry(["fetch", "--unshallow", "origin"],
+                        cwd=repo_directory)
+
+
+# borrowMirrorObjects: Points the alternates of the repository at a mirror
+# from the mirror cache so objects that are already in the mirror are never
+# copied or downloaded.
+def borrowMirrorObjects(repo_directory, mirror_directory):
+    alternates_filename = os.path.join(repo_directory, ".git", "objects",
+                                       "info", "alternates")
+    with open(alternates_filename, "w") as alternates_file:
+        alternates_file.write(os.path.abspath(
+            os.path.join(mirror_directory, "objects")) + "\n")
+
+
+# dissociateFromMirror: Copies the objects borrowed from the mirror into the
+# repository and removes the alternates. This way evicting a mirror from the
+# cache never breaks a checkout that was created from it.
+def dissociateFromMirror(repo_directory):
+    runGit(["repack", "-a", "-d", "-q"], cwd=repo_directory, check=True)
+    os.remove(os.path.join(repo_directory, ".git", "objects", "info",
+                           "alternates"))
+
+
+# FetchState: Records in the .git directory of a repository which steps of
+# fetching "ref" "depth" commits deep completed, so a fetch that was
+# interrupted (a dropped connection, a killed process) is resumed by the next
+# run instead of starting over. Steps recorded for another repository url,
+# ref or depth don't count. The file also marks the repository as one this
+# script created, the only kind it fetches into.
+class FetchState(object):
+    def __init__(self, repo_directory, ref, depth):
+        self.filename = os.path.join(getGitDirectory(repo_directory),
+                                     FETCH_STATE_FILENAME)
+        self.source = {"url": FREERTOS_REPOSITORY_URL, "ref": ref,
+                       "depth": depth}
+        self.recorded_source = None
+        self.completed_steps = []
+        try:
+            with open(self.filename) as state_file:
+                state = json.load(state_file)
+            self.recorded_source = state.get("source")
+            if self.recorded_source == self.source:
+                self.completed_steps = state.get("completed_steps", [])
+        except (IOError, ValueError, AttributeError):
+            pass
+
+    # isResumable: Returns: whether the repository holds a fetch of the same
+    # url and ref that this script started (with any depth)
+    def isResumable(self):
+        return (isinstance(self.recorded_source, dict) and
+                self.recorded_source.get("url") == self.source["url"] and
+                self.recorded_source.get("ref") == self.source["ref"])
+
+    # isCompleted: Returns: whether "step" completed in an earlier run
+    def isCompleted(self, step):
+        return step in self.completed_steps
+
+    # save: Writes the state. The file is replaced with a rename so an
+    # interruption never leaves it half written.
+    def save(self):
+        writeFileAtomically(self.filename, json.dumps(
+            {"source": self.source, "completed_steps": self.completed_steps},
+            indent=1))
+
+    # markCompleted: Records that "step" completed
+    def markCompleted(self, step):
+        self.completed_steps.append(step)
+        self.save()
+
+
+# checkCloneDestination: Like git clone, only fetches into a directory that
+# doesn't exist or is empty, or into a repository that holds an interrupted
+# fetch of the same url and ref (see FetchState). Anything else may hold
+# work of the user that the forced checkout would overwrite.
+# Raises: FileExistsError if "repo_directory" is none of those
+def checkCloneDestination(repo_directory, ref, depth):
+    if not os.path.isdir(repo_directory) or not os.listdir(repo_directory):
+        return
+    if os.path.isdir(os.path.join(repo_directory, ".git")) and \
+            FetchState(repo_directory, ref, depth).isResumable():
+        return
+    raise FileExistsError("destination path '%s' already exists and is not "
+                          "an empty directory or an interrupted fetch of %s"
+                          % (repo_directory, ref))
+
+
+# fetchRepository: Creates the repository in "repo_directory", fetches
+# "ref" into it and checks out "sparse_paths". The repository is a blobless
+# partial clone so blobs are only downloaded once they are checked out.
+# Only "ref" (a branch, tag or commit) is fetched, "depth" commits deep (0
+# fetches the full history), and it is checked out once. When
+# "mirror_cache_directory" is given the objects come from a local mirror that
+# is refreshed incrementally instead. Mirrors that were used are appended to
+# "used_mirrors". Steps that download are retried, and if "repo_directory"
+# holds a fetch that was interrupted the steps it completed are skipped.
+# Raises: GitError if a step keeps failing, FileExistsError if
+# "repo_directory" holds something else (see checkCloneDestination)
+def fetchRepository(repo_directory, sparse_paths, ref, depth,
+                    mirror_cache_directory, phase_stats, used_mirrors):
+    checkCloneDestination(repo_directory, ref, depth)
+
+    # Every command of this phase can be run again on an existing repository
+    with measurePhase("init", repo_directory, phase_stats):
+        runGit(["init", "-q", repo_directory], cwd=None, check=True)
+        runGit(["config", "remote.origin.url", FREERTOS_REPOSITORY_URL],
+               cwd=repo_directory, check=True)
+        if runGit(["config", "--get", "remote.origin.fetch"],
+                  cwd=repo_directory, capture_output=True).returncode != 0:
+            runGit(["config", "remote.origin.fetch",
+                    "+refs/heads/*:refs/remotes/origin/*"],
+                   cwd=repo_directory, check=True)
+        fetch_state = FetchState(repo_directory, ref, depth)
+        fetch_state.save()
+        setSparseCheckout(repo_directory, sparse_paths)
+
+    # Libraries outside of the sparse checkout are never fetched. With a
+    # mirror cache every object is already local so the whole tree of "ref"
+    # is borrowed instead.
+    if not fetch_state.isCompleted("fetch"):
+        with measurePhase("fetch", repo_directory, phase_stats):
+            if mirror_cache_directory:
+                mirror_directory = mirrorCache.updateMirror(
+                    FREERTOS_REPOSITORY_URL, mirror_cache_directory)
+                used_mirrors.append(mirror_directory)
+                borrowMirrorObjects(repo_directory, mirror_directory)
+                remote = os.path.abspath(mirror_directory)
+                fetch_arguments = ["fetch"] + getDepthArguments(depth)
+            else:
+                remote = "origin"
+                fetch_arguments = ["fetch", "--filter=blob:none"] + \
+                    getDepthArguments(depth)
+            runGitWithRetry(fetch_arguments + [remote, ref],
+                            cwd=repo_directory,
+                            should_retry=lambda error: not isMissingRef(
+                                remote, ref, repo_directory))
+        fetch_state.markCompleted("fetch")
+
+    # until the code is pulled into the master branch it only exists in the
+    # EthanDev branch. Branches get a local branch tracking the remote one,
+    # tags and pinned commits are checked out detached. The checkout
+    # downloads the blobs, and if an earlier checkout was interrupted the
+    # files it left behind are overwritten.
+    if not fetch_state.isCompleted("checkout"):
+        with measurePhase("checkout", repo_directory, phase_stats):
+            if getFetchedRefType(repo_directory) == "branch":
+                runGit(["config", "remote.origin.fetch",
+                        "+refs/heads/%s:refs/remotes/origin/%s" % (ref, ref)],
+                       cwd=repo_directory, check=True)
+                runGit(["update-ref", "refs/remotes/origin/" + ref,
+                        "FETCH_HEAD"], cwd=repo_directory, check=True)
+                runGitWithRetry(["checkout", "-q", "-f", "-B", ref,
+                                 "--track", "origin/" + ref],
+                                cwd=repo_directory)
+            else:
+                runGitWithRetry(["checkout", "-q", "-f", "--detach",
+                                 "FETCH_HEAD"], cwd=repo_directory)
+            if mirror_cache_directory:
+                dissociateFromMirror(repo_directory)
+        fetch_state.markCompleted("checkout")
+
+
+# setSparseCheckout: Sets the directories of the cone mode sparse checkout.
+# They are passed on stdin because git only checks command line arguments
+# for being directories, which submodules are not. Once something is checked
+# out this downloads the blobs of added directories, so it is retried.
+def setSparseCheckout(repo_directory, sparse_paths):
+    runGitWithRetry(["sparse-checkout", "set", "--cone", "--stdin"],
+                    cwd=repo_directory,
+                    input="\n".join(sparse_paths) + "\n")
+
+
+# getCheckedOutVendor: Finds the vendor whose directory is part of the
+# sparse checkout of "repo_directory".
+# Returns: the name of the vendor or None if every vendor (or none) is
+# checked out
+def getCheckedOutVendor(repo_directory):
+    result = runGit(["sparse-checkout", "list"], cwd=repo_directory,
+                    capture_output=True)
+    for path in result.stdout.splitlines():
+        if path.startswith(VENDORS_PATH + "/"):
+            return path[len(VENDORS_PATH) + 1:]
+    return None
+
+
+# updateSparseCheckout: Changes the directories that are checked out. Blobs
+# of newly added directories are downloaded on demand.
+def updateSparseCheckout(repo_directory, sparse_paths, phase_stats):
+    with measurePhase("libraries", repo_directory, phase_stats):
+        setSparseCheckout(repo_directory, sparse_paths)
+
+
+# initSubmodules: Only initializes the submodules that belong to the checked
+# out tree ("sparse_paths"), from the mirror cache if one is given.
+# Submodules of a checkout in a workspace are added as worktrees of the
+# submodule stores of the workspace (see addSubmoduleToWorkspace).
+# Submodules that are already checked out are skipped by git, so running
+# this again after an interruption only fetches the missing ones.
+def initSubmodules(repo_directory, sparse_paths, depth,
+                   mirror_cache_directory, phase_stats, used_mirrors):
+    submodules = OrderedDict(
+        (path, url) for path, url in getSubmodules(repo_directory).items()
+        if isPathWithin(path, sparse_paths))
+
+    workspace_directory = workspace.getCheckoutWorkspace(repo_directory)
+    with measurePhase("submodules", repo_directory, phase_stats):
+        if workspace_directory:
+            for path, url in submodules.items():
+                addSubmoduleToWorkspace(repo_directory, path, url,
+                                        workspace_directory, depth)
+        elif mirror_cache_directory:
+            for path, url in submodules.items():
+                mirror_directory = mirrorCache.updateMirror(
+                    url, mirror_cache_directory)
+                used_mirrors.append(mirror_directory)
+                runGitWithRetry(["submodule", "update", "--init",
+                                 "--recursive", "--reference",
+                                 os.path.abspath(mirror_directory),
+                                 "--dissociate"] +
+                                getDepthArguments(depth) +
+                                ["--", path], cwd=repo_directory)
+        elif submodules:
+            runGitWithRetry(["submodule", "update", "--init", "--recursive",
+                             "--filter=blob:none"] +
+                            getDepthArguments(depth) +
+                            ["--"] + list(submodules), cwd=repo_directory)
+
+
+# addSubmoduleToWorkspace: Checks out the submodule at "path" of the checkout
+# in "repo_directory" as a worktree of the store of its "url" in
+# "workspace_directory", so the checkouts of the workspace share its objects.
+# A worktree left behind by an interrupted run is checked out again. Nested
+# submodules are cloned the normal way.
+def addSubmoduleToWorkspace(repo_directory, path, url, workspace_directory,
+                            depth):
+    commit = runGit(["rev-parse", "HEAD:" + path], cwd=repo_directory,
+                    capture_output=True, check=True).stdout.strip()
+    store_directory = workspace.updateSubmoduleStore(
+        url, workspace_directory, commit, depth)
+
+    submodule_directory = os.path.join(repo_directory, path)
+    workspace.addCheckout(store_directory, submodule_directory, commit)
+    runGitWithRetry(["checkout", "-q", "-f", "--detach", commit],
+                    cwd=submodule_directory)
+    runGitWithRetry(["submodule", "update", "--init", "--recursive",
+                     "--filter=blob:none"] + getDepthArguments(depth) +
+                    ["--", path], cwd=repo_directory)
+
+
+# deinitSubmodules: Removes the submodules below "paths" that are checked out
+# from the working tree. Their git directories are kept in .git/modules so
+# enabling the library again doesn't download them again.
+def deinitSubmodules(repo_directory, paths, phase_stats):
+    submodules = [path for path in getSubmodules(repo_directory)
+                  if isPathWithin(path, paths) and
+                  os.path.exists(os.path.join(repo_directory, path, ".git"))]
+
+    with measurePhase("prune", repo_directory, phase_stats):
+        if submodules:
+            runGit(["submodule", "deinit", "-q", "-f", "--"] + submodules,
+                   cwd=repo_directory, check=True)
+
+
+# getFetchedConfigFilename: Returns: the path of the copy of the .config
+# that the checkout in "repo_directory" was fetched with
+def getFetchedConfigFilename(repo_directory):
+    return os.path.join(getGitDirectory(repo_directory),
+                        FETCHED_CONFIG_FILENAME)
+
+
+# saveFetchedConfig: Keeps a copy of the .config that a checkout was fetched
+# with in its .git directory
+def saveFetchedConfig(repo_directory, config_filename):
+    shutil.copyfile(config_filename, getFetchedConfigFilename(repo_directory))
+
+
+# hasInterruptedClone: Returns: whether "output_dir_name" holds a clone that
+# an earlier run started (see FetchState) but didn't finish
+def hasInterruptedClone(output_dir_name):
+    repo_directory = getRepositoryDirectory(output_dir_name)
+    return (os.path.isfile(os.path.join(getGitDirectory(repo_directory),
+                                        FETCH_STATE_FILENAME)) and
+            not os.path.isfile(getFetchedConfigFilename(repo_directory)))
+
+
+# isCheckoutOfBoard: Checks whether "output_dir_name" already holds a
+# checkout that was fetched and configured for the same board.
+def isCheckoutOfBoard(vendor, board, output_dir_name):
+    repo_directory = getRepositoryDirectory(output_dir_name)
+    board_choice_filename = os.path.join(repo_directory,
+                                         "tools/configuration",
+                                         "boardChoice.csv")
+    if not os.path.isfile(getFetchedConfigFilename(repo_directory)):
+        return False
+    try:
+        with open(board_choice_filename) as board_chosen_file:
+            return board_chosen_file.read() == vendor + "," + board
+    except IOError:
+        return False
+
+
+# reconfigureFreeRTOSRepository: Changes the libraries of a checkout made by
+# cloneFreeRTOSRepository to the ones enabled in "config_filename" instead of
+# cloning it again. Only newly enabled libraries (and their submodules) are
+# downloaded, newly disabled ones are removed from the working tree. The
+# directory of "vendor" is checked out, by default the one of the checkout
+# is kept.
+# Returns: the list of PhaseStats of the reconfiguration
+def reconfigureFreeRTOSRepository(output_dir_name, config_filename=".config",
+                                  depth=FETCH_DEPTH,
+                                  mirror_cache_directory=None, vendor=None):
+    print("\n-----Updating FreeRTOS Repository-----\n")
+    sys.stdout.flush()
+
+    repo_directory = getRepositoryDirectory(output_dir_name)
+    old_vendor = getCheckedOutVendor(repo_directory)
+    if vendor is None:
+        vendor = old_vendor
+    old_libraries = getRequiredLibraries(
+        getFetchedConfigFilename(repo_directory))
+    new_libraries = getRequiredLibraries(config_filename)
+    for library in sorted(new_libraries - old_libraries):
+        print("Adding %s" % library)
+    for library in sorted(old_libraries - new_libraries):
+        print("Removing %s" % library)
+    sys.stdout.flush()
+
+    sparse_paths = getSparseCheckoutPaths(new_libraries, vendor)
+    removed_paths = [path for path in
+                     getSparseCheckoutPaths(old_libraries, old_vendor)
+                     if not isPathWithin(path, sparse_paths)]
+    phase_stats = []
+    used_mirrors = []
+
+    # Submodules have to be emptied before sparse-checkout can remove their
+    # directories
+    deinitSubmodules(repo_directory, removed_paths, phase_stats)
+    updateSparseCheckout(repo_directory, sparse_paths, phase_stats)
+    initSubmodules(repo_directory, sparse_paths, depth,
+                   mirror_cache_directory, phase_stats, used_mirrors)
+    saveFetchedConfig(repo_directory, config_filename)
+
+    if mirror_cache_directory:
+        mirrorCache.evictMirrors(mirror_cache_directory,
+                                 mirrorCache.MIRROR_CACHE_SIZE_LIMIT,
+                                 keep=used_mirrors)
+
+    printPhaseSummary(phase_stats)
+    return phase_stats
+
+
 # cloneFreeRTOSRepository: changes directories outside the scope of this
-# scripts directory and clones the FreeRTOS source code.
-def cloneFreeRTOSRepository(output_dir_name):
+# scripts directory and clones the FreeRTOS source code. Only the libraries
+# enabled in "config_filename" are downloaded: the working tree is a sparse
+# checkout of the core tree, the directory of "vendor" (of every vendor if
+# it is None) and the enabled libraries and only the submodules inside of
+# those directories are initialized (see fetchRepository for "ref", "depth"
+# and "mirror_cache_directory"). A
+# clone that was interrupted in "output_dir_name" is resumed.
+# Returns: the list of PhaseStats of the clone
+# Raises: GitError if the clone keeps failing, FileExistsError if
+# "output_dir_name" holds something other than an interrupted clone
+def cloneFreeRTOSRepository(output_dir_name, config_filename=".config",
+                            ref=FREERTOS_BRANCH, depth=FETCH_DEPTH,
+                            mirror_cache_directory=None, vendor=None):
     print("\n-----Cloning FreeRTOS Repository-----\n")
+
+    sparse_paths = getSparseCheckoutPaths(
+        getRequiredLibraries(config_filename), vendor)
+    phase_stats = []
+    used_mirrors = []
+
+    # the freertos repo is cloned outside the scope of this repository
+    repo_directory = getRepositoryDirectory(output_dir_name)
+    try:
+        fetchRepository(repo_directory, sparse_paths, ref, depth,
+                        mirror_cache_directory, phase_stats, used_mirrors)
+        initSubmodules(repo_directory, sparse_paths, depth,
+                       mirror_cache_directory, phase_stats, used_mirrors)
+    except GitError:
+        print("\nThe clone was interrupted. Run the script again with the "
+              "same output directory to resume it.")
+        sys.stdout.flush()
+        raise
+    saveFetchedConfig(repo_directory, config_filename)
+
+    if mirror_cache_directory:
+        mirrorCache.evictMirrors(mirror_cache_directory,
+                                 mirrorCache.MIRROR_CACHE_SIZE_LIMIT,
+                                 keep=used_mirrors)
+
+    printPhaseSummary(phase_stats)
+    return phase_stats
+
+
+# resolveRef: Branches move, so the artifact of a branch is looked up by the
+# commit the branch points at right now.
+# Returns: the commit "ref" names on the remote, or "ref" itself if the
+# remote doesn't advertise it (a pinned commit)
+def resolveRef(ref):
+    result = runGit(["ls-remote", FREERTOS_REPOSITORY_URL, ref], cwd=None,
+                    capture_output=True)
+    if result.returncode != 0 or not result.stdout.strip():
+        return ref
+    return result.stdout.split()[0]
+
+
+# getArtifactKey: The checkout of a fetch only depends on the repository,
+# the "commit" (see resolveRef), the depth and the directories that are
+# checked out, so those (plus the board, which the board merge is run for
+# afterwards) are what the artifact of a fetch is named after.
+# Configurations that only differ in symbols that don't change the fetched
+# libraries share an artifact.
+# Returns: the name of the artifact
+def getArtifactKey(vendor, board, commit, config_filename=".config",
+                   depth=FETCH_DEPTH):
+    sparse_paths = getSparseCheckoutPaths(
+        getRequiredLibraries(config_filename), vendor)
+    return artifactCache.getArtifactKey(
+        [FREERTOS_REPOSITORY_URL, commit, depth, vendor, board] +
+        sparse_paths)
+
+
+# isCheckoutOfCommit: Checks that the repository in "directory" holds
+# "commit" and nothing else. Every object is hashed again (git fsck), the
+# index is rebuilt from HEAD and the working tree rewritten from it, and
+# there must be no other files.
+# Returns: whether "directory" is a clean checkout of "commit"
+def isCheckoutOfCommit(directory, commit):
+    head = runGit(["rev-parse", "--verify", "-q", "HEAD"], cwd=directory,
+                  capture_output=True)
+    if head.returncode != 0 or head.stdout.strip() != commit:
+        return False
+    if runGit(["fsck", "--no-dangling", "--no-progress"], cwd=directory,
+              capture_output=True).returncode != 0:
+        return False
+    index_filename = os.path.join(getGitDirectory(directory), "index")
+    if os.path.exists(index_filename):
+        os.remove(index_filename)
+    return runGit(["reset", "-q", "--hard", "HEAD"], cwd=directory,
+                  capture_output=True).returncode == 0
+
+
+# restoreGitConfig: Sets up the origin of a restored repository like
+# fetchRepository and initSubmodules do (artifacts don't carry git config
+# files, see artifactCache.isGitControlFile)
+def restoreGitConfig(directory, url, ref=None):
+    runGit(["init", "-q"], cwd=directory, check=True)
+    fetch_refspec = "+refs/heads/*:refs/remotes/origin/*"
+    settings = []
+    branch = runGit(["symbolic-ref", "-q", "HEAD"], cwd=directory,
+                    capture_output=True).stdout.strip()
+    if ref is not None and branch == "refs/heads/" + ref:
+        fetch_refspec = "+refs/heads/%s:refs/remotes/origin/%s" % (ref, ref)
+        settings = [("branch.%s.remote" % ref, "origin"),
+                    ("branch.%s.merge" % ref, branch)]
+    for key, value in [("remote.origin.url", url),
+                       ("remote.origin.fetch", fetch_refspec),
+                       ("remote.origin.promisor", "true"),
+                       ("remote.origin.partialclonefilter", "blob:none")] + \
+            settings:
+        runGit(["config", key, value], cwd=directory, check=True)
+
+
+# checkRestoredCheckout: An artifact comes from a server that anyone allowed
+# to upload to controls, so before it is used its repository is given back
+# its config and is checked (see isCheckoutOfCommit) against "commit", the
+# commit that "ref" points at on the remote. Its submodules are checked
+# against the commits the checked tree records, and their git directories
+# must be inside of its .git directory.
+# Returns: whether the checkout in "repo_directory" can be used
+def checkRestoredCheckout(repo_directory, commit, ref, sparse_paths):
+    restoreGitConfig(repo_directory, FREERTOS_REPOSITORY_URL, ref)
+    setSparseCheckout(repo_directory, sparse_paths)
+    if not isCheckoutOfCommit(repo_directory, commit):
+        return False
+
+    modules_directory = os.path.realpath(os.path.join(repo_directory,
+                                                      ".git", "modules"))
+    for path, url in getSubmodules(repo_directory).items():
+        submodule_directory = os.path.join(repo_directory, path)
+        if not os.path.exists(os.path.join(submodule_directory, ".git")):
+            continue
+        git_directory = os.path.realpath(getGitDirectory(submodule_directory))
+        if not isPathWithin(git_directory, [modules_directory]) or \
+                not os.path.isdir(git_directory):
+            return False
+        restoreGitConfig(submodule_directory, url)
+        runGit(["config", "core.worktree", os.path.relpath(
+            os.path.realpath(submodule_directory), git_directory)],
+            cwd=submodule_directory, check=True)
+        submodule_commit = runGit(["rev-parse", "HEAD:" + path],
+                                  cwd=repo_directory, capture_output=True,
+                                  check=True).stdout.strip()
+        if not isCheckoutOfCommit(submodule_directory, submodule_commit):
+            return False
+        runGit(["submodule", "init", "-q", "--", path], cwd=repo_directory,
+               check=True)
+
+    return runGit(["status", "--porcelain", "--ignored",
+                   "--untracked-files=all"], cwd=repo_directory,
+                  capture_output=True, check=True).stdout == ""
+
+
+# restoreFromArtifactCache: Downloads and extracts the artifact called "key"
+# into "output_dir_name", checks that it is a checkout of "commit" (see
+# checkRestoredCheckout) and records "config_filename" as the configuration
+# it was fetched with.
+# Returns: the list of PhaseStats of the download, or None if the cache
+# doesn't have the artifact or the artifact can't be used
+def restoreFromArtifactCache(artifact_cache_url, key, output_dir_name,
+                             commit, config_filename=".config",
+                             ref=FREERTOS_BRANCH, vendor=None):
+    repo_directory = getRepositoryDirectory(output_dir_name)
+    if os.path.exists(repo_directory):
+        return None
+    phase_stats = []
+    with measurePhase("artifact", repo_directory, phase_stats):
+        found = artifactCache.downloadArtifact(artifact_cache_url, key,
+                                               repo_directory)
+        if found:
+            sparse_paths = getSparseCheckoutPaths(
+                getRequiredLibraries(config_filename), vendor)
+            try:
+                with quietGit():
+                    valid = checkRestoredCheckout(repo_directory, commit,
+                                                  ref, sparse_paths)
+            except (GitError, OSError):
+                valid = False
+    if not found:
+        return None
+    if not valid:
+        print("warning: artifact cache: %s.tar.gz isn't a checkout of %s, "
+              "cloning instead" % (key, commit))
+        shutil.rmtree(repo_directory)
+        return None
+    saveFetchedConfig(repo_directory, config_filename)
+    print("Restored the checkout from the artifact cache")
+    printPhaseSummary(phase_stats)
+    return phase_stats
+
+
+# publishToArtifactCache: Uploads a finished checkout as the artifact called
+# "key". Checkouts without a HEAD (a fetch that failed) are not published.
+def publishToArtifactCache(artifact_cache_url, key, output_dir_name):
+    repo_directory = getRepositoryDirectory(output_dir_name)
+    result = runGit(["rev-parse", "--verify", "-q", "HEAD"],
+                    cwd=repo_directory, capture_output=True)
+    if result.returncode == 0 and artifactCache.publishArtifact(
+            artifact_cache_url, key, repo_directory):
+        print("Published the checkout to the artifact cache")
     sys.stdout.flush()
 
-    # change directories so that the freertos repo is cloned outside the scope
-    # of this repository
-    subprocess.run(["git", "clone",
-                    "https://github.com/ethan-tucker/amazon-freertos.git",
-                    "--recurse-submodules", output_dir_name], cwd="../..")
 
-    # until the code is pulled into the master branch it only exists in the
-    # EthanDev branch. So the user must checkout into that branch.
-    repo_directory = "../../" + output_dir_name
-    subprocess.run(["git", "checkout", "EthanDev"], cwd=repo_directory)
+# fetchFreeRTOSRepository: Gets a new checkout for the configuration in
+# "config_filename". With a "workspace_directory" it is added to the
+# workspace. Otherwise it comes from the artifact cache at
+# "artifact_cache_url" if that has it, or else from git: from
+# "speculative_fetch" when one was started or with cloneFreeRTOSRepository.
+# Checkouts fetched with git are published to the artifact cache for the
+# next fetch. Worktrees can't be archived, so workspaces don't use the
+# artifact cache.
+# Returns: the list of PhaseStats of the fetch
+def fetchFreeRTOSRepository(vendor, board, output_dir_name,
+                            config_filename=".config", ref=FREERTOS_BRANCH,
+                            depth=FETCH_DEPTH, mirror_cache_directory=None,
+                            artifact_cache_url=None, speculative_fetch=None,
+                            workspace_directory=None):
+    if workspace_directory:
+        if speculative_fetch is not None:
+            speculative_fetch.cancel()
+        return addToWorkspace(output_dir_name, workspace_directory,
+                              config_filename, ref, depth, vendor)
+
+    if artifact_cache_url:
+        commit = resolveRef(ref)
+        key = getArtifactKey(vendor, board, commit, config_filename, depth)
+        phase_stats = restoreFromArtifactCache(
+            artifact_cache_url, key, output_dir_name, commit,
+            config_filename, ref, vendor)
+        if phase_stats is not None:
+            # Kills the staging clone instead of waiting for it
+            if speculative_fetch is not None:
+                speculative_fetch.cancel()
+            return phase_stats
+
+    if speculative_fetch is not None:
+        phase_stats = speculative_fetch.finish(output_dir_name)
+    else:
+        phase_stats = cloneFreeRTOSRepository(output_dir_name,
+                                              config_filename, ref, depth,
+                                              mirror_cache_directory, vendor)
+    if artifact_cache_url:
+        publishToArtifactCache(artifact_cache_url, key, output_dir_name)
+    return phase_stats
+
+
+# addToWorkspace: Creates the checkout in "output_dir_name" as a worktree of
+# the store of "workspace_directory" instead of as a repository of its own
+# (see workspace.py). The store is brought up to date with "ref", then the
+# worktree checks out the core tree plus the libraries enabled in
+# "config_filename" and their submodules. Only blobs that the store doesn't
+# have yet are downloaded. A worktree that an interrupted run left in
+# "output_dir_name" is reused, and once its checkout completed (see
+# FetchState) only its libraries and submodules are updated.
+# Returns: the list of PhaseStats of the fetch, with the bytes received by
+# the store
+def addToWorkspace(output_dir_name, workspace_directory,
+                   config_filename=".config", ref=FREERTOS_BRANCH,
+                   depth=FETCH_DEPTH, vendor=None):
+    print("\n-----Adding the FreeRTOS Repository to the Workspace-----\n")
+
+    sparse_paths = getSparseCheckoutPaths(
+        getRequiredLibraries(config_filename), vendor)
+    repo_directory = getRepositoryDirectory(output_dir_name)
+    store_directory = workspace.getStoreDirectory(workspace_directory)
+    phase_stats = []
+
+    fetch_state = None
+    if workspace.isWorktreeOf(repo_directory, store_directory):
+        fetch_state = FetchState(repo_directory, ref, depth)
+
+    try:
+        if fetch_state is None or not fetch_state.isCompleted("checkout"):
+            with measurePhase("fetch", repo_directory, phase_stats,
+                              store_directory):
+                commit = workspace.updateStore(FREERTOS_REPOSITORY_URL,
+                                               workspace_directory, ref,
+                                               depth)
+            with measurePhase("worktree", repo_directory, phase_stats,
+                              store_directory):
+                workspace.addCheckout(store_directory, repo_directory,
+                                      commit)
+                setSparseCheckout(repo_directory, sparse_paths)
+            with measurePhase("checkout", repo_directory, phase_stats,
+                              store_directory):
+                runGitWithRetry(["checkout", "-q", "-f", "--detach", commit],
+                                cwd=repo_directory)
+            FetchState(repo_directory, ref, depth).markCompleted("checkout")
+        else:
+            updateSparseCheckout(repo_directory, sparse_paths, phase_stats)
+        initSubmodules(repo_directory, sparse_paths, depth, None,
+                       phase_stats, [])
+    except GitError:
+        print("\nAdding the checkout was interrupted. Run the script again "
+              "with the same output directory to resume it.")
+        sys.stdout.flush()
+        raise
+    saveFetchedConfig(repo_directory, config_filename)
+
+    printPhaseSummary(phase_stats)
+    return phase_stats
+
+
+# isProcessRunning: Returns: whether a process with the id "pid" exists.
+# Windows has no signal that only checks this, so there every process is
+# taken to be running.
+def isProcessRunning(pid):
+    if os.name == "nt":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# removeStaleStagingDirectories: Deletes the staging directories of
+# speculative fetches whose process is gone, like one that was killed before
+# it could clean up.
+def removeStaleStagingDirectories():
+    staging_prefix = os.path.join(OUTPUT_BASE_DIRECTORY,
+                                  STAGING_DIRECTORY_PREFIX)
+    prefix = os.path.basename(staging_prefix)
+    try:
+        entries = os.listdir(os.path.dirname(staging_prefix))
+    except OSError:
+        return
+    for entry in entries:
+        pid = entry[len(prefix):]
+        if (entry.startswith(prefix) and pid.isdigit() and
+                not isProcessRunning(int(pid))):
+            shutil.rmtree(os.path.join(os.path.dirname(staging_prefix),
+                                       entry), ignore_errors=True)
+
+
+# SpeculativeFetch: Downloads the part of the repository that every
+# configuration needs (the history and the core tree) in a background thread
+# while the user is still choosing libraries in guiconfig. The repository is
+# created in a staging directory next to the output directories because the
+# output directory isn't known yet. Once the libraries are chosen
+# (addLibraries) they are added to the staging repository and finish() moves
+# it into the output directory. cancel() kills the running git command
+# instead of waiting for the download.
+class SpeculativeFetch(object):
+    def __init__(self, ref=FREERTOS_BRANCH, depth=FETCH_DEPTH,
+                 mirror_cache_directory=None, vendor=None):
+        self.ref = ref
+        self.depth = depth
+        self.mirror_cache_directory = mirror_cache_directory
+        self.vendor = vendor
+        self.staging_directory = os.path.join(
+            OUTPUT_BASE_DIRECTORY, STAGING_DIRECTORY_PREFIX + str(os.getpid()))
+        self.phase_stats = []
+        self.used_mirrors = []
+        self.error = None
+        self._config_filename = None
+        self._libraries_chosen = threading.Event()
+        self._cancellation = GitCancellation()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    # start: Starts downloading the core of the repository, after deleting
+    # the staging directories that killed runs left behind
+    def start(self):
+        removeStaleStagingDirectories()
+        shutil.rmtree(self.staging_directory, ignore_errors=True)
+        self._thread.start()
+        return self
+
+    # addLibraries: Hands the users configuration to the background thread
+    # so the libraries it enables are added as soon as the core is fetched
+    def addLibraries(self, config_filename):
+        self._config_filename = os.path.abspath(config_filename)
+        self._libraries_chosen.set()
+
+    def _run(self):
+        try:
+            with quietGit(), cancellableGit(self._cancellation):
+                fetchRepository(self.staging_directory,
+                                getSparseCheckoutPaths([], self.vendor),
+                                self.ref, self.depth,
+                                self.mirror_cache_directory,
+                                self.phase_stats, self.used_mirrors)
+
+                self._libraries_chosen.wait()
+                if self._config_filename is None:
+                    return
+                sparse_paths = getSparseCheckoutPaths(
+                    getRequiredLibraries(self._config_filename), self.vendor)
+                updateSparseCheckout(self.staging_directory, sparse_paths,
+                                     self.phase_stats)
+                initSubmodules(self.staging_directory, sparse_paths,
+                               self.depth, self.mirror_cache_directory,
+                               self.phase_stats, self.used_mirrors)
+                saveFetchedConfig(self.staging_directory,
+                                  self._config_filename)
+        except Exception as exception:
+            self.error = exception
+        finally:
+            if self._cancellation.isCancelled():
+                shutil.rmtree(self.staging_directory, ignore_errors=True)
+
+    # finish: Waits for the background thread and moves the repository into
+    # the output directory. If the speculative fetch failed the repository
+    # is cloned the normal way instead (as it is if moving it fails), and if
+    # the output directory already exists the speculative fetch is cancelled
+    # and the repository there is cloned (or resumed) the normal way.
+    # Returns: the list of PhaseStats of the fetch
+    def finish(self, output_dir_name):
+        print("\n-----Cloning FreeRTOS Repository-----\n")
+        sys.stdout.flush()
+
+        # The staging clone can't be moved over a repository that is already
+        # there (like a clone that was interrupted and is resumed), so it is
+        # stopped instead of waited for
+        repo_directory = getRepositoryDirectory(output_dir_name)
+        if os.path.exists(repo_directory):
+            self.cancel()
+        else:
+            self._thread.join()
+
+        if (self.error is not None or self._config_filename is None or
+                os.path.exists(repo_directory)):
+            return self._clone(output_dir_name)
+
+        try:
+            shutil.move(self.staging_directory, repo_directory)
+        except OSError as error:
+            print("warning: can't move the speculative fetch to %s: %s" %
+                  (repo_directory, error), file=sys.stderr)
+            # A move across file systems copies, so a partial copy may be
+            # left behind
+            shutil.rmtree(repo_directory, ignore_errors=True)
+            return self._clone(output_dir_name)
+        if self.mirror_cache_directory:
+            mirrorCache.evictMirrors(self.mirror_cache_directory,
+                                     mirrorCache.MIRROR_CACHE_SIZE_LIMIT,
+                                     keep=self.used_mirrors)
+        printPhaseSummary(self.phase_stats)
+        return self.phase_stats
+
+    # _clone: Deletes the staging repository and clones into
+    # "output_dir_name" the normal way instead.
+    # Returns: the list of PhaseStats of the clone
+    def _clone(self, output_dir_name):
+        shutil.rmtree(self.staging_directory, ignore_errors=True)
+        return cloneFreeRTOSRepository(
+            output_dir_name, self._config_filename or ".config", self.ref,
+            self.depth, self.mirror_cache_directory, self.vendor)
+
+    # cancel: Stops the speculative fetch (started or not) and deletes the
+    # staging repository. The running git command is killed, so this
+    # doesn't wait for the download. If the thread takes longer than
+    # CANCEL_TIMEOUT to stop it deletes the staging repository itself.
+    def cancel(self):
+        self._cancellation.cancel()
+        self._libraries_chosen.set()
+        if self._thread.ident is not None:
+            self._thread.join(CANCEL_TIMEOUT)
+        if not self._thread.is_alive():
+            shutil.rmtree(self.staging_directory, ignore_errors=True)
 
 
 # updateBoardChosen: Now that the user has chosen a board and cloned the repo
 # the repository must be modified slightly to represent the board that the
 # user has chosen. This function updates the ".config" and "boardChoice.csv" to
 # indicate the board choice that the user has made.
+# Returns: the MergeResult of the board merge
 def updateBoardChosen(vendor, board, output_dir_name):
-    command = ["python3", "merge_config.py", "KConfig", ".config"]
-
-    config_files = findAllKConfigFiles(vendor, board, output_dir_name)
-    for file in config_files:
-        command.append(file)
+    configuration_directory = os.path.join(
+        getRepositoryDirectory(output_dir_name), "tools/configuration")
+    config_files = [os.path.normpath(os.path.join(configuration_directory,
+                                                  file))
+                    for file in findAllKConfigFiles(vendor, board,
+                                                    output_dir_name)]
 
     # merg_config.py runs merge config with all of the configruation files
     # associated with the chosen board. This created a heirarchy of defaults
@@ -145,25 +1311,50 @@ def updateBoardChosen(vendor, board, output_dir_name):
     # uses this .config file to generate a new KConfig.h file.
     print("\n-----MERGING CONFIGURATIONS FOR YOUR BOARD-----\n")
     sys.stdout.flush()
-    subprocess.run(command, cwd="../../" + output_dir_name +
-                   "/tools/configuration")
+    result = runMergeConfig(KCONFIG_FILENAME, configuration_directory,
+                            os.path.join(configuration_directory, ".config"),
+                            config_files)
     print()
 
     # Opening the boardChoice.csv file to store the vendor and board choice the
     # user made. This is how the configure.py script will know which option was
     # chosen.
-    with open("../../" + output_dir_name +
-              "/tools/configuration/boardChoice.csv", "w") as \
-              board_chosen_file:
-        board_chosen_file.write(vendor + "," + board)
+    writeFileIfChanged(
+        os.path.join(configuration_directory, "boardChoice.csv"),
+        vendor + "," + board)
+
+    return result
+
+
+# generateConfigHeaders: Generates the configuration headers of the board
+# merge in this process (see configHeaders.py), into the configuration
+# directory where configure.py has genconfig write them. Only headers whose
+# symbols changed since the last time are rewritten, and genconfig leaves
+# headers that are already current alone.
+# Returns: the paths of the headers that changed
+def generateConfigHeaders(output_dir_name):
+    configuration_directory = os.path.join(
+        getRepositoryDirectory(output_dir_name), "tools/configuration")
+    print("\n-----GENERATING CONFIGURATION HEADERS-----\n")
+    kconf = kconfigCache.getKconfig(KCONFIG_FILENAME, configuration_directory)
+    changed_headers = configHeaders.generateHeaders(
+        kconf, os.path.join(configuration_directory, ".config"),
+        configuration_directory)
+    for header_filename in changed_headers:
+        print("Updated %s" % header_filename)
+    if not changed_headers:
+        print("No change to the configuration headers")
+    sys.stdout.flush()
+    return changed_headers
 
 
 # callConfigurationScript: This calls the original configuration script
 # allowing the user to configure the FreeRTOS code as well as provision
 # AWS resources and build and run their demo of choice.
 def callConfigurationScript(output_dir_name):
-    subprocess.run(["python3", "configure.py"], cwd="../../" + output_dir_name +
-                    "/tools/configuration")
+    subprocess.run(["python3", "configure.py"],
+                   cwd=os.path.join(getRepositoryDirectory(output_dir_name),
+                                    "tools/configuration"))
 
 
 # findAllKConfigFiles: Globs the boards directory tree for Kconfig files.
@@ -172,61 +1363,398 @@ def callConfigurationScript(output_dir_name):
 # boards do not have all of the configuration files (for example some boards
 # wont have ota_agent_config.h).
 def findAllKConfigFiles(vendor, board, output_dir_name):
-    os.chdir("../../" + output_dir_name +
-             "/tools/configuration")
     board_properties = ("../../vendors/" +
                         vendor + "/boards/" + board + "/*Kconfig")
     library_configs = ("../../vendors/" +
                        vendor + "/boards/" + board +
                        "/aws_demos/config_files/*Kconfig")
-    KconfigFilenamesList = (glob.glob(board_properties) +
-                            glob.glob(library_configs))
-    
-    os.chdir("../../../sourceFetcher/source")
+
+    # The patterns are relative to the configuration directory of the clone
+    # and so are the returned names. Every directory of the clone is only
+    # listed once (see directoryIndex.py), later lookups for the same board
+    # reuse the listing.
+    vendors_index = directoryIndex.getDirectoryIndex(
+        os.path.join(getRepositoryDirectory(output_dir_name), "vendors"))
+    KconfigFilenamesList = []
+    for pattern in [board_properties, library_configs]:
+        pattern_directory = os.path.dirname(pattern)
+        for filename in vendors_index.findFiles(
+                os.path.relpath(pattern_directory, "../../vendors"),
+                os.path.basename(pattern)):
+            KconfigFilenamesList.append(os.path.join(pattern_directory,
+                                                     filename))
 
     return KconfigFilenamesList
 
 
-def main():
-    # I used an ordered dict here so that it was easy to use/index as well as
-    # easy to add new vendor board combos.
-    boards_dict = OrderedDict(
-             [("cypress", ["CY8CKIT_064S0S2_4343W", "CYW943907AEVAL1F",
-                           "CYW954907AEVAL1F"]),
-              ("espressif", ["esp32"]),
-              ("infineon", ["xmc4800_iotkit", "xmc4800_plus_optiga_trust_x"]),
-              ("marvell", ["mw300_rd"]),
-              ("mediatek", ["mt7697hx-dev-kit"]),
-              ("microchip", ["curiosity_pic32mzef", "ecc608a_plus_winsim"]),
-              ("nordic", ["nrf52840-dk"]),
-              ("nuvoton", ["numaker_iot_m487_wifi"]),
-              ("nxp", ["lpc54018iotmodule"]),
-              ("pc", ["linux", "windows"]),
-              ("renesas", ["rx65n-rsk"]),
-              ("st", ["stm32l475_discovery"]),
-              ("ti", ["cc3220_launchpad"]),
-              ("xilinx", ["microzed"])])
+# getBoardCatalog: Returns: the catalog of the boards in the vendors
+# directory (see boardCatalog.py), an OrderedDict mapping every vendor to an
+# OrderedDict mapping its boards to their BoardInfo
+def getBoardCatalog():
+    return boardCatalog.loadBoardCatalog(VENDORS_DIRECTORY,
+                                         getLibraryManifest())
+
+
+# getBoardsDict: Returns: an OrderedDict mapping every vendor to the list of
+# its boards, which is what boardChoiceMenu expects
+def getBoardsDict():
+    return OrderedDict((vendor, list(boards))
+                       for vendor, boards in getBoardCatalog().items())
+
+
+# getAllBoards: Lists every vendor/board pair that has a defaults file in
+# the vendors directory.
+# Returns: a sorted list of (vendor, board) tuples
+def getAllBoards():
+    return [(vendor, board) for vendor, boards in getBoardCatalog().items()
+            for board in boards]
+
+
+# printBoardCatalog: Prints every board with the libraries its defaults
+# enable and their estimated download size
+def printBoardCatalog():
+    print("%-45s %10s  %s" % ("board", "size (MiB)", "default libraries"))
+    for vendor, boards in getBoardCatalog().items():
+        for board_info in boards.values():
+            if board_info.estimated_size is None:
+                size = "unknown"
+            else:
+                size = "%.1f" % (board_info.estimated_size /
+                                 (1024.0 * 1024.0))
+            print("%-45s %10s  %s" % (vendor + "/" + board_info.board, size,
+                                      " ".join(board_info.enabled_libraries)))
+    sys.stdout.flush()
+
+
+# redirectOutput: Context manager that sends everything written to stdout and
+# stderr, including the output of child processes like git, to "filename".
+@contextmanager
+def redirectOutput(filename):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_stdout = os.dup(1)
+    saved_stderr = os.dup(2)
+    with open(filename, "w") as log_file:
+        os.dup2(log_file.fileno(), 1)
+        os.dup2(log_file.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_stdout, 1)
+            os.dup2(saved_stderr, 2)
+            os.close(saved_stdout)
+            os.close(saved_stderr)
+
+
+# configureBoard: Runs every non-interactive step for one board: the defaults
+# merge (plus the "config_files" and symbol "overrides" given on the command
+# line), the fetch and
+# the board merge. The source code ends up in "<output_root>/<vendor>_<board>"
+# and the output of every step is written to "<output_root>/<vendor>_<board>
+# .log". This runs in a worker process of runBatch, which hands every board
+# the same "trace_epoch" and its own "trace_pid" (see PhaseTracer).
+# Returns: a BatchResult
+def configureBoard(vendor, board, output_root, config_files=(),
+                   ref=FREERTOS_BRANCH, depth=FETCH_DEPTH,
+                   mirror_cache_directory=None, trace=False, overrides=(),
+                   artifact_cache_url=None, workspace_directory=None,
+                   trace_epoch=None, trace_pid=None):
+    target_name = vendor + "_" + board
+    output_dir = os.path.join(output_root, target_name)
+    tracer = phaseTrace.PhaseTracer(trace, target_name, trace_epoch,
+                                    trace_pid)
+    start_time = time.perf_counter()
+
+    error = None
+    try:
+        with redirectOutput(output_dir + ".log"):
+            if not os.path.isfile(os.path.join(VENDORS_DIRECTORY, vendor,
+                                               board, "KConfig")):
+                raise ValueError("unknown board %s/%s" % (vendor, board))
+            with tracer.phase("setLibraryDefaults"):
+                setLibraryDefaults(vendor, board, output_dir + ".config",
+                                   config_files)
+                if overrides:
+                    chooseLibraries(output_dir + ".config", overrides,
+                                    interactive=False)
+                printDownloadEstimate(output_dir + ".config")
+            with tracer.phase("cloneFreeRTOSRepository",
+                              output_dir) as trace_args:
+                if isCheckoutOfBoard(vendor, board, output_dir):
+                    phase_stats = reconfigureFreeRTOSRepository(
+                        output_dir, output_dir + ".config", depth,
+                        mirror_cache_directory, vendor)
+                else:
+                    phase_stats = fetchFreeRTOSRepository(
+                        vendor, board, output_dir, output_dir + ".config",
+                        ref, depth, mirror_cache_directory,
+                        artifact_cache_url, None, workspace_directory)
+                trace_args.update(getPhaseStatsTraceArgs(phase_stats))
+            with tracer.phase("updateBoardChosen", output_dir):
+                updateBoardChosen(vendor, board, output_dir)
+            with tracer.phase("generateConfigHeaders", output_dir):
+                generateConfigHeaders(output_dir)
+    except Exception as exception:
+        error = "%s: %s" % (type(exception).__name__, exception)
+
+    return BatchResult(vendor, board, output_dir,
+                       time.perf_counter() - start_time, error,
+                       tracer.getTraceEvents())
+
+
+# runBatch: Configures and fetches every board in "boards" (a list of
+# (vendor, board) tuples) with at most "jobs" boards being worked on at once,
+# then prints a summary of the results.
+# With "trace" every BatchResult carries the trace events of its board.
+# Returns: the list of BatchResults in the order of "boards" (empty without
+# any boards)
+def runBatch(boards, output_root, config_files=(), jobs=None,
+             ref=FREERTOS_BRANCH, depth=FETCH_DEPTH,
+             mirror_cache_directory=None, trace=False, overrides=(),
+             artifact_cache_url=None, workspace_directory=None):
+    output_root = os.path.abspath(output_root)
+    os.makedirs(output_root, exist_ok=True)
+    config_files = [os.path.abspath(config_file)
+                    for config_file in config_files]
+    if not boards:
+        print("No boards to configure")
+        return []
+    if not jobs:
+        jobs = min(len(boards), 2 * (os.cpu_count() or 1))
+    jobs = max(jobs, 1)
+
+    print("\n-----CONFIGURING %d BOARDS (%d AT A TIME)-----\n" %
+          (len(boards), jobs))
+    sys.stdout.flush()
+    # Workers are reused, so every board is traced as a process of its own
+    trace_epoch = time.time()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(configureBoard, vendor, board, output_root,
+                                   config_files, ref, depth,
+                                   mirror_cache_directory, trace,
+                                   overrides, artifact_cache_url,
+                                   workspace_directory, trace_epoch,
+                                   board_number)
+                   for board_number, (vendor, board) in enumerate(boards, 1)]
+        results = [future.result() for future in futures]
+
+    printBatchSummary(results)
+    return results
+
+
+# printBatchSummary: Prints one line per board of a batch with its result
+def printBatchSummary(results):
+    print("%-45s %10s  %s" % ("board", "time (s)", "result"))
+    for result in results:
+        print("%-45s %10.2f  %s" % (result.vendor + "/" + result.board,
+                                    result.seconds,
+                                    result.error or result.output_dir))
+    sys.stdout.flush()
+
+
+# parseBoardArgument: argparse type for "vendor/board"
+# Returns: a (vendor, board) tuple
+def parseBoardArgument(argument):
+    vendor, separator, board = argument.partition("/")
+    if not separator or not vendor or not board:
+        raise argparse.ArgumentTypeError(
+            "expected vendor/board, got '%s'" % argument)
+    return (vendor, board)
+
+
+# parseArguments: Without any arguments the script runs interactively. Giving
+# boards runs the batch mode instead.
+def parseArguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Fetch the FreeRTOS source code with only the libraries "
+                    "you need. Run without arguments to choose the board and "
+                    "libraries interactively.")
+    parser.add_argument("--board", dest="boards", action="append",
+                        type=parseBoardArgument, default=[],
+                        metavar="VENDOR/BOARD",
+                        help="configure and fetch this board without any "
+                             "prompts (can be repeated)")
+    parser.add_argument("--all-boards", action="store_true",
+                        help="configure and fetch every board in vendors/")
+    parser.add_argument("--list-boards", action="store_true",
+                        help="list every board in vendors/ with its default "
+                             "libraries and estimated download size and exit")
+    parser.add_argument("--config", dest="config_files", action="append",
+                        default=[], metavar="FRAGMENT",
+                        help="configuration fragment or preset merged on top "
+                             "of the board defaults (can be repeated)")
+    parser.add_argument("--set", dest="overrides", action="append",
+                        type=librarySelector.parseOverride, default=[],
+                        metavar="SYMBOL=VALUE",
+                        help="set a symbol after the defaults and presets "
+                             "are merged (can be repeated)")
+    parser.add_argument("--gui", action="store_true",
+                        help="choose the libraries in guiconfig instead of "
+                             "the terminal")
+    parser.add_argument("--output-root", metavar="DIRECTORY",
+                        help="directory that gets one output directory per "
+                             "board")
+    parser.add_argument("--jobs", type=int,
+                        help="number of boards configured at the same time")
+    parser.add_argument("--ref", default=FREERTOS_BRANCH,
+                        help="branch, tag or commit to fetch")
+    parser.add_argument("--depth", type=int, default=FETCH_DEPTH,
+                        help="commits of history to fetch (0 for all)")
+    parser.add_argument("--artifact-cache", metavar="URL",
+                        default=os.environ.get(
+                            ARTIFACT_CACHE_ENVIRONMENT_VARIABLE),
+                        help="download finished checkouts from the artifact "
+                             "cache at URL and publish new ones to it "
+                             "(default: $%s)" %
+                             ARTIFACT_CACHE_ENVIRONMENT_VARIABLE)
+    parser.add_argument("--workspace", metavar="DIRECTORY",
+                        default=os.environ.get(
+                            WORKSPACE_ENVIRONMENT_VARIABLE),
+                        help="add new checkouts to the workspace in "
+                             "DIRECTORY, sharing one object store with its "
+                             "other checkouts (default: $%s)" %
+                             WORKSPACE_ENVIRONMENT_VARIABLE)
+    parser.add_argument("--trace", metavar="FILE",
+                        help="record the time, CPU, memory and download size "
+                             "of every phase, write them to FILE as a Chrome "
+                             "trace and print a summary")
+    parser.add_argument("--build-defaults-index", action="store_true",
+                        help="precompute the defaults of every board into "
+                             "%s and exit" %
+                             boardDefaults.BOARD_DEFAULTS_INDEX)
+    parser.add_argument("--build-library-manifest", metavar="CHECKOUT",
+                        help="measure the libraries in CHECKOUT (a checkout "
+                             "with every library enabled) into %s and exit" %
+                             libraryManifest.LIBRARY_MANIFEST)
+    arguments = parser.parse_args(argv)
+
+    if (arguments.boards or arguments.all_boards) and \
+            not arguments.output_root:
+        parser.error("--output-root is required with --board/--all-boards")
+    return arguments
+
+
+def main(argv=None):
+    arguments = parseArguments(argv)
+    mirror_cache_directory = os.environ.get(MIRROR_CACHE_ENVIRONMENT_VARIABLE)
+
+    if arguments.build_defaults_index:
+        board_count = boardDefaults.buildDefaultsIndex(getAllBoards())
+        print("Stored the defaults of %d boards in %s" %
+              (board_count, boardDefaults.BOARD_DEFAULTS_INDEX))
+        return 0
+
+    if arguments.list_boards:
+        printBoardCatalog()
+        return 0
+
+    if arguments.build_library_manifest:
+        repo_directory = arguments.build_library_manifest
+        manifest = libraryManifest.buildLibraryManifest(
+            repo_directory, CORE_PATHS, LIBRARY_PATHS,
+            list(getSubmodules(repo_directory)))
+        print("Stored the sizes of %d libraries in %s" %
+              (len(manifest["libraries"]), libraryManifest.LIBRARY_MANIFEST))
+        return 0
+
+    if arguments.boards or arguments.all_boards:
+        boards = getAllBoards() if arguments.all_boards else arguments.boards
+        results = runBatch(boards, arguments.output_root,
+                           arguments.config_files, arguments.jobs,
+                           arguments.ref, arguments.depth,
+                           mirror_cache_directory, arguments.trace is not None,
+                           arguments.overrides, arguments.artifact_cache,
+                           arguments.workspace)
+        if arguments.trace:
+            trace_events = [event for result in results
+                            for event in result.trace_events]
+            phaseTrace.writeTrace(arguments.trace, trace_events)
+            phaseTrace.printTraceSummary(trace_events)
+        return 1 if any(result.error for result in results) else 0
+
+    # The vendors and boards come from the vendors directory (see
+    # boardCatalog.py), so adding a board only takes adding its defaults
+    boards_dict = getBoardsDict()
 
     # Get the users vendor and board choice
     board_chosen = boardChoiceMenu(boards_dict)
     vendor = board_chosen[0]
     board = board_chosen[1]
-    setLibraryDefaults(vendor, board)
 
-    # Allow the users t0 enable/disable libraries
-    enableLibraries()
+    # The core of the repository is needed whatever the user chooses next, so
+    # start downloading it while they are busy choosing libraries. A
+    # workspace already has it.
+    tracer = phaseTrace.PhaseTracer(arguments.trace is not None)
+    speculative_fetch = SpeculativeFetch(arguments.ref, arguments.depth,
+                                         mirror_cache_directory, vendor)
+    if not arguments.workspace:
+        speculative_fetch.start()
+    try:
+        with tracer.phase("setLibraryDefaults"):
+            setLibraryDefaults(vendor, board, ".config",
+                               arguments.config_files)
 
-    # Get the users output directory for the FreeRTOS code to be cloned to
-    output_dir_name = getOutputDirectory()
+        # Allow the users t0 enable/disable libraries. Presets and overrides
+        # given on the command line replace the prompts.
+        with tracer.phase("enableLibraries"):
+            if arguments.gui:
+                enableLibraries()
+            else:
+                chooseLibraries(".config", arguments.overrides,
+                                interactive=not (arguments.config_files or
+                                                 arguments.overrides))
+        speculative_fetch.addLibraries(".config")
+        printDownloadEstimate(".config")
+
+        # Get the users output directory for the FreeRTOS code to be cloned to
+        output_dir_name = getOutputDirectory()
+
+        # A checkout of this board is only reconfigured and an interrupted
+        # clone is resumed, so the speculative fetch is stopped (without
+        # waiting for its download) right away
+        reconfigure = isCheckoutOfBoard(vendor, board, output_dir_name)
+        if reconfigure or hasInterruptedClone(output_dir_name):
+            speculative_fetch.cancel()
+    except BaseException:
+        speculative_fetch.cancel()
+        raise
 
-    # Clone the FreeRTOS repository into the users chosen output_dir
-    cloneFreeRTOSRepository(output_dir_name)
+    # Move the FreeRTOS repository into the users chosen output_dir. Only
+    # the libraries enabled in the .config are downloaded, from the artifact
+    # cache if it has them. If the output_dir already holds a checkout for
+    # this board only the libraries that changed are added or removed.
+    repo_directory = getRepositoryDirectory(output_dir_name)
+    with tracer.phase("cloneFreeRTOSRepository",
+                      repo_directory) as trace_args:
+        if reconfigure:
+            phase_stats = reconfigureFreeRTOSRepository(
+                output_dir_name, ".config", arguments.depth,
+                mirror_cache_directory, vendor)
+        else:
+            phase_stats = fetchFreeRTOSRepository(
+                vendor, board, output_dir_name, ".config", arguments.ref,
+                arguments.depth, mirror_cache_directory,
+                arguments.artifact_cache, speculative_fetch,
+                arguments.workspace)
+        trace_args.update(getPhaseStatsTraceArgs(phase_stats))
 
     # Update the FreeRTOS repo to reflect the board that the use chose
-    updateBoardChosen(vendor, board, output_dir_name)
+    with tracer.phase("updateBoardChosen", repo_directory):
+        updateBoardChosen(vendor, board, output_dir_name)
+
+    with tracer.phase("generateConfigHeaders", repo_directory):
+        generateConfigHeaders(output_dir_name)
+
+    with tracer.phase("callConfigurationScript", repo_directory):
+        callConfigurationScript(output_dir_name)
 
-    callConfigurationScript(output_dir_name)
+    if arguments.trace:
+        phaseTrace.writeTrace(arguments.trace, tracer.getTraceEvents())
+        phaseTrace.printTraceSummary(tracer.getTraceEvents())
+    return 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,57 @@
+import os
+import tempfile
+
+
+# Helpers shared by the caches and the configuration steps for writing files.
+# A file is written to a temporary file next to it and renamed into place, so
+# other processes (the workers of a batch, a build that is running) never
+# read half of it.
+
+
+# Directory of these scripts. Every file the scripts look up themselves
+# (KConfig, the indexes and the manifest) is found from here instead of from
+# the working directory, so they can be used from any directory and from
+# several threads at once.
+SOURCE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Directory of the on disk caches, each cache has a directory of its own in
+# it
+CACHE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache",
+                               "sourceFetcher")
+
+# The umask of the process, read once while importing is still single
+# threaded. mkstemp creates files only the owner can read, so the renamed
+# file gets the mode open() would have given it.
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+# writeFileAtomically: Writes "contents" (str or bytes) to a temporary file
+# and renames it over "filename"
+def writeFileAtomically(filename, contents):
+    file_descriptor, temporary_filename = tempfile.mkstemp(
+        dir=os.path.dirname(filename) or None)
+    mode = "wb" if isinstance(contents, bytes) else "w"
+    try:
+        with os.fdopen(file_descriptor, mode) as temporary_file:
+            temporary_file.write(contents)
+        os.chmod(temporary_filename, 0o666 & ~_umask)
+        os.replace(temporary_filename, filename)
+    except BaseException:
+        os.remove(temporary_filename)
+        raise
+
+
+# writeFileIfChanged: Writes "contents" (str) to "filename" unless the file
+# already holds exactly that, so its mtime only changes with its contents
+# and builds that depend on it aren't redone.
+# Returns: True if the file was written
+def writeFileIfChanged(filename, contents):
+    try:
+        with open(filename) as existing_file:
+            if existing_file.read() == contents:
+                return False
+    except IOError:
+        pass
+    writeFileAtomically(filename, contents)
+    return True
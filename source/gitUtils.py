@@ -0,0 +1,223 @@
+from contextlib import contextmanager
+import subprocess
+import os
+import re
+import signal
+import sys
+import threading
+import time
+
+
+# Helpers shared by fetchSource and the mirror cache for running git and
+# measuring the repositories that it creates.
+
+
+# Times a git command that talks to a remote is tried before giving up, and
+# the seconds waited before the second try (doubled before every further try)
+GIT_ATTEMPTS = 4
+RETRY_BACKOFF = 2.0
+
+# A full or abbreviated commit hash, which remotes don't list in ls-remote
+COMMIT_PATTERN = re.compile(r"^[0-9a-f]{7,40}$")
+
+# Per thread state of runGit. "quiet" is set by quietGit, "cancellation" by
+# cancellableGit.
+_git_state = threading.local()
+
+
+# GitError: Raised by runGit with "check" when git exits with an error
+class GitError(Exception):
+    def __init__(self, arguments, returncode):
+        super(GitError, self).__init__(
+            "git %s failed with exit code %d" % (" ".join(arguments),
+                                                 returncode))
+        self.arguments = arguments
+        self.returncode = returncode
+
+
+# GitCancelled: Raised by runGit and runGitWithRetry in a thread whose git
+# commands were cancelled (see GitCancellation)
+class GitCancelled(Exception):
+    def __init__(self, arguments):
+        super(GitCancelled, self).__init__(
+            "git %s was cancelled" % " ".join(arguments))
+        self.arguments = arguments
+
+
+# GitCancellation: Lets one thread stop the git commands of another one.
+# The commands run in their own process group so that cancel kills git
+# together with the helpers it started (remote-https, index-pack) instead of
+# waiting for a download to finish. Once cancelled no further command starts.
+class GitCancellation(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._processes = set()
+
+    # isCancelled: Returns: whether cancel was called
+    def isCancelled(self):
+        return self._cancelled.is_set()
+
+    # cancel: Kills the running git commands and refuses to start new ones
+    def cancel(self):
+        with self._lock:
+            self._cancelled.set()
+            for process in self._processes:
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except (AttributeError, OSError):
+                    process.kill()
+
+    # wait: Sleeps for "delay" seconds unless cancel is called first.
+    # Raises: GitCancelled (for "arguments") if it is
+    def wait(self, delay, arguments):
+        if self._cancelled.wait(delay):
+            raise GitCancelled(arguments)
+
+    # run: Like subprocess.run, keeping the process so cancel can kill it.
+    # Raises: GitCancelled if cancel is called before or while it runs
+    def run(self, arguments, input=None, **kwargs):
+        with self._lock:
+            if self._cancelled.is_set():
+                raise GitCancelled(arguments[1:])
+            process = subprocess.Popen(
+                arguments, start_new_session=True,
+                stdin=subprocess.PIPE if input is not None else None,
+                **kwargs)
+            self._processes.add(process)
+        try:
+            stdout, stderr = process.communicate(input)
+        finally:
+            with self._lock:
+                self._processes.discard(process)
+        if self._cancelled.is_set():
+            raise GitCancelled(arguments[1:])
+        return subprocess.CompletedProcess(process.args, process.returncode,
+                                           stdout, stderr)
+
+
+# cancellableGit: Context manager that runs every git command of the
+# current thread through "cancellation"
+@contextmanager
+def cancellableGit(cancellation):
+    _git_state.cancellation = cancellation
+    try:
+        yield
+    finally:
+        _git_state.cancellation = None
+
+
+# quietGit: Context manager that hides the output of every git command run
+# by the current thread, for fetches that run in the background while the
+# user is busy with something else.
+@contextmanager
+def quietGit():
+    _git_state.quiet = True
+    try:
+        yield
+    finally:
+        _git_state.quiet = False
+
+
+# runGit: Small wrapper so that every git invocation goes through one place.
+# "input" is written to the standard input of git. With "check" a failing
+# command raises a GitError.
+# Returns: the subprocess.CompletedProcess of the git command
+# Raises: GitCancelled if the command was cancelled (see cancellableGit)
+def runGit(arguments, cwd, capture_output=False, input=None, check=False):
+    quiet = getattr(_git_state, "quiet", False)
+    cancellation = getattr(_git_state, "cancellation", None)
+    if capture_output:
+        stdout = subprocess.PIPE
+    else:
+        stdout = subprocess.DEVNULL if quiet else None
+    run = cancellation.run if cancellation is not None else subprocess.run
+    result = run(["git"] + arguments, cwd=cwd, stdout=stdout,
+                 stderr=subprocess.DEVNULL if quiet else None,
+                 input=input, universal_newlines=True)
+    if check and result.returncode != 0:
+        raise GitError(arguments, result.returncode)
+    return result
+
+
+# runGitWithRetry: Runs a git command that talks to a remote (and can fail
+# because of the network) up to GIT_ATTEMPTS times, waiting longer after
+# every failure. git throws away the pack of a fetch that breaks off, so
+# every try downloads everything again; only the steps that completed
+# before (see fetchSource.FetchState) and the submodules that were cloned
+# already aren't repeated. "should_retry" is called with the
+# GitError of a failed try; if it returns False the failure can't go away by
+# itself (a ref that doesn't exist) and it is raised without waiting.
+# Returns: the subprocess.CompletedProcess of the successful try
+# Raises: GitError if the last try fails as well
+def runGitWithRetry(arguments, cwd, input=None, should_retry=None):
+    for attempt in range(1, GIT_ATTEMPTS + 1):
+        try:
+            return runGit(arguments, cwd, input=input, check=True)
+        except GitError as error:
+            if attempt == GIT_ATTEMPTS or \
+                    should_retry is not None and not should_retry(error):
+                raise
+            delay = RETRY_BACKOFF * 2 ** (attempt - 1)
+            if not getattr(_git_state, "quiet", False):
+                print("%s, retrying in %.0f seconds (%d of %d)" %
+                      (error, delay, attempt + 1, GIT_ATTEMPTS))
+                sys.stdout.flush()
+            cancellation = getattr(_git_state, "cancellation", None)
+            if cancellation is not None:
+                cancellation.wait(delay, arguments)
+            else:
+                time.sleep(delay)
+
+
+# isMissingRef: Asks "remote" (a url, a path or a remote of the repository in
+# "cwd") for "ref" after fetching it failed. Commits are never advertised, so
+# a commit hash never counts as missing.
+# Returns: True if the remote answered and has no branch or tag "ref", so
+# fetching it again can't succeed
+def isMissingRef(remote, ref, cwd=None):
+    if COMMIT_PATTERN.match(ref):
+        return False
+    result = runGit(["ls-remote", remote, ref], cwd=cwd, capture_output=True)
+    return result.returncode == 0 and not result.stdout.strip()
+
+
+# getDepthArguments: Returns: the arguments that limit a fetch or clone to
+# "depth" commits of history (none for 0, which fetches the full history)
+def getDepthArguments(depth):
+    return ["--depth", str(depth)] if depth else []
+
+
+# getGitDirectory: The git directory of a repository is its .git directory,
+# except for worktrees whose .git is a file pointing at their private git
+# directory inside of the repository they were added to.
+# Returns: the path of the git directory of "repo_directory"
+def getGitDirectory(repo_directory):
+    git_path = os.path.join(repo_directory, ".git")
+    if os.path.isfile(git_path):
+        with open(git_path) as git_file:
+            contents = git_file.read().strip()
+        if contents.startswith("gitdir: "):
+            return os.path.normpath(os.path.join(repo_directory,
+                                                 contents[len("gitdir: "):]))
+    return git_path
+
+
+# countFiles: Returns: the number of files below "directory" and their total
+# size in bytes (both 0 if the directory does not exist yet)
+def countFiles(directory):
+    file_count = 0
+    total_size = 0
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            filepath = os.path.join(dirpath, filename)
+            if not os.path.islink(filepath):
+                file_count += 1
+                total_size += os.path.getsize(filepath)
+    return file_count, total_size
+
+
+# getDirectorySize: Adds up the size of every file below "directory".
+# Returns: the size in bytes (0 if the directory does not exist yet)
+def getDirectorySize(directory):
+    return countFiles(directory)[1]
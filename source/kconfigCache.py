@@ -0,0 +1,356 @@
+import glob
+import hashlib
+import json
+import os
+import pickle
+import re
+import sys
+import threading
+
+import kconfiglib
+
+from fileUtils import CACHE_DIRECTORY, writeFileAtomically
+import merge_config
+
+
+# Parsing a Kconfig tree is the expensive part of a merge. This module keeps
+# the Kconfig objects that have been parsed so that the defaults merge and the
+# board merge (and any later merge) can share one parsed tree whenever the
+# Kconfig files they use are the same. Parsed trees are also pickled to disk,
+# keyed by the hash of every file of the tree, so that later runs skip parsing
+# as long as none of the files changed. The results of merges are memoized
+# as well, keyed by the tree and the configuration fragments, so repeating a
+# merge whose inputs haven't changed doesn't have to touch the tree at all.
+
+
+# Directory of the on disk cache. None disables the on disk cache.
+KCONFIG_CACHE_DIRECTORY = os.path.join(CACHE_DIRECTORY, "kconfig")
+
+# Pickled trees can only be loaded by the kconfiglib and python versions that
+# pickled them, so they are part of every cache filename
+CACHE_TAG = "kconfiglib%s-py%d.%d" % (
+    ".".join(str(part) for part in kconfiglib.VERSION),
+    sys.version_info[0], sys.version_info[1])
+
+# Menu nodes are linked lists, so pickling a big tree recurses deeply
+PICKLE_RECURSION_LIMIT = 100000
+
+# Statements that source files, whose pattern may be a glob. The "r"
+# variants are relative to the directory of the file they are in.
+SOURCE_STATEMENT = re.compile(
+    r'^\s*(source|rsource|osource|orsource|gsource|grsource)\s+"([^"]*)"',
+    re.MULTILINE)
+
+# Parsed Kconfig objects keyed by the hash of the tree they were parsed from
+_parsed_kconfigs = {}
+_parsed_kconfigs_lock = threading.Lock()
+
+# Merge results (dicts with "config" and "warnings") keyed by getMergeKey
+_merge_results = {}
+
+
+# getTreeHash: Hashes the name and contents of every file of a Kconfig tree.
+# "kconfig_filenames" are relative to "srctree" (as in
+# Kconfig.kconfig_filenames).
+# Returns: the hex digest, or None if one of the files no longer exists
+def getTreeHash(kconfig_filenames, srctree=None):
+    tree_hash = hashlib.sha256()
+    for filename in kconfig_filenames:
+        try:
+            with open(os.path.join(srctree or "", filename), "rb") as \
+                    kconfig_file:
+                contents = kconfig_file.read()
+        except IOError:
+            return None
+        tree_hash.update(filename.encode("utf-8") + b"\0")
+        tree_hash.update(hashlib.sha256(contents).digest())
+    return tree_hash.hexdigest()
+
+
+# getGlobDirectories: A glob in a source statement sources a different set
+# of files as soon as a matching file is added to or removed from one of
+# the directories the glob searches, without any Kconfig file changing.
+# Returns: the sorted directories (relative to "srctree") searched by the
+# globs of the source statements of "kconfig_filenames"
+def getGlobDirectories(kconfig_filenames, srctree=None):
+    directories = set()
+    for filename in kconfig_filenames:
+        try:
+            with open(os.path.join(srctree or "", filename)) as kconfig_file:
+                contents = kconfig_file.read()
+        except IOError:
+            continue
+        for keyword, pattern in SOURCE_STATEMENT.findall(contents):
+            # Patterns with environment variables are never globs here
+            if not glob.has_magic(pattern) or "$" in pattern:
+                continue
+            if "r" in keyword:
+                pattern = os.path.join(os.path.dirname(filename), pattern)
+            parts = pattern.split("/")
+            for end in range(1, len(parts)):
+                prefix = "/".join(parts[:end]) or "/"
+                if not glob.has_magic(prefix):
+                    directories.add(prefix)
+                    continue
+                for match in glob.glob(os.path.join(srctree or "", prefix)):
+                    if os.path.isdir(match):
+                        directories.add(os.path.relpath(
+                            match, srctree or os.curdir))
+    return sorted(directories)
+
+
+# getModificationTimes: Returns: a dict mapping every file or directory of
+# "paths" (relative to "srctree") to its mtime in nanoseconds (None if it
+# doesn't exist)
+def getModificationTimes(paths, srctree=None):
+    modification_times = {}
+    for path in paths:
+        try:
+            modification_times[path] = os.stat(
+                os.path.join(srctree or "", path)).st_mtime_ns
+        except OSError:
+            modification_times[path] = None
+    return modification_times
+
+
+# getIndexFilename: The on disk cache has one index file per top level
+# Kconfig file (name and contents). It lists the files that the tree sourced
+# the last time it was parsed and the mtimes of the directories searched by
+# its globs (see getGlobDirectories). Any other change to which files are
+# sourced has to come from a change in one of those files, so hashing them
+# is enough to find out whether the pickled tree is still valid.
+# Returns: the path of the index file, or None if the top level file is
+# missing
+def getIndexFilename(cache_directory, kconfig_filename, srctree):
+    top_hash = getTreeHash([kconfig_filename], srctree)
+    if top_hash is None:
+        return None
+    return os.path.join(cache_directory, "%s-%s.json" % (top_hash, CACHE_TAG))
+
+
+# getPickleFilename: Returns: the path of the pickled tree with "tree_hash"
+def getPickleFilename(cache_directory, tree_hash):
+    return os.path.join(cache_directory,
+                        "%s-%s.pickle" % (tree_hash, CACHE_TAG))
+
+
+# readIndex: Reads the index of the top level file "kconfig_filename".
+# Returns: the files the tree sourced, or None if there is no index or a
+# directory searched by a glob of the tree changed since it was written
+def readIndex(cache_directory, kconfig_filename, srctree):
+    index_filename = getIndexFilename(cache_directory, kconfig_filename,
+                                      srctree)
+    try:
+        with open(index_filename) as index_file:
+            index = json.load(index_file)
+        kconfig_filenames = index["kconfig_filenames"]
+        glob_directories = index["glob_directories"]
+    except (IOError, TypeError, ValueError, KeyError):
+        return None
+    if getModificationTimes(glob_directories, srctree) != glob_directories:
+        return None
+    return kconfig_filenames
+
+
+# loadCachedKconfig: Looks for a pickled tree whose files all still have the
+# same contents under "srctree".
+# Returns: the unpickled Kconfig object and its tree hash, or (None, None)
+def loadCachedKconfig(cache_directory, kconfig_filename, srctree):
+    kconfig_filenames = readIndex(cache_directory, kconfig_filename, srctree)
+    if kconfig_filenames is None:
+        return None, None
+
+    tree_hash = getTreeHash(kconfig_filenames, srctree)
+    if tree_hash is None:
+        return None, None
+
+    old_recursion_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(old_recursion_limit, PICKLE_RECURSION_LIMIT))
+    try:
+        with open(getPickleFilename(cache_directory, tree_hash), "rb") as \
+                pickle_file:
+            kconf = pickle.load(pickle_file)
+    except (IOError, EOFError, AttributeError, ImportError,
+            pickle.UnpicklingError):
+        return None, None
+    finally:
+        sys.setrecursionlimit(old_recursion_limit)
+    # Trees pickled before parseKconfig returned MergeKconfig objects
+    if not isinstance(kconf, merge_config.MergeKconfig):
+        return None, None
+
+    # The pickled paths are those of the process that parsed the tree
+    kconf.srctree = srctree or ""
+    kconf._srctree_prefix = os.path.realpath(kconf.srctree) + os.sep
+    return kconf, tree_hash
+
+
+# storeCachedKconfig: Pickles a freshly parsed tree and points the index of
+# its top level file at it.
+def storeCachedKconfig(cache_directory, kconf, tree_hash, srctree):
+    os.makedirs(cache_directory, exist_ok=True)
+
+    # The reader of the last parsed file can't be pickled and is never used
+    # again after parsing
+    kconf._readline = None
+    old_recursion_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(old_recursion_limit, PICKLE_RECURSION_LIMIT))
+    try:
+        pickled_kconfig = pickle.dumps(kconf, pickle.HIGHEST_PROTOCOL)
+    finally:
+        sys.setrecursionlimit(old_recursion_limit)
+
+    writeFileAtomically(getPickleFilename(cache_directory, tree_hash),
+                        pickled_kconfig)
+    index = {"kconfig_filenames": kconf.kconfig_filenames,
+             "glob_directories": getModificationTimes(
+                 getGlobDirectories(kconf.kconfig_filenames, srctree),
+                 srctree)}
+    writeFileAtomically(getIndexFilename(cache_directory,
+                                         kconf.kconfig_filenames[0], srctree),
+                        json.dumps(index).encode("utf-8"))
+
+
+# findParsedKconfig: Looks for a tree parsed earlier in this process whose
+# files all still have the same contents under "srctree". The caller holds
+# _parsed_kconfigs_lock.
+# Returns: the Kconfig object and its tree hash, or (None, None)
+def findParsedKconfig(kconfig_filename, srctree):
+    for kconf in _parsed_kconfigs.values():
+        if kconf.kconfig_filenames[0] != kconfig_filename:
+            continue
+        tree_hash = getTreeHash(kconf.kconfig_filenames, srctree)
+        if _parsed_kconfigs.get(tree_hash) is kconf:
+            return kconf, tree_hash
+    return None, None
+
+
+# getKconfig: Returns a parsed Kconfig object for the tree whose top level
+# file is "kconfig_filename" (relative to "srctree"). A tree that was parsed
+# before (in this process or, through the on disk cache, in an earlier one)
+# is reused if every one of its files has the same name and contents under
+# "srctree", otherwise the tree is parsed.
+def getKconfig(kconfig_filename, srctree=None):
+    with _parsed_kconfigs_lock:
+        kconf, tree_hash = findParsedKconfig(kconfig_filename, srctree)
+        if kconf is not None:
+            return kconf
+
+        cache_directory = KCONFIG_CACHE_DIRECTORY
+        if cache_directory:
+            kconf, tree_hash = loadCachedKconfig(cache_directory,
+                                                 kconfig_filename, srctree)
+            if kconf is not None:
+                _parsed_kconfigs[tree_hash] = kconf
+                return kconf
+
+        kconf = merge_config.parseKconfig(kconfig_filename, srctree)
+        tree_hash = getTreeHash(kconf.kconfig_filenames, srctree)
+        _parsed_kconfigs[tree_hash] = kconf
+        if cache_directory and tree_hash:
+            storeCachedKconfig(cache_directory, kconf, tree_hash, srctree)
+        return kconf
+
+
+# getCurrentTreeHash: Finds the hash of the tree whose top level file is
+# "kconfig_filename" without parsing it, from the trees parsed in this
+# process or from the index of the on disk cache.
+# Returns: the hex digest, or None if the tree is unknown
+def getCurrentTreeHash(kconfig_filename, srctree=None):
+    with _parsed_kconfigs_lock:
+        kconf, tree_hash = findParsedKconfig(kconfig_filename, srctree)
+    if tree_hash is not None or not KCONFIG_CACHE_DIRECTORY:
+        return tree_hash
+
+    kconfig_filenames = readIndex(KCONFIG_CACHE_DIRECTORY, kconfig_filename,
+                                  srctree)
+    if kconfig_filenames is None:
+        return None
+    return getTreeHash(kconfig_filenames, srctree)
+
+
+# getMergeKey: Hashes the inputs of a merge: the tree and the name and
+# contents of every configuration fragment, in the order they are merged.
+# Returns: the hex digest, or None if one of the fragments is missing
+def getMergeKey(tree_hash, config_files):
+    merge_key = hashlib.sha256(tree_hash.encode("utf-8"))
+    for config_file in config_files:
+        try:
+            with open(config_file, "rb") as fragment_file:
+                contents = fragment_file.read()
+        except IOError:
+            return None
+        merge_key.update(config_file.encode("utf-8") + b"\0")
+        merge_key.update(hashlib.sha256(contents).digest())
+    return merge_key.hexdigest()
+
+
+# getMergeFilename: Returns: the path of the memoized merge with "merge_key"
+def getMergeFilename(cache_directory, merge_key):
+    return os.path.join(cache_directory,
+                        "merge-%s-%s.json" % (merge_key, CACHE_TAG))
+
+
+# findMergeResult: Returns: the memoized result of the merge with
+# "merge_key" (a dict with "config" and "warnings"), or None
+def findMergeResult(merge_key):
+    with _parsed_kconfigs_lock:
+        merge_result = _merge_results.get(merge_key)
+    if merge_result is not None or not KCONFIG_CACHE_DIRECTORY:
+        return merge_result
+
+    try:
+        with open(getMergeFilename(KCONFIG_CACHE_DIRECTORY, merge_key)) as \
+                merge_file:
+            merge_result = json.load(merge_file)
+    except (IOError, ValueError):
+        return None
+    with _parsed_kconfigs_lock:
+        _merge_results[merge_key] = merge_result
+    return merge_result
+
+
+# storeMergeResult: Memoizes the result of the merge with "merge_key" in
+# memory and in the on disk cache
+def storeMergeResult(merge_key, result):
+    merge_result = {"config": result.config,
+                    "warnings": list(result.warnings)}
+    with _parsed_kconfigs_lock:
+        _merge_results[merge_key] = merge_result
+    if KCONFIG_CACHE_DIRECTORY:
+        os.makedirs(KCONFIG_CACHE_DIRECTORY, exist_ok=True)
+        writeFileAtomically(getMergeFilename(KCONFIG_CACHE_DIRECTORY,
+                                             merge_key),
+                            json.dumps(merge_result).encode("utf-8"))
+
+
+# mergeConfig: Like merge_config.mergeConfig, for the tree whose top level
+# file is "kconfig_filename" (relative to "srctree"). A merge whose tree and
+# fragments are unchanged since it last ran returns the memoized result
+# without getting the Kconfig object. Either way "merged_config" is only
+# written if its contents change.
+# Returns: a MergeResult
+def mergeConfig(kconfig_filename, srctree, merged_config, config_files):
+    tree_hash = getCurrentTreeHash(kconfig_filename, srctree)
+    merge_key = tree_hash and getMergeKey(tree_hash, config_files)
+    merge_result = merge_key and findMergeResult(merge_key)
+    if merge_result:
+        return merge_config.writeMergedConfig(merge_result["config"],
+                                              merge_result["warnings"],
+                                              merged_config)
+
+    kconf = getKconfig(kconfig_filename, srctree)
+    result = merge_config.mergeConfig(kconf, merged_config, config_files)
+    tree_hash = getTreeHash(kconf.kconfig_filenames, srctree)
+    merge_key = tree_hash and getMergeKey(tree_hash, config_files)
+    if merge_key:
+        storeMergeResult(merge_key, result)
+    return result
+
+
+# clearKconfigCache: Forgets every parsed Kconfig object and merge result
+# held in memory. The on disk cache is left alone.
+def clearKconfigCache():
+    with _parsed_kconfigs_lock:
+        _parsed_kconfigs.clear()
+        _merge_results.clear()
@@ -0,0 +1,191 @@
+from collections import OrderedDict
+import json
+import os
+
+import kconfiglib
+
+from fileUtils import SOURCE_DIRECTORY
+from gitUtils import runGit
+
+
+# The manifest records, for the core tree and for every library symbol of
+# KConfig, the directories of the FreeRTOS repository it needs, the
+# submodules inside of them and how many bytes they hold. fetchSource uses it
+# to find the smallest set of directories a configuration needs (following
+# "depends on" and "select" between library symbols, plus any "requires"
+# listed in the manifest) and to estimate the download before it starts.
+# The directories are only listed in fetchSource (CORE_PATHS and
+# LIBRARY_PATHS). The manifest file holds what was measured in a checkout
+# (bytes and submodules) and the "requires", and getLibraryManifest puts the
+# two together.
+
+
+# Location of the manifest, relative to this scripts directory like KConfig
+LIBRARY_MANIFEST = "libraryManifest.json"
+
+
+# getManifestFilename: Returns: the path of the manifest to use
+def getManifestFilename(manifest_filename=None):
+    return manifest_filename or os.path.join(SOURCE_DIRECTORY,
+                                             LIBRARY_MANIFEST)
+
+
+# getTreeSize: Adds up the size of the files of the checked out commit of
+# "repo_directory" below "path" (the whole tree without a path). Submodules
+# are not included.
+# Returns: the size in bytes
+def getTreeSize(repo_directory, path=None):
+    arguments = ["ls-tree", "-r", "-l", "--full-tree", "HEAD"]
+    if path:
+        arguments += ["--", path]
+    result = runGit(arguments, cwd=repo_directory, capture_output=True)
+    total_size = 0
+    for line in result.stdout.splitlines():
+        size = line.split("\t", 1)[0].split()[-1]
+        if size.isdigit():
+            total_size += int(size)
+    return total_size
+
+
+# getSubmoduleSize: Returns: the size of the checked out submodule at "path"
+# of "repo_directory", or None if it isn't checked out
+def getSubmoduleSize(repo_directory, path):
+    submodule_directory = os.path.join(repo_directory, path)
+    if not os.path.exists(os.path.join(submodule_directory, ".git")):
+        return None
+    return getTreeSize(submodule_directory)
+
+
+# measureEntry: Returns: what the manifest file stores about a set of
+# directories: their size and the sizes of the submodules inside of them
+def measureEntry(repo_directory, paths, submodule_paths, requires=()):
+    submodules = OrderedDict()
+    for submodule_path in submodule_paths:
+        if any(submodule_path == path or submodule_path.startswith(path + "/")
+               for path in paths):
+            submodules[submodule_path] = getSubmoduleSize(repo_directory,
+                                                          submodule_path)
+    return OrderedDict([("bytes", sum(getTreeSize(repo_directory, path)
+                                      for path in paths)),
+                        ("submodules", submodules),
+                        ("requires", list(requires))])
+
+
+# buildLibraryManifest: Measures the core tree ("core_paths") and the
+# directories of every library ("library_paths" maps a symbol to its
+# directories) in a checkout that has every library and submodule checked
+# out, and writes the measurements to the manifest file. "submodule_paths"
+# are the paths of the submodules of the repository. The "requires" of an
+# existing manifest file are kept.
+# Returns: the manifest (see getLibraryManifest)
+def buildLibraryManifest(repo_directory, core_paths, library_paths,
+                         submodule_paths, manifest_filename=None):
+    manifest_filename = getManifestFilename(manifest_filename)
+    old_measurements = loadLibraryManifest(manifest_filename) or {}
+    old_libraries = old_measurements.get("libraries", {})
+
+    commit = runGit(["rev-parse", "HEAD"], cwd=repo_directory,
+                    capture_output=True).stdout.strip()
+    measurements = OrderedDict(
+        [("commit", commit),
+         ("core", measureEntry(repo_directory, core_paths,
+                               submodule_paths)),
+         ("libraries", OrderedDict())])
+    for library, paths in library_paths.items():
+        measurements["libraries"][library] = measureEntry(
+            repo_directory, paths, submodule_paths,
+            old_libraries.get(library, {}).get("requires", []))
+
+    with open(manifest_filename, "w") as manifest_file:
+        json.dump(measurements, manifest_file, indent=1)
+        manifest_file.write("\n")
+    return getLibraryManifest(core_paths, library_paths, manifest_filename)
+
+
+# loadLibraryManifest: Returns: the contents of the manifest file (the
+# measurements and "requires"), or None if there is none
+def loadLibraryManifest(manifest_filename=None):
+    try:
+        with open(getManifestFilename(manifest_filename)) as manifest_file:
+            return json.load(manifest_file, object_pairs_hook=OrderedDict)
+    except (IOError, ValueError):
+        return None
+
+
+# getLibraryManifest: Puts the directories of the core tree ("core_paths")
+# and of every library ("library_paths") together with what the manifest
+# file knows about them. "bytes" is None for anything that wasn't measured.
+# Returns: the manifest, a dict with the "commit" that was measured, the
+# "core" entry and an OrderedDict of the "libraries" entries (each with
+# "paths", "bytes", "submodules" and "requires")
+def getLibraryManifest(core_paths, library_paths, manifest_filename=None):
+    measurements = loadLibraryManifest(manifest_filename) or {}
+    measured_libraries = measurements.get("libraries", {})
+
+    def getEntry(paths, measured):
+        return OrderedDict([("paths", list(paths)),
+                            ("bytes", measured.get("bytes")),
+                            ("submodules", measured.get("submodules", {})),
+                            ("requires", measured.get("requires", []))])
+    return OrderedDict(
+        [("commit", measurements.get("commit")),
+         ("core", getEntry(core_paths, measurements.get("core", {}))),
+         ("libraries", OrderedDict(
+             (library, getEntry(paths, measured_libraries.get(library, {})))
+             for library, paths in library_paths.items()))])
+
+
+# getLibraryDependencies: Collects the library symbols that "library" needs
+# according to KConfig: the ones it depends on and the ones it selects.
+# Returns: a set of symbol names
+def getLibraryDependencies(kconf, library, libraries):
+    sym = kconf.syms.get(library)
+    if sym is None:
+        return set()
+    items = set(kconfiglib.expr_items(sym.direct_dep))
+    for selected, condition in sym.selects:
+        items.add(selected)
+    return set(item.name for item in items
+               if getattr(item, "name", None) in libraries)
+
+
+# getLibraryClosure: Extends the enabled libraries with every library they
+# need, directly or through other libraries: the ones they depend on or
+# select in "kconf" (which may be None) and the ones the manifest lists
+# under "requires".
+# Returns: a set of symbol names
+def getLibraryClosure(enabled_libraries, kconf, manifest):
+    libraries = manifest["libraries"]
+    closure = set()
+    pending = [library for library in enabled_libraries
+               if library in libraries]
+    while pending:
+        library = pending.pop()
+        if library in closure:
+            continue
+        closure.add(library)
+        needed = set(libraries[library].get("requires", []))
+        if kconf is not None:
+            needed |= getLibraryDependencies(kconf, library, libraries)
+        pending.extend(needed - closure)
+    return closure
+
+
+# estimateDownloadSize: Adds up the size of the core tree and of the
+# directories and submodules of "libraries", counting submodules that are
+# shared by several entries once.
+# Returns: the size in bytes, or None if the manifest has no size for one of
+# them
+def estimateDownloadSize(libraries, manifest):
+    entries = [manifest["core"]] + [manifest["libraries"][library]
+                                    for library in sorted(libraries)]
+    total_size = 0
+    submodule_sizes = {}
+    for entry in entries:
+        if entry.get("bytes") is None:
+            return None
+        total_size += entry["bytes"]
+        submodule_sizes.update(entry.get("submodules", {}))
+    if None in submodule_sizes.values():
+        return None
+    return total_size + sum(submodule_sizes.values())
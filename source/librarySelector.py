@@ -0,0 +1,138 @@
+import argparse
+from collections import namedtuple
+
+from kconfiglib import BOOL, TRISTATE
+
+import merge_config
+
+
+# A terminal replacement for guiconfig. It works on the Kconfig object that
+# the defaults merge already parsed (see kconfigCache.py), so it starts
+# without parsing anything and without Tk or a display. Symbols can be
+# toggled by number or set with "SYMBOL=VALUE", and the same assignments can
+# be given up front to run it without any prompts. The result is written
+# with kconfiglib's write_config(), which is what guiconfig saves with, so
+# the .config is byte for byte the one guiconfig would write. The Kconfig
+# object is shared with merges in other threads, so it is only used (under
+# its merge lock) to load the .config with the choices made so far and to
+# save it, never while waiting for the user.
+
+
+# What the menu shows of a symbol the user can change
+SelectableSymbol = namedtuple("SelectableSymbol",
+                              ["name", "prompt", "enabled"])
+
+
+# parseOverride: argparse type for "SYMBOL=VALUE"
+# Returns: a (symbol name, value) tuple
+def parseOverride(argument):
+    name, separator, value = argument.partition("=")
+    if not separator or not name:
+        raise argparse.ArgumentTypeError(
+            "expected SYMBOL=VALUE, got '%s'" % argument)
+    if name.startswith("CONFIG_"):
+        name = name[len("CONFIG_"):]
+    return (name, value)
+
+
+# applyOverride: Assigns "value" to the symbol called "name".
+# Returns: a warning if the symbol ended up with another value (because of
+# its dependencies), otherwise None
+def applyOverride(kconf, name, value):
+    sym = kconf.syms.get(name)
+    if sym is None or not sym.nodes:
+        raise ValueError("unknown symbol %s" % name)
+    if not sym.set_value(value):
+        raise ValueError("invalid value '%s' for %s" % (value, name))
+    if sym.str_value != value:
+        return ("warning: %s was assigned the value '%s' but got the value "
+                "'%s' -- check dependencies" % (name, value, sym.str_value))
+    return None
+
+
+# loadAssignments: Loads "config_filename" into "kconf" and assigns the
+# (symbol name, value) tuples of "assignments" in order. The caller holds
+# the merge lock of "kconf".
+# Returns: the warnings of the assignments
+def loadAssignments(kconf, config_filename, assignments):
+    kconf.load_config(config_filename)
+    warnings = []
+    for name, value in assignments:
+        warning = applyOverride(kconf, name, value)
+        if warning:
+            warnings.append(warning)
+    return warnings
+
+
+# getSelectableSymbols: Returns: a SelectableSymbol for every bool and
+# tristate symbol that the user can currently change, in menu order
+def getSelectableSymbols(kconf):
+    return [SelectableSymbol(
+                sym.name,
+                next(node.prompt[0] for node in sym.nodes if node.prompt),
+                bool(sym.tri_value))
+            for sym in kconf.unique_defined_syms
+            if sym.type in (BOOL, TRISTATE) and sym.visibility and
+            any(node.prompt for node in sym.nodes)]
+
+
+# printSelection: Prints the selectable symbols with their prompt and value
+def printSelection(selectable_symbols):
+    print("\n-----CHOOSE YOUR LIBRARIES-----\n")
+    for idx, sym in enumerate(selectable_symbols, start=1):
+        print("%s) [%s] %s (%s)" % (idx, "x" if sym.enabled else " ",
+                                    sym.prompt, sym.name))
+    print("\nEnter a number to toggle it, SYMBOL=VALUE to set any symbol, "
+          "'s' to save or 'q' to quit without saving")
+
+
+# selectLibraries: Loads "config_filename" into "kconf", applies
+# "overrides" (a list of (symbol name, value) tuples) and, if "interactive",
+# lets the user change symbols in the terminal. The result is saved to
+# "config_filename" unless the user quits.
+# Returns: the message of write_config(), or None if nothing was saved
+def selectLibraries(kconf, config_filename, overrides=(), interactive=True):
+    assignments = list(overrides)
+    merge_lock = merge_config.getMergeLock(kconf)
+    with merge_lock:
+        warnings = loadAssignments(kconf, config_filename, assignments)
+        selectable_symbols = getSelectableSymbols(kconf)
+    for warning in warnings:
+        print(warning)
+
+    while interactive:
+        printSelection(selectable_symbols)
+        user_input = input("\nYour choice: ").strip()
+        if user_input == "s":
+            break
+        if user_input == "q":
+            return None
+
+        if user_input.isdigit() and \
+                1 <= int(user_input) <= len(selectable_symbols):
+            sym = selectable_symbols[int(user_input) - 1]
+            assignment = (sym.name, "n" if sym.enabled else "y")
+        elif "=" in user_input:
+            try:
+                assignment = parseOverride(user_input)
+            except argparse.ArgumentTypeError as exception:
+                print(exception)
+                continue
+        else:
+            print("Please enter a valid number, SYMBOL=VALUE, 's' or 'q'")
+            continue
+
+        with merge_lock:
+            loadAssignments(kconf, config_filename, assignments)
+            try:
+                warning = applyOverride(kconf, *assignment)
+                assignments.append(assignment)
+            except ValueError as exception:
+                warning = str(exception)
+            selectable_symbols = getSelectableSymbols(kconf)
+        if warning:
+            print(warning)
+
+    with merge_lock:
+        loadAssignments(kconf, config_filename, assignments)
+        return kconf.write_config(config_filename)
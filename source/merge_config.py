@@ -1,50 +1,226 @@
 from __future__ import print_function
+from collections import namedtuple
 import sys
 import os
+import shutil
+import threading
+import weakref
 
 from kconfiglib import Kconfig, BOOL, TRISTATE, TRI_TO_STR
 
+from fileUtils import writeFileAtomically
 
-if len(sys.argv) < 4:
-    sys.exit("usage: merge_config.py Kconfig merged_config config1 [config2 ...]")
 
-kconf = Kconfig(sys.argv[1], suppress_traceback=True)
+# Result of mergeConfig:
+#   config: the contents of the merged configuration file
+#   messages: the messages returned by load_config() and write_config()
+#   warnings: kconfiglib warnings plus a warning for every symbol whose
+#             actual value doesn't match the value it was assigned
+#   changed_symbols: names of the symbols whose value differs from the one in
+#                    the merged configuration file before the merge
+MergeResult = namedtuple("MergeResult", ["config", "messages", "warnings",
+                                         "changed_symbols"])
 
-# Enable warnings for assignments to undefined symbols
-kconf.warn_assign_undef = True
+# kconfiglib reads $srctree from the environment when a Kconfig object is
+# created, so parsing two trees at once from different threads must not
+# interleave.
+_srctree_lock = threading.Lock()
 
-# (This script uses alldefconfig as the base. Other starting states could be
-# set up here as well. The approach in examples/allnoconfig_simpler.py could
-# provide an allnoconfig starting state for example.)
+# A Kconfig object holds the values of one merge at a time, so merges that
+# share a Kconfig object (see kconfigCache.py) take turns. The locks are
+# dropped together with the Kconfig object they belong to.
+_merge_locks = weakref.WeakKeyDictionary()
+_merge_locks_lock = threading.Lock()
 
-# Disable warnings generated for multiple assignments to the same symbol within
-# a (set of) configuration files. Assigning a symbol multiple times might be
-# done intentionally when merging configuration files.
-kconf.warn_assign_override = False
-kconf.warn_assign_redun = False
 
-# Create a merged configuration by loading the fragments with replace=False.
-# load_config() and write_config() returns a message to print.
-for config in sys.argv[3:]:
-    print(kconf.load_config(config, replace=False))
+# MergeKconfig: The Kconfig objects of parseKconfig. Unlike Kconfig they can
+# be weakly referenced, which _merge_locks needs.
+class MergeKconfig(Kconfig):
+    __slots__ = ("__weakref__",)
 
-# Write the merged configuration
-print(kconf.write_config(sys.argv[2]))
 
-# Print warnings for symbols whose actual value doesn't match the assigned
-# value
-for sym in kconf.defined_syms:
-    # Was the symbol assigned to?
-    if sym.user_value is not None:
-        # Tristate values are represented as 0, 1, 2. Having them as
-        # "n", "m", "y" is more convenient here, so convert.
-        if sym.type in (BOOL, TRISTATE):
-            user_value = TRI_TO_STR[sym.user_value]
+# parseKconfig: Parses the Kconfig tree whose top level file is
+# "kconfig_filename". "source" statements (and the top level file itself, if
+# it is relative) are looked up relative to "srctree", or to the current
+# directory if no srctree is given.
+# Returns: the Kconfig object, set up for merging configuration fragments
+def parseKconfig(kconfig_filename, srctree=None):
+    with _srctree_lock:
+        old_srctree = os.environ.get("srctree")
+        if srctree:
+            os.environ["srctree"] = srctree
+        try:
+            kconf = MergeKconfig(kconfig_filename, suppress_traceback=True)
+        finally:
+            if old_srctree is None:
+                os.environ.pop("srctree", None)
+            else:
+                os.environ["srctree"] = old_srctree
+
+    # Warnings from parsing have been printed already. Warnings from merging
+    # are returned by mergeConfig instead.
+    kconf.warn_to_stderr = False
+
+    # Enable warnings for assignments to undefined symbols
+    kconf.warn_assign_undef = True
+
+    # Disable warnings generated for multiple assignments to the same symbol
+    # within a (set of) configuration files. Assigning a symbol multiple times
+    # might be done intentionally when merging configuration files.
+    kconf.warn_assign_override = False
+    kconf.warn_assign_redun = False
+    return kconf
+
+
+# readConfigValues: Reads the symbol assignments of a .config file.
+# Returns: a dict mapping symbol names (without the prefix) to their value as
+# it is written in the file ("n" for symbols that are not set). It is empty
+# if the file does not exist.
+def readConfigValues(config_filename, prefix="CONFIG_"):
+    values = {}
+    try:
+        with open(config_filename) as config_file:
+            for line in config_file:
+                line = line.strip()
+                if line.startswith(prefix) and "=" in line:
+                    name, value = line[len(prefix):].split("=", 1)
+                    values[name] = value
+                elif (line.startswith("# " + prefix) and
+                      line.endswith(" is not set")):
+                    values[line[len("# " + prefix):-len(" is not set")]] = "n"
+    except IOError:
+        pass
+    return values
+
+
+# getWrittenValues: Returns: the values that write_config() writes for the
+# symbols of "kconf", in the same format as readConfigValues
+def getWrittenValues(kconf):
+    values = {}
+    for sym in kconf.unique_defined_syms:
+        if not sym.config_string:
+            continue
+        if sym.type in (BOOL, TRISTATE) and sym.str_value == "n":
+            values[sym.name] = "n"
         else:
-            user_value = sym.user_value
+            values[sym.name] = sym.config_string.strip().split("=", 1)[1]
+    return values
+
+
+# getMergeLock: Returns: the lock that merges with "kconf" hold
+def getMergeLock(kconf):
+    with _merge_locks_lock:
+        merge_lock = _merge_locks.get(kconf)
+        if merge_lock is None:
+            merge_lock = threading.Lock()
+            _merge_locks[kconf] = merge_lock
+        return merge_lock
+
+
+# mergeConfig: Merges the configuration fragments in "config_files" on top of
+# the defaults of the Kconfig tree and writes the result to "merged_config".
+# "kconf" can be reused across merges, also from several threads: any values
+# from an earlier merge are dropped first.
+# Returns: a MergeResult
+def mergeConfig(kconf, merged_config, config_files):
+    with getMergeLock(kconf):
+        return _mergeConfig(kconf, merged_config, config_files)
+
+
+def _mergeConfig(kconf, merged_config, config_files):
+    kconf.unset_values()
+    # unset_values() leaves the "was assigned" flags that load_config() uses
+    # to detect symbols that are assigned twice, reset them the same way
+    # load_config(replace=True) does.
+    for item in kconf.unique_defined_syms + kconf.unique_choices:
+        item._was_set = False
+    kconf.missing_syms = []
+    kconf.warnings = []
+    messages = []
+
+    # (This uses alldefconfig as the base. Other starting states could be set
+    # up here as well. The approach in examples/allnoconfig_simpler.py could
+    # provide an allnoconfig starting state for example.)
+
+    # Create a merged configuration by loading the fragments with
+    # replace=False. load_config() and write_config() returns a message.
+    for config in config_files:
+        messages.append(kconf.load_config(config, replace=False))
+
+    # Write the merged configuration
+    old_values = readConfigValues(merged_config, kconf.config_prefix)
+    messages.append(kconf.write_config(merged_config))
+    new_values = getWrittenValues(kconf)
+    changed_symbols = sorted(name for name in set(old_values) | set(new_values)
+                             if old_values.get(name) != new_values.get(name))
+
+    # Warn about symbols whose actual value doesn't match the assigned value
+    warnings = list(kconf.warnings)
+    for sym in kconf.unique_defined_syms:
+        # Was the symbol assigned to?
+        if sym.user_value is not None:
+            # Tristate values are represented as 0, 1, 2. Having them as
+            # "n", "m", "y" is more convenient here, so convert.
+            if sym.type in (BOOL, TRISTATE):
+                user_value = TRI_TO_STR[sym.user_value]
+            else:
+                user_value = sym.user_value
+
+            if user_value != sym.str_value:
+                warnings.append(
+                    "warning: {} was assigned the value '{}' but got the "
+                    "value '{}' -- check dependencies".format(
+                        sym.name_and_loc, user_value, sym.str_value))
+
+    with open(merged_config) as merged_file:
+        config = merged_file.read()
+
+    return MergeResult(config, messages, warnings, changed_symbols)
+
+
+# writeMergedConfig: Writes the result of an earlier merge ("config" and its
+# "warnings") to "merged_config" the same way kconfiglib's write_config()
+# does: the file is left untouched if nothing changed, otherwise the old file
+# is kept as "<merged_config>.old".
+# Returns: a MergeResult, like mergeConfig
+def writeMergedConfig(config, warnings, merged_config, prefix="CONFIG_"):
+    old_values = readConfigValues(merged_config, prefix)
+    try:
+        with open(merged_config) as merged_file:
+            unchanged = merged_file.read() == config
+    except IOError:
+        unchanged = False
+
+    if unchanged:
+        message = "No change to configuration in '%s'" % merged_config
+    else:
+        if os.path.isfile(merged_config):
+            try:
+                shutil.copyfile(merged_config, merged_config + ".old")
+            except IOError:
+                pass
+        writeFileAtomically(merged_config, config)
+        message = "Configuration saved to '%s'" % merged_config
+
+    new_values = readConfigValues(merged_config, prefix)
+    changed_symbols = sorted(name for name in set(old_values) | set(new_values)
+                             if old_values.get(name) != new_values.get(name))
+    return MergeResult(config, [message], list(warnings), changed_symbols)
+
+
+def main():
+    if len(sys.argv) < 4:
+        sys.exit("usage: merge_config.py Kconfig merged_config config1 "
+                 "[config2 ...]")
+
+    kconf = parseKconfig(sys.argv[1])
+    result = mergeConfig(kconf, sys.argv[2], sys.argv[3:])
+
+    for message in result.messages:
+        print(message)
+    for warning in result.warnings:
+        print(warning, file=sys.stderr)
+
 
-        if user_value != sym.str_value:
-            print("warning: {} was assigned the value '{}' but got the "
-                  "value '{}' -- check dependencies".format(
-                      sym.name_and_loc, user_value, sym.str_value),
-                  file=sys.stderr)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
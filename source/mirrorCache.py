@@ -0,0 +1,166 @@
+from contextlib import contextmanager
+import hashlib
+import os
+import re
+import shutil
+import time
+
+from fileUtils import CACHE_DIRECTORY
+from gitUtils import runGitWithRetry, getDirectorySize
+
+
+# A local cache of bare mirrors of the FreeRTOS repository and its
+# submodules. cloneFreeRTOSRepository borrows objects from these mirrors
+# (through git alternates) so repeated fetches only download what changed
+# upstream since the last run. The cache is capped in size, the mirrors that
+# were used least recently are evicted first.
+
+
+# Default location of the cache and its size cap (in bytes)
+MIRROR_CACHE_DIRECTORY = os.path.join(CACHE_DIRECTORY, "mirrors")
+MIRROR_CACHE_SIZE_LIMIT = 10 * 1024 * 1024 * 1024
+
+# File inside of every mirror whose modification time records when the
+# mirror was last used. This is what the LRU eviction is based on.
+LAST_USED_FILENAME = "fetchSource-last-used"
+
+# File inside of every mirror whose modification time records when the
+# mirror was last fetched. Mirrors fetched less than MIRROR_REFRESH_INTERVAL
+# seconds ago are not fetched again, which keeps the boards of a batch from
+# all refreshing the same mirror.
+LAST_FETCHED_FILENAME = "fetchSource-last-fetched"
+MIRROR_REFRESH_INTERVAL = 60
+
+# A mirror is locked while it is created or fetched. Locks older than this
+# many seconds were left behind by a process that died and are broken.
+MIRROR_LOCK_TIMEOUT = 600
+
+# A fetch borrows objects from the mirrors it used until it dissociates from
+# them. Mirrors used less than this many seconds ago may still be borrowed
+# from by another process (like another worker of a batch) and aren't
+# evicted.
+MIRROR_IN_USE_INTERVAL = MIRROR_LOCK_TIMEOUT
+
+
+# getMirrorDirectory: Every url gets its own bare mirror. The directory name
+# is the readable repository name followed by a hash of the full url so that
+# repositories with the same name on different hosts do not collide.
+# Returns: the path of the mirror for "url"
+def getMirrorDirectory(url, cache_directory=MIRROR_CACHE_DIRECTORY):
+    repository_name = os.path.basename(url.rstrip("/"))
+    if repository_name.endswith(".git"):
+        repository_name = repository_name[:-len(".git")]
+    repository_name = re.sub(r"[^A-Za-z0-9_.-]", "_", repository_name)
+    url_hash = hashlib.sha1(url.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(cache_directory,
+                        "%s-%s.git" % (repository_name, url_hash))
+
+
+# markMirrorUsed: Updates the last used time of a mirror
+def markMirrorUsed(mirror_directory):
+    with open(os.path.join(mirror_directory, LAST_USED_FILENAME), "w") as \
+            last_used_file:
+        last_used_file.write("%f\n" % time.time())
+
+
+# getMirrorLastUsed: Returns: the time the mirror was last used (0 if never)
+def getMirrorLastUsed(mirror_directory):
+    try:
+        return os.path.getmtime(os.path.join(mirror_directory,
+                                             LAST_USED_FILENAME))
+    except OSError:
+        return 0
+
+
+# lockMirror: Context manager that keeps other processes from creating,
+# fetching or evicting the same mirror at the same time. Creating a directory
+# is atomic on every platform so it is used as the lock. Without "wait" a
+# mirror that is locked by someone else isn't waited for.
+# Returns: (as the value of the with statement) whether the lock was taken
+@contextmanager
+def lockMirror(mirror_directory, wait=True):
+    lock_directory = mirror_directory + ".lock"
+    while True:
+        try:
+            os.mkdir(lock_directory)
+            break
+        except FileExistsError:
+            try:
+                if (time.time() - os.path.getmtime(lock_directory) >
+                        MIRROR_LOCK_TIMEOUT):
+                    os.rmdir(lock_directory)
+                    continue
+            except OSError:
+                pass
+            if not wait:
+                yield False
+                return
+            time.sleep(0.1)
+    try:
+        yield True
+    finally:
+        os.rmdir(lock_directory)
+
+
+# updateMirror: Creates the bare mirror of "url" the first time it is needed
+# and refreshes it with an incremental fetch every time after that (unless it
+# was refreshed less than MIRROR_REFRESH_INTERVAL seconds ago).
+# Returns: the path of the up to date mirror
+def updateMirror(url, cache_directory=MIRROR_CACHE_DIRECTORY):
+    mirror_directory = getMirrorDirectory(url, cache_directory)
+    last_fetched_filename = os.path.join(mirror_directory,
+                                         LAST_FETCHED_FILENAME)
+    os.makedirs(cache_directory, exist_ok=True)
+
+    with lockMirror(mirror_directory):
+        if not os.path.isdir(mirror_directory):
+            runGitWithRetry(["clone", "--mirror", "--quiet", url,
+                             mirror_directory], cwd=cache_directory)
+        elif (os.path.exists(last_fetched_filename) and
+              time.time() - os.path.getmtime(last_fetched_filename) <
+              MIRROR_REFRESH_INTERVAL):
+            markMirrorUsed(mirror_directory)
+            return mirror_directory
+        else:
+            runGitWithRetry(["fetch", "--prune", "--quiet", "origin"],
+                            cwd=mirror_directory)
+
+        with open(last_fetched_filename, "w") as last_fetched_file:
+            last_fetched_file.write("%f\n" % time.time())
+        markMirrorUsed(mirror_directory)
+    return mirror_directory
+
+
+# evictMirrors: Deletes the least recently used mirrors until the cache is
+# no bigger than "size_limit". Mirrors listed in "keep" (the ones used by the
+# current fetch), mirrors that are locked (see lockMirror) and mirrors that
+# may be in use (see MIRROR_IN_USE_INTERVAL) are never evicted.
+# Returns: the list of mirrors that were deleted
+def evictMirrors(cache_directory=MIRROR_CACHE_DIRECTORY,
+                 size_limit=MIRROR_CACHE_SIZE_LIMIT, keep=()):
+    if not os.path.isdir(cache_directory):
+        return []
+
+    keep = set(os.path.abspath(mirror) for mirror in keep)
+    mirrors = []
+    for entry in os.scandir(cache_directory):
+        if entry.is_dir() and entry.name.endswith(".git"):
+            mirrors.append((getMirrorLastUsed(entry.path), entry.path,
+                            getDirectorySize(entry.path)))
+
+    total_size = sum(mirror[2] for mirror in mirrors)
+    evicted = []
+    for last_used, mirror_directory, mirror_size in sorted(mirrors):
+        if total_size <= size_limit:
+            break
+        if os.path.abspath(mirror_directory) in keep:
+            continue
+        with lockMirror(mirror_directory, wait=False) as locked:
+            if not locked or (time.time() -
+                              getMirrorLastUsed(mirror_directory) <
+                              MIRROR_IN_USE_INTERVAL):
+                continue
+            shutil.rmtree(mirror_directory)
+        total_size -= mirror_size
+        evicted.append(mirror_directory)
+    return evicted
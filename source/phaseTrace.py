@@ -0,0 +1,149 @@
+from contextlib import contextmanager
+import json
+import os
+import sys
+import time
+
+from gitUtils import countFiles, getGitDirectory
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is not recorded there
+    resource = None
+
+
+# Records where a fetchSource run spends its time. Every phase gets its wall
+# time, CPU time (of this process and of the child processes it waited for),
+# the peak RSS of the child processes, and, when it works on a repository,
+# the bytes received and the number of files it added. The phases are written
+# as a Chrome trace (chrome://tracing, Perfetto) and summarized in a table.
+
+
+# countRepositoryFiles: Counts the git directory of "repo_directory" (see
+# gitUtils.getGitDirectory, a worktree's lives outside of it) apart from the
+# working tree.
+# Returns: the size of the git directory in bytes and the number of files
+# of the working tree and their size in bytes
+def countRepositoryFiles(repo_directory):
+    git_directory = getGitDirectory(repo_directory)
+    git_files, git_bytes = countFiles(git_directory)
+    files, total_size = countFiles(repo_directory)
+    if not os.path.relpath(git_directory, repo_directory).startswith(".."):
+        files -= git_files
+        total_size -= git_bytes
+    return git_bytes, files, total_size
+
+
+# getChildPeakRss: Returns: the peak RSS (in KiB) of the largest child
+# process waited for so far, or None where it can't be measured. The
+# operating system only keeps this high water mark, so a phase reports the
+# largest child of the run up to the end of that phase.
+def getChildPeakRss():
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # macOS reports bytes, Linux reports KiB
+    if sys.platform == "darwin":
+        peak_rss //= 1024
+    return peak_rss
+
+
+class PhaseTracer(object):
+    # "enabled" False turns every phase into a no-op. Tracers whose events
+    # are merged into one trace share the same "epoch" (a time.time() value
+    # that the timestamps are relative to) and each get their own "pid", so
+    # their phases line up on one time axis without overlaying each other.
+    def __init__(self, enabled=True, process_name="fetchSource", epoch=None,
+                 pid=None):
+        self.enabled = enabled
+        self.process_name = process_name
+        self.events = []
+        self.epoch = time.time() if epoch is None else epoch
+        self.pid = os.getpid() if pid is None else pid
+
+    # phase: Context manager that records one phase. "repo_directory" is the
+    # repository the phase works on, if any: the growth of its git directory
+    # is reported as the bytes received and the growth of everything else as
+    # the files (and bytes) written. The yielded dict can be filled with
+    # extra values that are stored with the phase.
+    @contextmanager
+    def phase(self, name, repo_directory=None):
+        extra_args = {}
+        if not self.enabled:
+            yield extra_args
+            return
+
+        if repo_directory:
+            git_bytes_before, files_before, bytes_before = \
+                countRepositoryFiles(repo_directory)
+        times_before = os.times()
+        start_timestamp = time.time() - self.epoch
+        start_time = time.perf_counter()
+        try:
+            yield extra_args
+        finally:
+            end_time = time.perf_counter()
+            times_after = os.times()
+            args = {
+                "wall_seconds": end_time - start_time,
+                "cpu_seconds": ((times_after.user + times_after.system) -
+                                (times_before.user + times_before.system)),
+                "child_cpu_seconds": (
+                    (times_after.children_user +
+                     times_after.children_system) -
+                    (times_before.children_user +
+                     times_before.children_system)),
+                "child_peak_rss_kb": getChildPeakRss()}
+            if repo_directory:
+                git_bytes_after, files_after, bytes_after = \
+                    countRepositoryFiles(repo_directory)
+                args["bytes_received"] = git_bytes_after - git_bytes_before
+                args["files_written"] = files_after - files_before
+                args["bytes_written"] = bytes_after - bytes_before
+            args.update(extra_args)
+            self.events.append({
+                "name": name,
+                "cat": "phase",
+                "ph": "X",
+                "ts": start_timestamp * 1000000,
+                "dur": (end_time - start_time) * 1000000,
+                "pid": self.pid,
+                "tid": 0,
+                "args": args})
+
+    # getTraceEvents: Returns: the recorded phases as Chrome trace events,
+    # plus a metadata event that names the process
+    def getTraceEvents(self):
+        if not self.events:
+            return []
+        return [{"name": "process_name", "ph": "M", "pid": self.pid,
+                 "tid": 0, "args": {"name": self.process_name}}] + self.events
+
+
+# writeTrace: Writes trace events (from one or more PhaseTracers) to
+# "filename" in the Chrome trace event format
+def writeTrace(filename, trace_events):
+    with open(filename, "w") as trace_file:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"},
+                  trace_file, indent=1)
+        trace_file.write("\n")
+
+
+# printTraceSummary: Prints one line per phase of the trace events
+def printTraceSummary(trace_events):
+    print("\n-----TRACE SUMMARY-----\n")
+    print("%-26s %9s %9s %11s %12s %8s" % ("phase", "wall (s)", "cpu (s)",
+                                           "child rss", "received",
+                                           "files"))
+    for event in trace_events:
+        if event["ph"] != "X":
+            continue
+        args = event["args"]
+        child_rss = args.get("child_peak_rss_kb")
+        print("%-26s %9.2f %9.2f %11s %12s %8s" % (
+            event["name"], args["wall_seconds"],
+            args["cpu_seconds"] + args["child_cpu_seconds"],
+            "-" if child_rss is None else "%d KiB" % child_rss,
+            args.get("bytes_received", "-"), args.get("files_written", "-")))
+    sys.stdout.flush()
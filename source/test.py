@@ -2,11 +2,39 @@ import unittest
 from unittest import mock
 import sys
 import filecmp
+import gc
+import artifactCache
+import boardCatalog
+import benchmark
+import concurrent.futures
+import functools
+import multiprocessing
+import boardDefaults
+import configHeaders
+import directoryIndex
 import fetchSource
+import gitUtils
+import kconfigCache
+import libraryManifest
+import librarySelector
+import merge_config
+import mirrorCache
+import phaseTrace
+import workspace
 from contextlib import contextmanager
 from io import StringIO
-from collections import OrderedDict
+import io
 import os
+import json
+import shutil
+import socket
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
 
 
 # When this function is called it redirects stdout to a
@@ -24,26 +52,68 @@ def captured_output():
         sys.stdout, sys.stderr = old_out, old_err
 
 
-# This variable is global because it is needed by a variety
-# of tests cases
-boards_dict = OrderedDict(
-        [("cypress", ["CY8CKIT_064S0S2_4343W", "CYW943907AEVAL1F",
-                      "CYW954907AEVAL1F"]),
-            ("espressif", ["esp32"]),
-            ("infineon", ["xmc4800_iotkit",
-                          "xmc4800_plus_optiga_trust_x"]),
-            ("marvell", ["mw300_rd"]),
-            ("mediatek", ["mt7697hx-dev-kit"]),
-            ("microchip", ["curiosity_pic32mzef",
-                           "ecc608a_plus_winsim"]),
-            ("nordic", ["nrf52840-dk"]),
-            ("nuvoton", ["numaker_iot_m487_wifi"]),
-            ("nxp", ["lpc54018iotmodule"]),
-            ("pc", ["linux", "windows"]),
-            ("renesas", ["rx65n-rsk"]),
-            ("st", ["stm32l475_discovery"]),
-            ("ti", ["cc3220_launchpad"]),
-            ("xilinx", ["microzed"])])
+# Points the on disk caches at a temporary directory for the whole test run
+# so the tests never read or write the caches of the user.
+def setUpModule():
+    global cache_temp_dir
+    cache_temp_dir = tempfile.TemporaryDirectory()
+    kconfigCache.KCONFIG_CACHE_DIRECTORY = os.path.join(cache_temp_dir.name,
+                                                        "kconfig")
+    boardCatalog.BOARD_CATALOG_DIRECTORY = os.path.join(cache_temp_dir.name,
+                                                        "boards")
+
+
+def tearDownModule():
+    cache_temp_dir.cleanup()
+
+
+# Creates a git repository at "directory" with the given files committed on
+# the EthanDev branch (see benchmark.commitDirectory, the fixture
+# repositories are created with benchmark.FIXTURE_GIT_ENVIRONMENT). "files"
+# maps a repository relative path to its content.
+def createFixtureRepository(directory, files):
+    for path, content in files.items():
+        filepath = os.path.join(directory, path)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, "w") as fixture_file:
+            fixture_file.write(content)
+    benchmark.commitDirectory(directory)
+
+
+# Creates a small stand-in for the amazon-freertos repository with a core
+# tree, a directory for every library and two submodules (one in the core
+# tree and one that belongs to the OTA library).
+# Returns: the file:// url of the fixture repository
+def createFreeRTOSFixture(directory):
+    with open("KConfig") as kconfig_file:
+        kconfig = kconfig_file.read()
+    files = {"README.md": "fixture\n",
+             "freertos_kernel/tasks.c": "tasks\n",
+             "tools/configuration/KConfig": kconfig,
+             "vendors/espressif/boards/esp32/Kconfig": "",
+             "vendors/pc/boards/linux/Kconfig": "",
+             "vendors/espressif/boards/esp32/aws_demos/config_files/" +
+             "mqtt_Kconfig": "# CONFIG_MQTT_ENABLED is not set\n"}
+    for library_paths in fetchSource.LIBRARY_PATHS.values():
+        for library_path in library_paths:
+            # Third party code is added as submodules below
+            if not library_path.startswith("libraries/3rdparty/"):
+                files[library_path + "/source.c"] = library_path + "\n"
+
+    for submodule in ["mbedtls", "tinycbor"]:
+        createFixtureRepository(os.path.join(directory, submodule),
+                                {"src/" + submodule + ".c": submodule + "\n"})
+
+    freertos_directory = os.path.join(directory, "amazon-freertos")
+    createFixtureRepository(freertos_directory, files)
+    for submodule in ["mbedtls", "tinycbor"]:
+        subprocess.run(["git", "submodule", "add", "-q",
+                        "file://" + os.path.join(directory, submodule),
+                        "libraries/3rdparty/" + submodule],
+                       cwd=freertos_directory, check=True)
+    subprocess.run(["git", "commit", "-q", "-m", "submodules"],
+                   cwd=freertos_directory, check=True)
+    return "file://" + freertos_directory
 
 
 class TestFetchSource(unittest.TestCase):
@@ -78,7 +148,8 @@ class TestFetchSource(unittest.TestCase):
         with captured_output() as (out, err),\
              open(actual_output_filepath, 'w') as realOutput:
 
-            res = fetchSource.boardChoiceMenu(boards_dict)
+            res = fetchSource.boardChoiceMenu(
+                fetchSource.getBoardsDict())
             output = out.getvalue().strip()
             realOutput.write(output)
 
@@ -239,5 +310,1781 @@ class TestFetchSource(unittest.TestCase):
         self.assertEqual(testing_input, output_dir)
 
 
+# Returns: a TCP port of the loopback interface that nothing listens on
+def getFreePort():
+    with socket.socket() as free_socket:
+        free_socket.bind(("127.0.0.1", 0))
+        return free_socket.getsockname()[1]
+
+
+# Starts a git daemon that serves the repositories below "base_directory" on
+# "port" of the loopback interface.
+# Returns: the subprocess.Popen of the daemon, once it accepts connections
+def startGitDaemon(base_directory, port):
+    daemon = subprocess.Popen(["git", "daemon", "--reuseaddr", "--export-all",
+                               "--listen=127.0.0.1", "--port=%d" % port,
+                               "--base-path=" + base_directory,
+                               base_directory])
+    for attempt in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return daemon
+        except OSError:
+            threading.Event().wait(0.05)
+    daemon.kill()
+    raise RuntimeError("git daemon didn't start")
+
+
+class TestCloneFreeRTOSRepository(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+        environment = mock.patch.dict(os.environ,
+                                      benchmark.FIXTURE_GIT_ENVIRONMENT)
+        environment.start()
+        self.addCleanup(environment.stop)
+
+        repository_url = createFreeRTOSFixture(
+            os.path.join(self.temp_dir.name, "remote"))
+        url_patch = mock.patch("fetchSource.FREERTOS_REPOSITORY_URL",
+                               repository_url)
+        url_patch.start()
+        self.addCleanup(url_patch.stop)
+
+        self.output_dir = os.path.join(self.temp_dir.name, "output")
+
+    # Writes a .config that only enables the given libraries
+    def writeConfig(self, enabled_libraries):
+        config_filename = os.path.join(self.temp_dir.name, ".config")
+        with open(config_filename, "w") as config_file:
+            for library in fetchSource.LIBRARY_PATHS:
+                if library in enabled_libraries:
+                    config_file.write("CONFIG_%s=y\n" % library)
+                else:
+                    config_file.write("# CONFIG_%s is not set\n" % library)
+        return config_filename
+
+    # This test confirms that the clone only checks out the core tree and the
+    # libraries that are enabled in the .config file
+    def test_sparseCheckout(self):
+        config_filename = self.writeConfig(["MQTT_ENABLED"])
+
+        with captured_output():
+            fetchSource.cloneFreeRTOSRepository(self.output_dir,
+                                                config_filename)
+
+        def exists(path):
+            return os.path.exists(os.path.join(self.output_dir, path))
+
+        self.assertTrue(exists("freertos_kernel/tasks.c"))
+        self.assertTrue(exists("libraries/c_sdk/standard/mqtt/source.c"))
+        self.assertFalse(exists("libraries/freertos_plus/aws/ota"))
+        self.assertFalse(exists(
+            "libraries/freertos_plus/standard/freertos_plus_tcp"))
+
+    # This test confirms that only the submodules of the core tree and of
+    # the enabled libraries are initialized
+    def test_submodulesOfEnabledLibraries(self):
+        def submoduleFile(submodule):
+            return os.path.join(self.output_dir, "libraries/3rdparty",
+                                submodule, "src", submodule + ".c")
+
+        config_filename = self.writeConfig(["TCP_ENABLED"])
+        with captured_output():
+            fetchSource.cloneFreeRTOSRepository(self.output_dir,
+                                                config_filename)
+
+        self.assertTrue(os.path.exists(submoduleFile("mbedtls")))
+        self.assertFalse(os.path.exists(submoduleFile("tinycbor")))
+
+    # This test confirms that reconfiguring a checkout for the same board
+    # adds the newly enabled libraries (and submodules) and removes the
+    # disabled ones from the working tree
+    def test_reconfigureRepository(self):
+        def exists(path):
+            return os.path.exists(os.path.join(self.output_dir, path))
+
+        config_filename = self.writeConfig(["OTA_ENABLED"])
+        with captured_output():
+            fetchSource.cloneFreeRTOSRepository(self.output_dir,
+                                                config_filename)
+            fetchSource.updateBoardChosen("espressif", "esp32",
+                                          self.output_dir)
+        self.assertTrue(exists("libraries/3rdparty/tinycbor/src/tinycbor.c"))
+        self.assertTrue(fetchSource.isCheckoutOfBoard("espressif", "esp32",
+                                                      self.output_dir))
+        self.assertFalse(fetchSource.isCheckoutOfBoard("pc", "linux",
+                                                       self.output_dir))
+
+        config_filename = self.writeConfig(["MQTT_ENABLED"])
+        with captured_output() as (out, err):
+            fetchSource.reconfigureFreeRTOSRepository(self.output_dir,
+                                                      config_filename)
+
+        self.assertIn("Adding MQTT_ENABLED", out.getvalue())
+        self.assertIn("Removing OTA_ENABLED", out.getvalue())
+        self.assertTrue(exists("libraries/c_sdk/standard/mqtt/source.c"))
+        self.assertFalse(exists("libraries/freertos_plus/aws/ota"))
+        self.assertFalse(exists("libraries/3rdparty/tinycbor/src"))
+        self.assertTrue(exists("libraries/3rdparty/mbedtls/src/mbedtls.c"))
+
+        config_filename = self.writeConfig(["OTA_ENABLED"])
+        with captured_output():
+            fetchSource.reconfigureFreeRTOSRepository(self.output_dir,
+                                                      config_filename)
+        self.assertTrue(exists("libraries/3rdparty/tinycbor/src/tinycbor.c"))
+        self.assertFalse(exists("libraries/c_sdk/standard/mqtt"))
+
+    # This test confirms that boards can be merged into several checkouts
+    # from several threads of one process at once, sharing one parsed
+    # Kconfig tree, and that the results don't depend on the working
+    # directory
+    def test_concurrentBoardMerges(self):
+        config_filename = self.writeConfig(["MQTT_ENABLED"])
+        with captured_output():
+            fetchSource.cloneFreeRTOSRepository(self.output_dir,
+                                                config_filename)
+        output_dirs = [self.output_dir]
+        for copy in range(3):
+            output_dirs.append(self.output_dir + str(copy))
+            shutil.copytree(self.output_dir, output_dirs[-1], symlinks=True)
+
+        errors = []
+
+        def mergeBoard(output_dir):
+            try:
+                fetchSource.updateBoardChosen("espressif", "esp32",
+                                              output_dir)
+            except Exception as exception:
+                errors.append(exception)
+
+        old_directory = os.getcwd()
+        os.chdir(self.temp_dir.name)
+        try:
+            with captured_output():
+                threads = [threading.Thread(target=mergeBoard,
+                                            args=(output_dir,))
+                           for output_dir in output_dirs]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+        finally:
+            os.chdir(old_directory)
+
+        self.assertEqual(errors, [])
+        for output_dir in output_dirs:
+            configuration_directory = os.path.join(output_dir,
+                                                   "tools/configuration")
+            self.assertIn("# CONFIG_MQTT_ENABLED is not set", open(
+                os.path.join(configuration_directory, ".config")).read())
+            with open(os.path.join(configuration_directory,
+                                   "boardChoice.csv")) as board_choice_file:
+                self.assertEqual(board_choice_file.read(), "espressif,esp32")
+
+    # This test confirms that the library manifest measures the directories
+    # and submodules of every library of a full checkout and that the
+    # download estimate counts the core and the chosen libraries
+    def test_buildLibraryManifest(self):
+        config_filename = self.writeConfig(fetchSource.LIBRARY_PATHS)
+        with captured_output():
+            fetchSource.cloneFreeRTOSRepository(self.output_dir,
+                                                config_filename)
+
+        manifest_filename = os.path.join(self.temp_dir.name, "manifest.json")
+        manifest = libraryManifest.buildLibraryManifest(
+            self.output_dir, fetchSource.CORE_PATHS,
+            fetchSource.LIBRARY_PATHS,
+            list(fetchSource.getSubmodules(self.output_dir)),
+            manifest_filename)
+
+        self.assertEqual(libraryManifest.getLibraryManifest(
+            fetchSource.CORE_PATHS, fetchSource.LIBRARY_PATHS,
+            manifest_filename), manifest)
+        self.assertNotIn("paths", libraryManifest.loadLibraryManifest(
+            manifest_filename)["core"])
+        self.assertEqual(manifest["core"]["paths"], fetchSource.CORE_PATHS)
+        mqtt = manifest["libraries"]["MQTT_ENABLED"]
+        self.assertEqual(mqtt["bytes"],
+                         len("libraries/c_sdk/standard/mqtt\n") +
+                         len("demos/mqtt\n"))
+        self.assertEqual(manifest["libraries"]["OTA_ENABLED"]["submodules"],
+                         {"libraries/3rdparty/tinycbor": len("tinycbor\n")})
+        self.assertEqual(manifest["core"]["submodules"],
+                         {"libraries/3rdparty/mbedtls": len("mbedtls\n")})
+
+        core_size = libraryManifest.estimateDownloadSize(set(), manifest)
+        self.assertEqual(libraryManifest.estimateDownloadSize(
+            {"MQTT_ENABLED"}, manifest), core_size + mqtt["bytes"])
+
+    # This test confirms that the clone is a blobless partial clone
+    def test_partialClone(self):
+        config_filename = self.writeConfig([])
+        with captured_output():
+            fetchSource.cloneFreeRTOSRepository(self.output_dir,
+                                                config_filename)
+
+        result = subprocess.run(["git", "config",
+                                 "remote.origin.partialclonefilter"],
+                                cwd=self.output_dir, stdout=subprocess.PIPE,
+                                universal_newlines=True)
+        self.assertEqual(result.stdout.strip(), "blob:none")
+
+    # Runs git in the output directory and returns its stripped output
+    def gitOutput(self, arguments):
+        result = subprocess.run(["git"] + arguments, cwd=self.output_dir,
+                                stdout=subprocess.PIPE,
+                                universal_newlines=True, check=True)
+        return result.stdout.strip()
+
+    # This test confirms that only the last commit of the branch is fetched,
+    # that the branch is checked out tracking the remote branch and that the
+    # history can be deepened later on
+    def test_shallowBranchClone(self):
+        config_filename = self.writeConfig([])
+        with captured_output():
+            phase_stats = fetchSource.cloneFreeRTOSRepository(
+                self.output_dir, config_filename)
+
+        self.assertEqual(self.gitOutput(["rev-list", "--count", "HEAD"]), "1")
+        self.assertEqual(self.gitOutput(["rev-parse", "--abbrev-ref",
+                                         "@{upstream}"]),
+                         "origin/" + fetchSource.FREERTOS_BRANCH)
+        self.assertEqual([stats.name for stats in phase_stats],
+                         ["init", "fetch", "checkout", "submodules"])
+        self.assertTrue(all(stats.bytes_received >= 0
+                            for stats in phase_stats))
+
+        with captured_output():
+            fetchSource.deepenRepository(self.output_dir)
+        self.assertEqual(self.gitOutput(["rev-list", "--count", "HEAD"]), "2")
+
+    # This test confirms that a tag and a pinned commit are checked out
+    # detached at the requested commit
+    def test_tagAndCommitClone(self):
+        remote_directory = os.path.join(self.temp_dir.name, "remote",
+                                        "amazon-freertos")
+        subprocess.run(["git", "tag", "v1", "HEAD~1"], cwd=remote_directory,
+                       check=True)
+        first_commit = subprocess.run(["git", "rev-parse", "HEAD~1"],
+                                      cwd=remote_directory,
+                                      stdout=subprocess.PIPE,
+                                      universal_newlines=True).stdout.strip()
+        config_filename = self.writeConfig([])
+
+        for ref in ["v1", first_commit]:
+            output_dir = os.path.join(self.temp_dir.name, "output-" + ref)
+            with captured_output():
+                fetchSource.cloneFreeRTOSRepository(output_dir,
+                                                    config_filename, ref=ref)
+            result = subprocess.run(["git", "rev-parse", "HEAD"],
+                                    cwd=output_dir, stdout=subprocess.PIPE,
+                                    universal_newlines=True)
+            self.assertEqual(result.stdout.strip(), first_commit)
+
+    # This test confirms that the repository and its submodules are fetched
+    # through the mirror cache, that a second fetch reuses the same mirrors
+    # and that the checkout does not depend on the mirrors afterwards
+    def test_mirrorCache(self):
+        cache_directory = os.path.join(self.temp_dir.name, "mirrors")
+        config_filename = self.writeConfig(["OTA_ENABLED"])
+
+        for output_name in ["output1", "output2"]:
+            output_dir = os.path.join(self.temp_dir.name, output_name)
+            with captured_output():
+                fetchSource.cloneFreeRTOSRepository(
+                    output_dir, config_filename,
+                    mirror_cache_directory=cache_directory)
+
+            self.assertTrue(os.path.exists(os.path.join(
+                output_dir, "libraries/3rdparty/tinycbor/src/tinycbor.c")))
+            self.assertFalse(os.path.exists(os.path.join(
+                output_dir, ".git/objects/info/alternates")))
+
+        self.assertEqual(len(os.listdir(cache_directory)), 3)
+        self.assertEqual(subprocess.run(["git", "fsck", "--connectivity-only"],
+                                        cwd=output_dir).returncode, 0)
+
+    # This test confirms that the first fetch of a configuration is cloned
+    # with git and published to the artifact cache, and that the next fetch
+    # of it is extracted from the cache without cloning
+    def test_artifactCache(self):
+        server = artifactCache.createServer(
+            os.path.join(self.temp_dir.name, "artifacts"), "127.0.0.1", 0)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server_thread.join)
+        self.addCleanup(server.shutdown)
+        cache_url = "http://127.0.0.1:%d/" % server.server_address[1]
+        config_filename = self.writeConfig(["OTA_ENABLED"])
+
+        with captured_output() as (out, err):
+            fetchSource.fetchFreeRTOSRepository(
+                "espressif", "esp32", self.output_dir, config_filename,
+                artifact_cache_url=cache_url)
+        self.assertIn("Published the checkout", out.getvalue())
+        self.assertEqual(len(os.listdir(server.cache_directory)), 1)
+
+        restored_dir = os.path.join(self.temp_dir.name, "restored")
+        with mock.patch("fetchSource.cloneFreeRTOSRepository") as clone:
+            with captured_output() as (out, err):
+                fetchSource.fetchFreeRTOSRepository(
+                    "espressif", "esp32", restored_dir, config_filename,
+                    artifact_cache_url=cache_url)
+        clone.assert_not_called()
+        self.assertIn("Restored the checkout", out.getvalue())
+        self.assertTrue(os.path.exists(os.path.join(
+            restored_dir, "libraries/3rdparty/tinycbor/src/tinycbor.c")))
+        self.assertFalse(os.path.exists(os.path.join(
+            restored_dir, "libraries/c_sdk/standard/mqtt")))
+        self.assertTrue(filecmp.cmp(
+            fetchSource.getFetchedConfigFilename(restored_dir),
+            config_filename, shallow=False))
+        self.assertEqual(subprocess.run(["git", "fsck", "--connectivity-only"],
+                                        cwd=restored_dir).returncode, 0)
+
+        # Another library selection is another artifact
+        with captured_output():
+            fetchSource.fetchFreeRTOSRepository(
+                "espressif", "esp32",
+                os.path.join(self.temp_dir.name, "mqtt"),
+                self.writeConfig(["MQTT_ENABLED"]),
+                artifact_cache_url=cache_url)
+        self.assertEqual(len(os.listdir(server.cache_directory)), 2)
+
+    # This test confirms that the files of an artifact are rewritten from the
+    # commit of the ref, and that an artifact with files the commit doesn't
+    # have is thrown away and cloned instead
+    def test_tamperedArtifact(self):
+        server = artifactCache.createServer(
+            os.path.join(self.temp_dir.name, "artifacts"), port=0)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server_thread.join)
+        self.addCleanup(server.shutdown)
+        cache_url = "http://127.0.0.1:%d/" % server.server_address[1]
+        config_filename = self.writeConfig(["OTA_ENABLED"])
+
+        with captured_output():
+            fetchSource.fetchFreeRTOSRepository(
+                "espressif", "esp32", self.output_dir, config_filename,
+                artifact_cache_url=cache_url)
+        source_filename = "libraries/freertos_plus/aws/ota/source.c"
+        with open(os.path.join(self.output_dir, source_filename)) as \
+                source_file:
+            source = source_file.read()
+        artifact_filename = os.path.join(server.cache_directory,
+                                         os.listdir(server.cache_directory)[0])
+        planted_filename = "libraries/freertos_plus/aws/ota/json.py"
+
+        for tampered_filename in [source_filename, planted_filename]:
+            with open(os.path.join(self.output_dir, tampered_filename),
+                      "w") as tampered_file:
+                tampered_file.write("tampered\n")
+            with tarfile.open(artifact_filename, "w:gz") as archive:
+                archive.add(self.output_dir, arcname=".")
+
+            restored_dir = os.path.join(self.temp_dir.name, "restored")
+            shutil.rmtree(restored_dir, ignore_errors=True)
+            with captured_output() as (out, err):
+                fetchSource.fetchFreeRTOSRepository(
+                    "espressif", "esp32", restored_dir, config_filename,
+                    artifact_cache_url=cache_url)
+            with open(os.path.join(restored_dir, source_filename)) as \
+                    source_file:
+                self.assertEqual(source_file.read(), source)
+        self.assertIn("isn't a checkout of", out.getvalue())
+        self.assertFalse(os.path.exists(os.path.join(restored_dir,
+                                                     planted_filename)))
+
+    # This test confirms that a fetch from a git daemon that can't be reached
+    # yet is retried, waiting twice as long every time, until the daemon is
+    # up
+    def test_retryFetch(self):
+        port = getFreePort()
+        daemons = []
+        delays = []
+
+        # The daemon is only started while the second retry is waited for
+        def sleep(delay):
+            delays.append(delay)
+            if len(delays) == 2:
+                daemons.append(startGitDaemon(
+                    os.path.join(self.temp_dir.name, "remote"), port))
+                self.addCleanup(daemons[0].wait)
+                self.addCleanup(daemons[0].terminate)
+
+        config_filename = self.writeConfig(["MQTT_ENABLED"])
+        with mock.patch("fetchSource.FREERTOS_REPOSITORY_URL",
+                        "git://127.0.0.1:%d/amazon-freertos" % port), \
+                mock.patch("gitUtils.time.sleep", side_effect=sleep):
+            with captured_output() as (out, err):
+                fetchSource.cloneFreeRTOSRepository(self.output_dir,
+                                                    config_filename)
+
+        self.assertEqual(delays, [gitUtils.RETRY_BACKOFF,
+                                  2 * gitUtils.RETRY_BACKOFF])
+        self.assertIn("retrying", out.getvalue())
+        self.assertTrue(os.path.exists(os.path.join(
+            self.output_dir, "libraries/c_sdk/standard/mqtt/source.c")))
+
+    # This test confirms that fetching a ref the remote doesn't have fails
+    # right away instead of being retried
+    def test_missingRef(self):
+        config_filename = self.writeConfig(["MQTT_ENABLED"])
+        with mock.patch("gitUtils.time.sleep") as sleep:
+            with captured_output():
+                with self.assertRaises(gitUtils.GitError):
+                    fetchSource.cloneFreeRTOSRepository(
+                        self.output_dir, config_filename, "nonexistent")
+        sleep.assert_not_called()
+
+    # This test confirms that a clone whose submodules keep failing records
+    # its progress, and that the next run only does what is left
+    def test_resumeClone(self):
+        config_filename = self.writeConfig(["OTA_ENABLED"])
+        run = subprocess.run
+        git_commands = []
+
+        def failSubmodules(command, *args, **kwargs):
+            git_commands.append(command[1])
+            if command[1:3] == ["submodule", "update"]:
+                return subprocess.CompletedProcess(command, 128)
+            return run(command, *args, **kwargs)
+
+        with mock.patch("gitUtils.subprocess.run",
+                        side_effect=failSubmodules), \
+                mock.patch("gitUtils.RETRY_BACKOFF", 0):
+            with captured_output() as (out, err):
+                with self.assertRaises(gitUtils.GitError):
+                    fetchSource.cloneFreeRTOSRepository(self.output_dir,
+                                                        config_filename)
+        self.assertIn("Run the script again", out.getvalue())
+        self.assertEqual(git_commands.count("submodule"),
+                         gitUtils.GIT_ATTEMPTS)
+        fetch_state = fetchSource.FetchState(
+            self.output_dir, fetchSource.FREERTOS_BRANCH,
+            fetchSource.FETCH_DEPTH)
+        self.assertEqual(fetch_state.completed_steps, ["fetch", "checkout"])
+        tinycbor = os.path.join(self.output_dir,
+                                "libraries/3rdparty/tinycbor/src/tinycbor.c")
+        self.assertFalse(os.path.exists(tinycbor))
+
+        del git_commands[:]
+
+        def recordCommands(command, *args, **kwargs):
+            git_commands.append(command[1])
+            return run(command, *args, **kwargs)
+
+        with mock.patch("gitUtils.subprocess.run",
+                        side_effect=recordCommands):
+            with captured_output():
+                fetchSource.cloneFreeRTOSRepository(self.output_dir,
+                                                    config_filename)
+        self.assertNotIn("fetch", git_commands)
+        self.assertNotIn("checkout", git_commands)
+        self.assertTrue(os.path.exists(tinycbor))
+        self.assertTrue(os.path.isfile(
+            fetchSource.getFetchedConfigFilename(self.output_dir)))
+
+    # This test confirms that a repository this script didn't create is
+    # left alone instead of being fetched into, like git clone does
+    def test_refuseForeignRepository(self):
+        os.makedirs(self.output_dir)
+        subprocess.run(["git", "init", "-q"], cwd=self.output_dir, check=True)
+        subprocess.run(["git", "remote", "add", "origin",
+                        "https://example.com/mine.git"], cwd=self.output_dir,
+                       check=True)
+        work_filename = os.path.join(self.output_dir, "work.c")
+        with open(work_filename, "w") as work_file:
+            work_file.write("int main(void) { return 0; }\n")
+
+        config_filename = self.writeConfig(["MQTT_ENABLED"])
+        with captured_output():
+            with self.assertRaises(FileExistsError):
+                fetchSource.cloneFreeRTOSRepository(self.output_dir,
+                                                    config_filename)
+        self.assertTrue(os.path.isfile(work_filename))
+        self.assertEqual(self.gitOutput(
+            ["-C", self.output_dir, "remote", "get-url", "origin"]),
+            "https://example.com/mine.git")
+
+    # This test confirms that the checkouts of a workspace are worktrees of
+    # one store with their own sparse checkout, and that their submodules
+    # are worktrees of the shallow, blobless submodule stores of the
+    # workspace
+    def test_workspace(self):
+        workspace_directory = os.path.join(self.temp_dir.name, "workspace")
+        ota_dir = self.output_dir
+        mqtt_dir = os.path.join(self.temp_dir.name, "mqtt")
+
+        with captured_output():
+            fetchSource.fetchFreeRTOSRepository(
+                "espressif", "esp32", ota_dir,
+                self.writeConfig(["OTA_ENABLED"]),
+                workspace_directory=workspace_directory)
+            fetchSource.fetchFreeRTOSRepository(
+                "pc", "linux", mqtt_dir, self.writeConfig(["MQTT_ENABLED"]),
+                workspace_directory=workspace_directory)
+
+        store_directory = os.path.join(workspace_directory, "freertos.git")
+        self.assertEqual(sorted(os.listdir(workspace_directory)),
+                         ["freertos.git", "modules"])
+        for checkout in [ota_dir, mqtt_dir]:
+            self.assertTrue(os.path.isfile(os.path.join(checkout, ".git")))
+            self.assertEqual(workspace.getCheckoutWorkspace(checkout),
+                             workspace_directory)
+            self.assertEqual(self.gitOutput(
+                ["-C", checkout, "rev-parse", "--git-common-dir"]),
+                store_directory)
+        self.assertTrue(os.path.exists(os.path.join(
+            ota_dir, "libraries/freertos_plus/aws/ota/source.c")))
+        self.assertFalse(os.path.exists(os.path.join(
+            mqtt_dir, "libraries/freertos_plus/aws/ota")))
+        self.assertTrue(os.path.exists(os.path.join(
+            mqtt_dir, "libraries/c_sdk/standard/mqtt/source.c")))
+        # Only the directory of the chosen vendor is checked out
+        self.assertEqual(os.listdir(os.path.join(ota_dir, "vendors")),
+                         ["espressif"])
+        self.assertEqual(os.listdir(os.path.join(mqtt_dir, "vendors")),
+                         ["pc"])
+        self.assertTrue(filecmp.cmp(
+            fetchSource.getFetchedConfigFilename(mqtt_dir),
+            self.writeConfig(["MQTT_ENABLED"]), shallow=False))
+
+        # Enabling OTA in the second checkout adds tinycbor from the store
+        # that the first checkout created
+        with captured_output():
+            fetchSource.reconfigureFreeRTOSRepository(
+                mqtt_dir, self.writeConfig(["MQTT_ENABLED", "OTA_ENABLED"]))
+        self.assertTrue(os.path.exists(os.path.join(
+            mqtt_dir, "libraries/3rdparty/tinycbor/src/tinycbor.c")))
+        self.assertEqual(os.listdir(os.path.join(mqtt_dir, "vendors")),
+                         ["pc"])
+        tinycbor_store = self.gitOutput(
+            ["-C", os.path.join(mqtt_dir, "libraries/3rdparty/tinycbor"),
+             "rev-parse", "--git-common-dir"])
+        self.assertEqual(tinycbor_store, self.gitOutput(
+            ["-C", os.path.join(ota_dir, "libraries/3rdparty/tinycbor"),
+             "rev-parse", "--git-common-dir"]))
+        self.assertEqual(os.path.dirname(tinycbor_store),
+                         os.path.join(workspace_directory, "modules"))
+        self.assertEqual(self.gitOutput(
+            ["-C", tinycbor_store, "rev-parse", "--is-shallow-repository"]),
+            "true")
+        self.assertEqual(self.gitOutput(
+            ["-C", tinycbor_store, "config", "remote.origin.promisor"]),
+            "true")
+        self.assertEqual(len(os.listdir(os.path.join(workspace_directory,
+                                                     "modules"))), 2)
+        self.assertNotRegex(self.gitOutput(
+            ["-C", mqtt_dir, "submodule", "status"]), r"(^|\n)[-+U]")
+        self.assertEqual(subprocess.run(["git", "fsck", "--connectivity-only"],
+                                        cwd=mqtt_dir).returncode, 0)
+
+    # This test confirms that a checkout of a workspace that was interrupted
+    # after its worktree was added is resumed in the same worktree
+    def test_resumeWorkspace(self):
+        workspace_directory = os.path.join(self.temp_dir.name, "workspace")
+        config_filename = self.writeConfig(["OTA_ENABLED"])
+        run = subprocess.run
+        git_commands = []
+
+        def failCheckout(command, *args, **kwargs):
+            git_commands.append(command[1:3])
+            if command[1] == "checkout":
+                return subprocess.CompletedProcess(command, 128)
+            return run(command, *args, **kwargs)
+
+        with mock.patch("gitUtils.subprocess.run",
+                        side_effect=failCheckout), \
+                mock.patch("gitUtils.RETRY_BACKOFF", 0):
+            with captured_output() as (out, err):
+                with self.assertRaises(gitUtils.GitError):
+                    fetchSource.addToWorkspace(self.output_dir,
+                                               workspace_directory,
+                                               config_filename)
+        self.assertIn("Run the script again", out.getvalue())
+        self.assertIn(["worktree", "add"], git_commands)
+
+        del git_commands[:]
+
+        store_directory = os.path.join(workspace_directory, "freertos.git")
+
+        def recordCommands(command, *args, **kwargs):
+            git_commands.append((command[1:3], kwargs.get("cwd")))
+            return run(command, *args, **kwargs)
+
+        with mock.patch("gitUtils.subprocess.run",
+                        side_effect=recordCommands):
+            with captured_output():
+                fetchSource.addToWorkspace(self.output_dir,
+                                           workspace_directory,
+                                           config_filename)
+        self.assertNotIn((["worktree", "add"], store_directory),
+                         git_commands)
+        self.assertTrue(os.path.exists(os.path.join(
+            self.output_dir, "libraries/freertos_plus/aws/ota/source.c")))
+        self.assertTrue(os.path.exists(os.path.join(
+            self.output_dir, "libraries/3rdparty/tinycbor/src/tinycbor.c")))
+        self.assertEqual(self.gitOutput(
+            ["-C", store_directory, "worktree", "list",
+             "--porcelain"]).count("worktree "), 2)
+
+
+class TestArtifactCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+        self.server = artifactCache.createServer(
+            os.path.join(self.temp_dir.name, "artifacts"), "127.0.0.1", 0)
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(server_thread.join)
+        self.addCleanup(self.server.shutdown)
+        self.cache_url = "http://127.0.0.1:%d" % self.server.server_address[1]
+
+    # This test confirms that a published directory is extracted unchanged
+    # and that a missing archive is a miss that leaves nothing behind
+    def test_publishAndDownload(self):
+        source_directory = os.path.join(self.temp_dir.name, "source")
+        os.makedirs(os.path.join(source_directory, "nested"))
+        with open(os.path.join(source_directory, "nested", "file.c"),
+                  "w") as source_file:
+            source_file.write("source\n")
+        key = artifactCache.getArtifactKey(["ref", "board"])
+        self.assertNotEqual(key, artifactCache.getArtifactKey(["ref", "b"]))
+
+        target_directory = os.path.join(self.temp_dir.name, "target")
+        self.assertFalse(artifactCache.downloadArtifact(
+            self.cache_url, key, target_directory))
+        self.assertFalse(os.path.exists(target_directory))
+
+        self.assertTrue(artifactCache.publishArtifact(
+            self.cache_url, key, source_directory))
+        self.assertTrue(artifactCache.downloadArtifact(
+            self.cache_url, key, target_directory))
+        with open(os.path.join(target_directory, "nested", "file.c")) as \
+                target_file:
+            self.assertEqual(target_file.read(), "source\n")
+        self.assertFalse(os.path.exists(
+            target_directory + artifactCache.PARTIAL_SUFFIX))
+
+    # This test confirms that an archive that is already stored isn't
+    # replaced by another upload
+    def test_noOverwrite(self):
+        key = artifactCache.getArtifactKey(["ref", "board"])
+        for contents in ["first\n", "second\n"]:
+            source_directory = os.path.join(self.temp_dir.name, contents)
+            os.makedirs(source_directory)
+            with open(os.path.join(source_directory, "file.c"),
+                      "w") as source_file:
+                source_file.write(contents)
+            stored = artifactCache.publishArtifact(self.cache_url, key,
+                                                   source_directory)
+            self.assertEqual(stored, contents == "first\n")
+
+        target_directory = os.path.join(self.temp_dir.name, "target")
+        self.assertTrue(artifactCache.downloadArtifact(
+            self.cache_url, key, target_directory))
+        with open(os.path.join(target_directory, "file.c")) as target_file:
+            self.assertEqual(target_file.read(), "first\n")
+
+    # This test confirms that the git config files and hooks of a directory
+    # are left out of its archive and skipped when an archive is extracted
+    def test_gitControlFiles(self):
+        source_directory = os.path.join(self.temp_dir.name, "source")
+        control_files = [".git/config", ".git/config.worktree",
+                         ".git/hooks/post-checkout",
+                         ".git/modules/lib/config",
+                         ".git/modules/lib/hooks/pre-commit"]
+        data_files = [".git/HEAD", ".git/refs/heads/config",
+                      ".git/modules/lib/HEAD", "config", "hooks/file.c"]
+        for filename in control_files + data_files:
+            os.makedirs(os.path.dirname(os.path.join(source_directory,
+                                                     filename)),
+                        exist_ok=True)
+            with open(os.path.join(source_directory, filename),
+                      "w") as source_file:
+                source_file.write("contents\n")
+
+        key = artifactCache.getArtifactKey(["ref", "board"])
+        self.assertTrue(artifactCache.publishArtifact(
+            self.cache_url, key, source_directory))
+        target_directory = os.path.join(self.temp_dir.name, "target")
+        self.assertTrue(artifactCache.downloadArtifact(
+            self.cache_url, key, target_directory))
+        for filename in control_files:
+            self.assertFalse(os.path.exists(os.path.join(target_directory,
+                                                         filename)))
+        for filename in data_files:
+            self.assertTrue(os.path.exists(os.path.join(target_directory,
+                                                        filename)))
+
+        archive_file = io.BytesIO()
+        with tarfile.open(fileobj=archive_file, mode="w:gz") as archive:
+            archive.add(source_directory, arcname=".")
+        for data_filter in [True, False]:
+            target_directory = os.path.join(self.temp_dir.name,
+                                            "extracted%s" % data_filter)
+            with mock.patch.dict(tarfile.__dict__):
+                if not data_filter:
+                    tarfile.__dict__.pop("data_filter", None)
+                archive_file.seek(0)
+                artifactCache.extractArchive(archive_file, target_directory)
+            self.assertFalse(os.path.exists(os.path.join(
+                target_directory, ".git/hooks/post-checkout")))
+            self.assertTrue(os.path.exists(os.path.join(
+                target_directory, ".git/refs/heads/config")))
+
+    # This test confirms that archives with links pointing outside of the
+    # target directory are refused, also on python versions without
+    # tarfile.data_filter
+    def test_unsafeLinks(self):
+        for name, link_type, linkname in [
+                ("nested/up", tarfile.SYMTYPE, "../../outside"),
+                ("absolute", tarfile.SYMTYPE, "/etc/passwd"),
+                ("hard", tarfile.LNKTYPE, "../outside")]:
+            archive_file = io.BytesIO()
+            with tarfile.open(fileobj=archive_file, mode="w:gz") as archive:
+                member = tarfile.TarInfo(name)
+                member.type = link_type
+                member.linkname = linkname
+                archive.addfile(member)
+
+            for data_filter in [True, False]:
+                target_directory = os.path.join(self.temp_dir.name, "target")
+                with mock.patch.dict(tarfile.__dict__):
+                    if not data_filter:
+                        tarfile.__dict__.pop("data_filter", None)
+                    archive_file.seek(0)
+                    with self.assertRaises(tarfile.TarError):
+                        artifactCache.extractArchive(archive_file,
+                                                     target_directory)
+                shutil.rmtree(target_directory, ignore_errors=True)
+
+        archive_file = io.BytesIO()
+        with tarfile.open(fileobj=archive_file, mode="w:gz") as archive:
+            member = tarfile.TarInfo("nested/link")
+            member.type = tarfile.SYMTYPE
+            member.linkname = "../file.c"
+            archive.addfile(member)
+        archive_file.seek(0)
+        target_directory = os.path.join(self.temp_dir.name, "inside")
+        with mock.patch.dict(tarfile.__dict__):
+            tarfile.__dict__.pop("data_filter", None)
+            artifactCache.extractArchive(archive_file, target_directory)
+        self.assertEqual(os.readlink(os.path.join(target_directory, "nested",
+                                                  "link")), "../file.c")
+
+    # This test confirms that the server refuses names that aren't archive
+    # names, so requests can't reach files outside of its directory
+    def test_invalidName(self):
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            urllib.request.urlopen(self.cache_url + "/..%2Fsecret.tar.gz")
+        self.assertEqual(context.exception.code, 400)
+        context.exception.close()
+
+
+class TestBoardDefaults(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.config_filename = os.path.join(self.temp_dir.name, ".config")
+
+    # This test confirms that the checked in index is up to date and that the
+    # defaults are copied from it without running kconfiglib
+    def test_setLibraryDefaultsFromIndex(self):
+        with mock.patch("kconfigCache.getKconfig") as get_kconfig, \
+                captured_output():
+            fetchSource.setLibraryDefaults("nuvoton", "numaker_iot_m487_wifi",
+                                           self.config_filename)
+            result = fetchSource.setLibraryDefaults("espressif", "esp32",
+                                                    self.config_filename)
+
+        get_kconfig.assert_not_called()
+        self.assertTrue(filecmp.cmp(self.config_filename,
+                                    "testOutputExpected/setLibraryDefaults"))
+        self.assertEqual(result.changed_symbols, ["OTA_ENABLED"])
+
+    # This test confirms that a board whose inputs changed after the index
+    # was built is merged live instead
+    def test_staleIndexEntry(self):
+        index_filename = os.path.join(self.temp_dir.name, "index.json")
+        boardDefaults.buildDefaultsIndex([("espressif", "esp32")],
+                                         index_filename=index_filename)
+        with open(index_filename) as index_file:
+            index = json.load(index_file)
+        self.assertIsNotNone(boardDefaults.lookupDefaults(
+            "espressif", "esp32", index_filename))
+        self.assertIsNone(boardDefaults.lookupDefaults(
+            "pc", "linux", index_filename))
+
+        index["boards"]["espressif/esp32"]["input_hash"] = "stale"
+        with open(index_filename, "w") as index_file:
+            json.dump(index, index_file)
+        self.assertIsNone(boardDefaults.lookupDefaults(
+            "espressif", "esp32", index_filename))
+
+        with mock.patch("boardDefaults.BOARD_DEFAULTS_INDEX",
+                        index_filename), captured_output():
+            fetchSource.setLibraryDefaults("espressif", "esp32",
+                                           self.config_filename)
+        self.assertTrue(filecmp.cmp(self.config_filename,
+                                    "testOutputExpected/setLibraryDefaults"))
+
+
+# Makes the patches of TestBatchMode again in a worker process of runBatch.
+# Workers that are spawned (the default on Windows and macOS) import the
+# modules afresh instead of inheriting them from the test process.
+def initBatchWorker(repository_url, cache_directory):
+    fetchSource.FREERTOS_REPOSITORY_URL = repository_url
+    kconfigCache.KCONFIG_CACHE_DIRECTORY = os.path.join(cache_directory,
+                                                        "kconfig")
+    boardCatalog.BOARD_CATALOG_DIRECTORY = os.path.join(cache_directory,
+                                                        "boards")
+
+
+class TestBatchMode(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+        environment = mock.patch.dict(os.environ,
+                                      benchmark.FIXTURE_GIT_ENVIRONMENT)
+        environment.start()
+        self.addCleanup(environment.stop)
+
+        repository_url = createFreeRTOSFixture(
+            os.path.join(self.temp_dir.name, "remote"))
+        url_patch = mock.patch("fetchSource.FREERTOS_REPOSITORY_URL",
+                               repository_url)
+        url_patch.start()
+        self.addCleanup(url_patch.stop)
+
+        # The workers are always spawned so the tests don't depend on them
+        # inheriting the patches above
+        executor_patch = mock.patch(
+            "concurrent.futures.ProcessPoolExecutor", functools.partial(
+                concurrent.futures.ProcessPoolExecutor,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=initBatchWorker,
+                initargs=(repository_url, cache_temp_dir.name)))
+        executor_patch.start()
+        self.addCleanup(executor_patch.stop)
+
+        self.output_root = os.path.join(self.temp_dir.name, "output")
+
+    # This test confirms that every board of a batch is configured and
+    # fetched into its own output directory, that a preset is merged on top
+    # of the board defaults and that a bad board only fails its own target
+    def test_runBatch(self):
+        preset = os.path.join(self.temp_dir.name, "preset")
+        with open(preset, "w") as preset_file:
+            preset_file.write("# CONFIG_TCP_ENABLED is not set\n")
+
+        with captured_output():
+            results = fetchSource.runBatch(
+                [("espressif", "esp32"), ("nuvoton", "numaker_iot_m487_wifi"),
+                 ("nobody", "nothing")], self.output_root, [preset], jobs=3)
+
+        self.assertEqual([result.error is None for result in results],
+                         [True, True, False])
+
+        esp32_dir = os.path.join(self.output_root, "espressif_esp32")
+        self.assertTrue(os.path.exists(os.path.join(
+            esp32_dir, "libraries/freertos_plus/aws/ota/source.c")))
+        self.assertFalse(os.path.exists(os.path.join(
+            esp32_dir, "libraries/freertos_plus/standard/freertos_plus_tcp")))
+        with open(os.path.join(esp32_dir, "tools/configuration",
+                               "boardChoice.csv")) as board_choice_file:
+            self.assertEqual(board_choice_file.read(), "espressif,esp32")
+        self.assertIn("# CONFIG_MQTT_ENABLED is not set", open(os.path.join(
+            esp32_dir, "tools/configuration/.config")).read())
+
+        nuvoton_dir = os.path.join(self.output_root,
+                                   "nuvoton_numaker_iot_m487_wifi")
+        self.assertFalse(os.path.exists(os.path.join(
+            nuvoton_dir, "libraries/freertos_plus/aws/ota")))
+
+    # This test confirms that --trace writes a Chrome trace with the phases
+    # of every board of a batch
+    def test_traceBatch(self):
+        trace_filename = os.path.join(self.temp_dir.name, "trace.json")
+        with captured_output() as (out, err):
+            exit_code = fetchSource.main(
+                ["--board", "espressif/esp32", "--board",
+                 "nuvoton/numaker_iot_m487_wifi", "--jobs", "1",
+                 "--output-root", self.output_root, "--trace",
+                 trace_filename])
+
+        self.assertEqual(exit_code, 0)
+        self.assertIn("TRACE SUMMARY", out.getvalue())
+        with open(trace_filename) as trace_file:
+            trace_events = json.load(trace_file)["traceEvents"]
+        phases = [event for event in trace_events if event["ph"] == "X"]
+        self.assertEqual([event["name"] for event in phases],
+                         ["setLibraryDefaults", "cloneFreeRTOSRepository",
+                          "updateBoardChosen", "generateConfigHeaders"] * 2)
+
+        # Both boards ran in the same worker but are separate processes of
+        # the trace, and the second one starts after the first one ended
+        names = dict((event["pid"], event["args"]["name"])
+                     for event in trace_events if event["ph"] == "M")
+        self.assertEqual(sorted(names.values()),
+                         ["espressif_esp32", "nuvoton_numaker_iot_m487_wifi"])
+        self.assertEqual(phases[0]["pid"], phases[3]["pid"])
+        self.assertNotEqual(phases[0]["pid"], phases[4]["pid"])
+        self.assertGreaterEqual(phases[4]["ts"],
+                                phases[3]["ts"] + phases[3]["dur"])
+        clone_args = phases[1]["args"]
+        self.assertGreater(clone_args["bytes_received"], 0)
+        self.assertGreater(clone_args["files_written"], 0)
+        self.assertIn("clone_phases", clone_args)
+
+    # This test confirms that boards are only accepted as vendor/board and
+    # that the batch mode needs an output root
+    def test_parseArguments(self):
+        arguments = fetchSource.parseArguments(
+            ["--board", "pc/linux", "--output-root", "out"])
+        self.assertEqual(arguments.boards, [("pc", "linux")])
+        arguments = fetchSource.parseArguments(
+            ["--set", "CONFIG_OTA_ENABLED=n", "--set", "TCP_ENABLED=y"])
+        self.assertEqual(arguments.overrides,
+                         [("OTA_ENABLED", "n"), ("TCP_ENABLED", "y")])
+
+        with captured_output():
+            with self.assertRaises(SystemExit):
+                fetchSource.parseArguments(["--board", "pc"])
+            with self.assertRaises(SystemExit):
+                fetchSource.parseArguments(["--set", "OTA_ENABLED"])
+            with self.assertRaises(SystemExit):
+                fetchSource.parseArguments(["--all-boards"])
+
+    # This test confirms that a batch without boards returns without starting
+    # any workers
+    def test_runBatchWithoutBoards(self):
+        with captured_output():
+            results = fetchSource.runBatch([], self.output_root)
+        self.assertEqual(results, [])
+
+    # This test confirms that all boards are found in the vendors directory
+    def test_getAllBoards(self):
+        boards = fetchSource.getAllBoards()
+
+        self.assertEqual(len(boards), 19)
+        self.assertIn(("ti", "stm32l475_discovery"), boards)
+
+
+class TestSpeculativeFetch(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+        environment = mock.patch.dict(os.environ,
+                                      benchmark.FIXTURE_GIT_ENVIRONMENT)
+        environment.start()
+        self.addCleanup(environment.stop)
+
+        repository_url = createFreeRTOSFixture(
+            os.path.join(self.temp_dir.name, "remote"))
+        for name, value in [("FREERTOS_REPOSITORY_URL", repository_url),
+                            ("STAGING_DIRECTORY_PREFIX",
+                             os.path.join(self.temp_dir.name, "staging-"))]:
+            patch = mock.patch("fetchSource." + name, value)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.config_filename = os.path.join(self.temp_dir.name, ".config")
+        with open(self.config_filename, "w") as config_file:
+            config_file.write("CONFIG_OTA_ENABLED=y\n")
+
+    # This test confirms that the core is fetched before the libraries are
+    # known, that the enabled libraries are added afterwards and that the
+    # result ends up in the output directory
+    def test_speculativeFetch(self):
+        output_dir = os.path.join(self.temp_dir.name, "output")
+        speculative_fetch = fetchSource.SpeculativeFetch().start()
+        speculative_fetch.addLibraries(self.config_filename)
+        with captured_output():
+            phase_stats = speculative_fetch.finish(output_dir)
+
+        self.assertIsNone(speculative_fetch.error)
+        self.assertEqual([stats.name for stats in phase_stats],
+                         ["init", "fetch", "checkout", "libraries",
+                          "submodules"])
+        self.assertFalse(os.path.exists(speculative_fetch.staging_directory))
+        self.assertTrue(os.path.exists(os.path.join(
+            output_dir, "libraries/freertos_plus/aws/ota/source.c")))
+        self.assertTrue(os.path.exists(os.path.join(
+            output_dir, "libraries/3rdparty/tinycbor/src/tinycbor.c")))
+        self.assertFalse(os.path.exists(os.path.join(
+            output_dir, "libraries/c_sdk/standard/mqtt")))
+        self.assertEqual(subprocess.run(["git", "status", "--porcelain"],
+                                        cwd=output_dir, stdout=subprocess.PIPE,
+                                        universal_newlines=True).stdout, "")
+
+    # This test confirms that cancelling removes the staging repository
+    def test_cancel(self):
+        speculative_fetch = fetchSource.SpeculativeFetch().start()
+        speculative_fetch.cancel()
+
+        self.assertFalse(os.path.exists(speculative_fetch.staging_directory))
+
+    # This test confirms that cancelling kills a fetch that is still
+    # downloading instead of waiting for it, here from a server that
+    # accepts the connection and never answers
+    def test_cancelDuringFetch(self):
+        server = socket.socket()
+        self.addCleanup(server.close)
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        url = "git://127.0.0.1:%d/amazon-freertos" % server.getsockname()[1]
+
+        with mock.patch("fetchSource.FREERTOS_REPOSITORY_URL", url):
+            speculative_fetch = fetchSource.SpeculativeFetch().start()
+            server.settimeout(30)
+            connection = server.accept()[0]
+            self.addCleanup(connection.close)
+            start_time = time.monotonic()
+            speculative_fetch.cancel()
+
+        self.assertLess(time.monotonic() - start_time,
+                        fetchSource.CANCEL_TIMEOUT)
+        self.assertFalse(speculative_fetch._thread.is_alive())
+        self.assertIsInstance(speculative_fetch.error, gitUtils.GitCancelled)
+        self.assertFalse(os.path.exists(speculative_fetch.staging_directory))
+
+    # This test confirms that finishing into an interrupted clone resumes it
+    # without waiting for the speculative fetch, here one from a server that
+    # accepts the connection and never answers
+    def test_finishInterruptedClone(self):
+        output_dir = os.path.join(self.temp_dir.name, "output")
+        with captured_output():
+            fetchSource.cloneFreeRTOSRepository(output_dir,
+                                                self.config_filename)
+        os.remove(fetchSource.getFetchedConfigFilename(output_dir))
+        self.assertTrue(fetchSource.hasInterruptedClone(output_dir))
+
+        server = socket.socket()
+        self.addCleanup(server.close)
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        url = "git://127.0.0.1:%d/amazon-freertos" % server.getsockname()[1]
+
+        with mock.patch("fetchSource.FREERTOS_REPOSITORY_URL", url):
+            speculative_fetch = fetchSource.SpeculativeFetch().start()
+            speculative_fetch.addLibraries(self.config_filename)
+            server.settimeout(30)
+            connection = server.accept()[0]
+            self.addCleanup(connection.close)
+        with captured_output():
+            speculative_fetch.finish(output_dir)
+
+        self.assertFalse(speculative_fetch._thread.is_alive())
+        self.assertFalse(os.path.exists(speculative_fetch.staging_directory))
+        self.assertFalse(fetchSource.hasInterruptedClone(output_dir))
+        self.assertTrue(os.path.exists(os.path.join(
+            output_dir, "libraries/freertos_plus/aws/ota/source.c")))
+
+    # This test confirms that a failed speculative fetch falls back to a
+    # normal clone
+    def test_fallbackAfterFailure(self):
+        output_dir = os.path.join(self.temp_dir.name, "output")
+        with mock.patch("fetchSource.FREERTOS_REPOSITORY_URL",
+                        "file:///nonexistent"), \
+                mock.patch("gitUtils.RETRY_BACKOFF", 0):
+            speculative_fetch = fetchSource.SpeculativeFetch().start()
+            speculative_fetch.addLibraries(self.config_filename)
+            speculative_fetch._thread.join()
+        self.assertIsNotNone(speculative_fetch.error)
+
+        with captured_output():
+            speculative_fetch.finish(output_dir)
+        self.assertTrue(os.path.exists(os.path.join(
+            output_dir, "libraries/freertos_plus/aws/ota/source.c")))
+
+    # This test confirms that a staging repository that can't be moved into
+    # the output directory is deleted and the repository is cloned instead
+    def test_fallbackAfterFailedMove(self):
+        output_dir = os.path.join(self.temp_dir.name, "output")
+        speculative_fetch = fetchSource.SpeculativeFetch().start()
+        speculative_fetch.addLibraries(self.config_filename)
+        with mock.patch("shutil.move", side_effect=OSError("no space")), \
+                captured_output() as (out, err):
+            speculative_fetch.finish(output_dir)
+
+        self.assertIn("no space", err.getvalue())
+        self.assertFalse(os.path.exists(speculative_fetch.staging_directory))
+        self.assertTrue(os.path.exists(os.path.join(
+            output_dir, "libraries/freertos_plus/aws/ota/source.c")))
+
+    # This test confirms that starting deletes the staging directories of
+    # processes that are gone and keeps the ones of running processes
+    def test_removeStaleStagingDirectories(self):
+        process = subprocess.Popen(["true"])
+        process.wait()
+        stale_directory = fetchSource.STAGING_DIRECTORY_PREFIX + \
+            str(process.pid)
+        running_directory = fetchSource.STAGING_DIRECTORY_PREFIX + \
+            str(os.getppid())
+        for directory in [stale_directory, running_directory]:
+            os.makedirs(os.path.join(directory, ".git"))
+
+        speculative_fetch = fetchSource.SpeculativeFetch().start()
+        speculative_fetch.cancel()
+
+        self.assertFalse(os.path.exists(stale_directory))
+        self.assertTrue(os.path.exists(running_directory))
+
+
+class TestMirrorCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    # Creates a fake mirror of "size" bytes that was last used at "last_used"
+    def createMirror(self, name, size, last_used):
+        mirror_directory = os.path.join(self.temp_dir.name, name + ".git")
+        os.makedirs(mirror_directory)
+        with open(os.path.join(mirror_directory, "pack"), "wb") as pack_file:
+            pack_file.write(b"\0" * size)
+        mirrorCache.markMirrorUsed(mirror_directory)
+        os.utime(os.path.join(mirror_directory,
+                              mirrorCache.LAST_USED_FILENAME),
+                 (last_used, last_used))
+        return mirror_directory
+
+    # This test confirms that the least recently used mirrors are evicted
+    # first, that mirrors in use are kept and that eviction stops as soon as
+    # the cache fits in the size limit
+    def test_evictMirrors(self):
+        oldest = self.createMirror("oldest", 1000, 100)
+        in_use = self.createMirror("in_use", 1000, 200)
+        older = self.createMirror("older", 1000, 300)
+        newest = self.createMirror("newest", 1000, 400)
+
+        evicted = mirrorCache.evictMirrors(self.temp_dir.name, 2500,
+                                           keep=[in_use])
+
+        self.assertEqual(evicted, [oldest, older])
+        self.assertTrue(os.path.isdir(in_use))
+        self.assertTrue(os.path.isdir(newest))
+
+    # This test confirms that mirrors another process holds the lock of, or
+    # used too recently to be done with, aren't evicted
+    def test_evictMirrorsInUse(self):
+        locked = self.createMirror("locked", 1000, 100)
+        recent = self.createMirror("recent", 1000, time.time())
+        unused = self.createMirror("unused", 1000, 200)
+
+        with mirrorCache.lockMirror(locked) as taken:
+            self.assertTrue(taken)
+            evicted = mirrorCache.evictMirrors(self.temp_dir.name, 0)
+
+        self.assertEqual(evicted, [unused])
+        self.assertTrue(os.path.isdir(locked))
+        self.assertTrue(os.path.isdir(recent))
+        self.assertFalse(os.path.exists(locked + ".lock"))
+
+    # This test confirms that different urls get different mirrors
+    def test_getMirrorDirectory(self):
+        first = mirrorCache.getMirrorDirectory(
+            "https://github.com/a/amazon-freertos.git", "cache")
+        second = mirrorCache.getMirrorDirectory(
+            "https://example.com/a/amazon-freertos.git", "cache")
+
+        self.assertNotEqual(first, second)
+        self.assertTrue(os.path.basename(first).startswith("amazon-freertos-"))
+
+    # This test confirms that relative submodule urls are resolved against the
+    # url of the superproject before they are mirrored
+    def test_resolveSubmoduleUrl(self):
+        superproject_url = "https://github.com/aws/amazon-freertos.git"
+        self.assertEqual(
+            fetchSource.resolveSubmoduleUrl("../mbedtls.git",
+                                            superproject_url),
+            "https://github.com/aws/mbedtls.git")
+        self.assertEqual(
+            fetchSource.resolveSubmoduleUrl("../../ARMmbed/mbedtls.git",
+                                            superproject_url),
+            "https://github.com/ARMmbed/mbedtls.git")
+        self.assertEqual(
+            fetchSource.resolveSubmoduleUrl("../mbedtls.git",
+                                            "git@github.com:amazon.git"),
+            "git@github.com:mbedtls.git")
+        self.assertEqual(
+            fetchSource.resolveSubmoduleUrl("file:///tmp/mbedtls",
+                                            superproject_url),
+            "file:///tmp/mbedtls")
+
+
+class TestMergeConfig(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        kconfigCache.clearKconfigCache()
+        self.addCleanup(kconfigCache.clearKconfigCache)
+
+    # This test confirms that mergeConfig writes the same .config that
+    # running merge_config.py used to and reports the symbols it changed
+    def test_mergeConfig(self):
+        merged_config = os.path.join(self.temp_dir.name, ".config")
+        kconf = merge_config.parseKconfig("KConfig")
+
+        result = merge_config.mergeConfig(
+            kconf, merged_config, ["../vendors/nuvoton/numaker_iot_m487_wifi" +
+                                   "/KConfig"])
+
+        self.assertTrue(filecmp.cmp(merged_config,
+                                    "testOutputExpected/setLibraryDefaults2"))
+        self.assertEqual(result.changed_symbols,
+                         ["MQTT_ENABLED", "OTA_ENABLED", "TCP_ENABLED"])
+        self.assertEqual(result.warnings, [])
+
+        # Merging another board with the same Kconfig object only changes the
+        # symbols that differ between the boards
+        result = merge_config.mergeConfig(
+            kconf, merged_config, ["../vendors/espressif/esp32/KConfig"])
+
+        self.assertTrue(filecmp.cmp(merged_config,
+                                    "testOutputExpected/setLibraryDefaults"))
+        self.assertEqual(result.changed_symbols, ["OTA_ENABLED"])
+
+    # This test confirms that every Kconfig object has one merge lock, which
+    # goes away together with the object
+    def test_getMergeLock(self):
+        # Trees of earlier tests that are only waiting for the collector
+        gc.collect()
+        kconf = merge_config.parseKconfig("KConfig")
+        merge_lock = merge_config.getMergeLock(kconf)
+        self.assertIs(merge_config.getMergeLock(kconf), merge_lock)
+        lock_count = len(merge_config._merge_locks)
+
+        del kconf
+        gc.collect()
+        self.assertEqual(len(merge_config._merge_locks), lock_count - 1)
+
+    # This test confirms that repeating a merge with unchanged inputs reuses
+    # the memoized result without touching the .config, and that changing a
+    # fragment merges again
+    def test_mergeMemo(self):
+        merged_config = os.path.join(self.temp_dir.name, ".config")
+        fragment = os.path.join(self.temp_dir.name, "fragment")
+        with open(fragment, "w") as fragment_file:
+            fragment_file.write("CONFIG_OTA_ENABLED=y\n")
+
+        cache_patch = mock.patch("kconfigCache.KCONFIG_CACHE_DIRECTORY",
+                                 os.path.join(self.temp_dir.name, "cache"))
+        cache_patch.start()
+        self.addCleanup(cache_patch.stop)
+
+        kconfigCache.mergeConfig("KConfig", None, merged_config, [fragment])
+        old_mtime = os.stat(merged_config).st_mtime_ns
+
+        # A new process only finds the memo on disk
+        kconfigCache.clearKconfigCache()
+        with mock.patch("merge_config.mergeConfig") as merge, \
+                mock.patch("merge_config.parseKconfig") as parse:
+            result = kconfigCache.mergeConfig("KConfig", None, merged_config,
+                                              [fragment])
+        merge.assert_not_called()
+        parse.assert_not_called()
+        self.assertEqual(result.messages, [
+            "No change to configuration in '%s'" % merged_config])
+        self.assertEqual(result.changed_symbols, [])
+        self.assertEqual(os.stat(merged_config).st_mtime_ns, old_mtime)
+
+        with open(fragment, "a") as fragment_file:
+            fragment_file.write("CONFIG_TCP_ENABLED=y\n")
+        result = kconfigCache.mergeConfig("KConfig", None, merged_config,
+                                          [fragment])
+        self.assertEqual(result.changed_symbols, ["TCP_ENABLED"])
+        self.assertIn("CONFIG_TCP_ENABLED=y", open(merged_config).read())
+
+    # This test confirms that writeFileIfChanged leaves a file with the same
+    # contents alone
+    def test_writeFileIfChanged(self):
+        filename = os.path.join(self.temp_dir.name, "boardChoice.csv")
+        self.assertTrue(fetchSource.writeFileIfChanged(filename, "pc,linux"))
+        self.assertFalse(fetchSource.writeFileIfChanged(filename, "pc,linux"))
+        self.assertTrue(fetchSource.writeFileIfChanged(filename,
+                                                       "pc,windows"))
+        with open(filename) as board_choice_file:
+            self.assertEqual(board_choice_file.read(), "pc,windows")
+
+    # This test confirms that a Kconfig tree is parsed once and reused for
+    # any tree with the same files, and parsed again once a file changes
+    def test_getKconfig(self):
+        srctree = os.path.join(self.temp_dir.name, "configuration")
+        os.makedirs(srctree)
+        with open("KConfig") as source_file, \
+                open(os.path.join(srctree, "KConfig"), "w") as copy_file:
+            copy_file.write(source_file.read())
+
+        kconf = kconfigCache.getKconfig("KConfig")
+
+        self.assertIs(kconfigCache.getKconfig("KConfig"), kconf)
+        self.assertIs(kconfigCache.getKconfig("KConfig", srctree), kconf)
+
+        with open(os.path.join(srctree, "KConfig"), "a") as copy_file:
+            copy_file.write("\nconfig EXTRA_ENABLED\n    bool\n")
+        self.assertIsNot(kconfigCache.getKconfig("KConfig", srctree), kconf)
+
+    # This test confirms that a tree parsed by an earlier process is loaded
+    # from the on disk cache without parsing, and that the cache is
+    # invalidated when a sourced file changes
+    def test_diskCache(self):
+        srctree = os.path.join(self.temp_dir.name, "configuration")
+        os.makedirs(os.path.join(srctree, "libraries"))
+        with open(os.path.join(srctree, "KConfig"), "w") as kconfig_file:
+            kconfig_file.write('source "libraries/Kconfig"\n')
+        with open(os.path.join(srctree, "libraries", "Kconfig"), "w") as \
+                kconfig_file:
+            kconfig_file.write("config MQTT_ENABLED\n    bool\n")
+
+        cache_patch = mock.patch("kconfigCache.KCONFIG_CACHE_DIRECTORY",
+                                 os.path.join(self.temp_dir.name, "cache"))
+        cache_patch.start()
+        self.addCleanup(cache_patch.stop)
+
+        kconfigCache.getKconfig("KConfig", srctree)
+        kconfigCache.clearKconfigCache()
+        with mock.patch("merge_config.parseKconfig") as parse:
+            kconf = kconfigCache.getKconfig("KConfig", srctree)
+        parse.assert_not_called()
+        self.assertIn("MQTT_ENABLED", kconf.syms)
+
+        with open(os.path.join(srctree, "libraries", "Kconfig"), "a") as \
+                kconfig_file:
+            kconfig_file.write("config OTA_ENABLED\n    bool\n")
+        kconfigCache.clearKconfigCache()
+        kconf = kconfigCache.getKconfig("KConfig", srctree)
+        self.assertIn("OTA_ENABLED", kconf.syms)
+        self.assertEqual(kconf._srctree_prefix,
+                         os.path.realpath(srctree) + os.sep)
+
+    # This test confirms that a file matched by a glob of a source statement
+    # invalidates the on disk cache when it is added, although none of the
+    # files the tree sourced changed
+    def test_diskCacheGlob(self):
+        srctree = os.path.join(self.temp_dir.name, "configuration")
+        os.makedirs(os.path.join(srctree, "libraries", "mqtt"))
+        with open(os.path.join(srctree, "KConfig"), "w") as kconfig_file:
+            kconfig_file.write('osource "libraries/*/Kconfig"\n')
+        with open(os.path.join(srctree, "libraries", "mqtt", "Kconfig"),
+                  "w") as kconfig_file:
+            kconfig_file.write("config MQTT_ENABLED\n    bool\n")
+
+        cache_patch = mock.patch("kconfigCache.KCONFIG_CACHE_DIRECTORY",
+                                 os.path.join(self.temp_dir.name, "cache"))
+        cache_patch.start()
+        self.addCleanup(cache_patch.stop)
+
+        kconfigCache.getKconfig("KConfig", srctree)
+        os.makedirs(os.path.join(srctree, "libraries", "ota"))
+        with open(os.path.join(srctree, "libraries", "ota", "Kconfig"),
+                  "w") as kconfig_file:
+            kconfig_file.write("config OTA_ENABLED\n    bool\n")
+        kconfigCache.clearKconfigCache()
+        self.assertIsNone(kconfigCache.getCurrentTreeHash("KConfig", srctree))
+        kconf = kconfigCache.getKconfig("KConfig", srctree)
+        self.assertIn("MQTT_ENABLED", kconf.syms)
+        self.assertIn("OTA_ENABLED", kconf.syms)
+
+
+class TestPhaseTrace(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    # This test confirms that a phase records its time, the child processes
+    # it ran and the files it added to a repository (apart from .git)
+    def test_phase(self):
+        repo_directory = os.path.join(self.temp_dir.name, "repo")
+        os.makedirs(os.path.join(repo_directory, ".git"))
+        tracer = phaseTrace.PhaseTracer()
+
+        with tracer.phase("write", repo_directory) as trace_args:
+            subprocess.run(["true"])
+            with open(os.path.join(repo_directory, ".git", "object"),
+                      "w") as object_file:
+                object_file.write("x" * 100)
+            with open(os.path.join(repo_directory, "source.c"), "w") as \
+                    source_file:
+                source_file.write("x" * 10)
+            trace_args["extra"] = 1
+
+        event = tracer.getTraceEvents()[-1]
+        self.assertEqual(event["name"], "write")
+        self.assertEqual(event["ph"], "X")
+        self.assertGreaterEqual(event["dur"], 0)
+        self.assertEqual(event["args"]["bytes_received"], 100)
+        self.assertEqual(event["args"]["files_written"], 1)
+        self.assertEqual(event["args"]["bytes_written"], 10)
+        self.assertEqual(event["args"]["extra"], 1)
+        self.assertIn("child_cpu_seconds", event["args"])
+
+    # This test confirms that the bytes received by a worktree are measured
+    # in the git directory its .git file points at
+    def test_phaseWorktree(self):
+        repo_directory = os.path.join(self.temp_dir.name, "worktree")
+        git_directory = os.path.join(self.temp_dir.name, "store")
+        os.makedirs(repo_directory)
+        os.makedirs(git_directory)
+        with open(os.path.join(repo_directory, ".git"), "w") as git_file:
+            git_file.write("gitdir: ../store\n")
+        tracer = phaseTrace.PhaseTracer()
+
+        with tracer.phase("write", repo_directory):
+            with open(os.path.join(git_directory, "object"),
+                      "w") as object_file:
+                object_file.write("x" * 100)
+            with open(os.path.join(repo_directory, "source.c"), "w") as \
+                    source_file:
+                source_file.write("x" * 10)
+
+        event = tracer.getTraceEvents()[-1]
+        self.assertEqual(event["args"]["bytes_received"], 100)
+        self.assertEqual(event["args"]["files_written"], 1)
+        self.assertEqual(event["args"]["bytes_written"], 10)
+
+    # This test confirms that a disabled tracer records nothing
+    def test_disabledTracer(self):
+        tracer = phaseTrace.PhaseTracer(enabled=False)
+        with tracer.phase("nothing", self.temp_dir.name):
+            pass
+        self.assertEqual(tracer.getTraceEvents(), [])
+
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    # This test confirms that the benchmark suite runs offline against a
+    # small synthetic tree and repository and that its results are saved
+    # under the name of the commit
+    def test_runBenchmarks(self):
+        with captured_output():
+            results = benchmark.runBenchmarks([10], 2, 100, 100, 1)
+
+        self.assertEqual(len(results), 1)
+        self.assertEqual(set(results[0]),
+                         {"symbols", "merge_cold", "merge_warm", "merge_hot",
+                          "find_kconfig_files", "clone", "board_merge_cold",
+                          "board_merge_hot"})
+        self.assertGreater(results[0]["clone"], 0)
+
+        results_filename = benchmark.saveResults(results, {},
+                                                 self.temp_dir.name)
+        with open(results_filename) as results_file:
+            saved = json.load(results_file)
+        self.assertEqual(saved["results"], results)
+        self.assertEqual(os.path.basename(results_filename),
+                         saved["commit"] + ".json")
+
+
+class TestLibraryManifest(unittest.TestCase):
+    # This test confirms that the libraries needed by the enabled ones,
+    # through "depends on", "select" or the "requires" of the manifest, are
+    # added transitively
+    def test_getLibraryClosure(self):
+        with tempfile.TemporaryDirectory() as srctree:
+            with open(os.path.join(srctree, "KConfig"), "w") as kconfig_file:
+                kconfig_file.write("config OTA_ENABLED\n"
+                                   "    bool\n"
+                                   "    depends on MQTT_ENABLED\n"
+                                   "config MQTT_ENABLED\n"
+                                   "    bool\n"
+                                   "    select TCP_ENABLED\n"
+                                   "config TCP_ENABLED\n"
+                                   "    bool\n"
+                                   "config WIFI_ENABLED\n"
+                                   "    bool\n"
+                                   "config OTHER\n"
+                                   "    bool\n")
+            kconf = merge_config.parseKconfig("KConfig", srctree)
+
+        def getEntry(requires=()):
+            return {"paths": [], "bytes": None, "submodules": {},
+                    "requires": list(requires)}
+        manifest = {"core": getEntry(),
+                    "libraries": {"OTA_ENABLED": getEntry(),
+                                  "MQTT_ENABLED": getEntry(),
+                                  "TCP_ENABLED": getEntry(["WIFI_ENABLED"]),
+                                  "WIFI_ENABLED": getEntry()}}
+
+        self.assertEqual(libraryManifest.getLibraryClosure(
+            {"OTA_ENABLED", "OTHER"}, kconf, manifest),
+            {"OTA_ENABLED", "MQTT_ENABLED", "TCP_ENABLED", "WIFI_ENABLED"})
+        self.assertEqual(libraryManifest.getLibraryClosure(
+            {"WIFI_ENABLED"}, kconf, manifest), {"WIFI_ENABLED"})
+        self.assertIsNone(libraryManifest.estimateDownloadSize(
+            {"WIFI_ENABLED"}, manifest))
+
+    # This test confirms that every library with directories in
+    # LIBRARY_PATHS is a symbol of KConfig, which a configuration can enable
+    def test_libraryPathsInKconfig(self):
+        kconf = merge_config.parseKconfig("KConfig",
+                                          fetchSource.SOURCE_DIRECTORY)
+        for library in fetchSource.LIBRARY_PATHS:
+            self.assertIn(library, kconf.syms)
+
+
+class TestConfigHeaders(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+        self.srctree = os.path.join(self.temp_dir.name, "configuration")
+        os.makedirs(os.path.join(self.srctree, "libraries"))
+        with open(os.path.join(self.srctree, "KConfig"), "w") as kconfig_file:
+            kconfig_file.write('config TCP_ENABLED\n    bool "tcp"\n'
+                               'source "libraries/ota_Kconfig"\n')
+        with open(os.path.join(self.srctree, "libraries", "ota_Kconfig"),
+                  "w") as kconfig_file:
+            kconfig_file.write('config OTA_ENABLED\n    bool "ota"\n'
+                               'config OTA_BUFFER\n    int "buffer"\n'
+                               '    default 64\n')
+        self.kconf = merge_config.parseKconfig("KConfig", self.srctree)
+        self.config_filename = os.path.join(self.srctree, ".config")
+
+    # Writes a .config with the given lines
+    def writeConfig(self, lines):
+        with open(self.config_filename, "w") as config_file:
+            config_file.write("".join(line + "\n" for line in lines))
+
+    # This test confirms that the headers hold the symbols of their Kconfig
+    # file, that only the headers and dependency files of changed symbols
+    # are touched and that headers it didn't write are left alone
+    def test_generateHeaders(self):
+        def header(name):
+            return os.path.join(self.srctree, name)
+
+        with open(header("board_config.h"), "w") as board_header:
+            board_header.write("#define BOARD_ENABLED 1\n")
+        self.writeConfig(["CONFIG_TCP_ENABLED=y", "CONFIG_OTA_ENABLED=y",
+                          "CONFIG_OTA_BUFFER=64"])
+        changed_headers = configHeaders.generateHeaders(
+            self.kconf, self.config_filename, self.srctree)
+
+        self.assertEqual(sorted(changed_headers),
+                         [header("KConfig.h"), header("kconfig_config.h"),
+                          header("ota_config.h")])
+        with open(header("ota_config.h")) as header_file:
+            ota_header = header_file.read()
+        self.assertIn("#define CONFIG_OTA_ENABLED 1\n", ota_header)
+        self.assertIn("#define CONFIG_OTA_BUFFER 64\n", ota_header)
+        self.assertNotIn("TCP_ENABLED", ota_header)
+        self.assertTrue(os.path.exists(header("board_config.h")))
+
+        self.assertEqual(configHeaders.generateHeaders(
+            self.kconf, self.config_filename, self.srctree), [])
+        for dependency in ["deps/ota/buffer.h", "deps/tcp/enabled.h"]:
+            os.utime(header(dependency), (0, 0))
+
+        self.writeConfig(["CONFIG_TCP_ENABLED=y", "CONFIG_OTA_ENABLED=y",
+                          "CONFIG_OTA_BUFFER=128"])
+        changed_headers = configHeaders.generateHeaders(
+            self.kconf, self.config_filename, self.srctree)
+        self.assertEqual(sorted(changed_headers),
+                         [header("KConfig.h"), header("ota_config.h")])
+        self.assertNotEqual(os.stat(header("deps/ota/buffer.h")).st_mtime, 0)
+        self.assertEqual(os.stat(header("deps/tcp/enabled.h")).st_mtime, 0)
+
+    # This test confirms that a header with the name of a generated one that
+    # was written by hand is left alone
+    def test_keepHandWrittenHeader(self):
+        ota_header = os.path.join(self.srctree, "ota_config.h")
+        with open(ota_header, "w") as header_file:
+            header_file.write("#define OTA_BUFFER 32\n")
+        self.writeConfig(["CONFIG_OTA_ENABLED=y"])
+        with captured_output() as (out, err):
+            changed_headers = configHeaders.generateHeaders(
+                self.kconf, self.config_filename, self.srctree)
+
+        self.assertNotIn(ota_header, changed_headers)
+        self.assertIn(ota_header, err.getvalue())
+        with open(ota_header) as header_file:
+            self.assertEqual(header_file.read(), "#define OTA_BUFFER 32\n")
+
+
+class TestLibrarySelector(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+        with open(os.path.join(self.temp_dir.name, "KConfig"),
+                  "w") as kconfig_file:
+            kconfig_file.write('config TCP_ENABLED\n    bool "tcp"\n'
+                               'config OTA_ENABLED\n    bool "ota"\n'
+                               '    depends on TCP_ENABLED\n')
+        self.kconf = merge_config.parseKconfig("KConfig", self.temp_dir.name)
+        self.config_filename = os.path.join(self.temp_dir.name, ".config")
+        with open(self.config_filename, "w") as config_file:
+            config_file.write("CONFIG_TCP_ENABLED=y\n")
+
+    # Returns: the lines of the saved .config that set a symbol
+    def readConfig(self):
+        with open(self.config_filename) as config_file:
+            return [line.strip() for line in config_file
+                    if line.startswith(("CONFIG_", "# CONFIG_"))]
+
+    # This test confirms that overrides are applied without any prompts and
+    # that the .config is written like guiconfig writes it
+    def test_overrides(self):
+        with captured_output():
+            librarySelector.selectLibraries(
+                self.kconf, self.config_filename,
+                [librarySelector.parseOverride("CONFIG_OTA_ENABLED=y")],
+                interactive=False)
+        self.assertEqual(self.readConfig(),
+                         ["CONFIG_TCP_ENABLED=y", "CONFIG_OTA_ENABLED=y"])
+
+        with open(self.config_filename) as config_file:
+            selector_config = config_file.read()
+        self.kconf.load_config(self.config_filename)
+        self.kconf.write_config(self.config_filename)
+        with open(self.config_filename) as config_file:
+            self.assertEqual(config_file.read(), selector_config)
+
+        with self.assertRaises(ValueError):
+            librarySelector.selectLibraries(
+                self.kconf, self.config_filename, [("MISSING", "y")],
+                interactive=False)
+
+    # This test confirms that a number toggles a symbol, that 's' saves, that
+    # 'q' leaves the .config as it was and that the Kconfig object isn't
+    # locked while the user is choosing
+    @mock.patch('builtins.input')
+    def test_interactive(self, mocked_input):
+        answers = iter(["3", "OTA_ENABLED=x", "1", "s", "2", "q"])
+
+        def answer(prompt):
+            self.assertFalse(merge_config.getMergeLock(self.kconf).locked())
+            return next(answers)
+        mocked_input.side_effect = answer
+
+        with captured_output() as (out, err):
+            librarySelector.selectLibraries(self.kconf, self.config_filename)
+        self.assertIn("Please enter a valid number", out.getvalue())
+        self.assertIn("invalid value 'x' for OTA_ENABLED", out.getvalue())
+        self.assertEqual(self.readConfig(),
+                         ["# CONFIG_TCP_ENABLED is not set"])
+
+        with captured_output():
+            self.assertIsNone(librarySelector.selectLibraries(
+                self.kconf, self.config_filename))
+        self.assertEqual(self.readConfig(),
+                         ["# CONFIG_TCP_ENABLED is not set"])
+
+
+class TestBoardCatalog(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.addCleanup(boardCatalog.clearBoardCatalogs)
+
+        self.vendors_directory = os.path.join(self.temp_dir.name, "vendors")
+        self.writeDefaults("pc", "linux", ["CONFIG_OTA_ENABLED=y"])
+        self.writeDefaults("espressif", "esp32", ["CONFIG_MQTT_ENABLED=y",
+                                                  "CONFIG_TCP_ENABLED=y"])
+        self.manifest = fetchSource.getLibraryManifest()
+
+    # Writes the defaults of a board
+    def writeDefaults(self, vendor, board, lines):
+        board_directory = os.path.join(self.vendors_directory, vendor, board)
+        os.makedirs(board_directory, exist_ok=True)
+        with open(os.path.join(board_directory, "KConfig"),
+                  "w") as defaults_file:
+            defaults_file.write("".join(line + "\n" for line in lines))
+
+    def loadCatalog(self):
+        return boardCatalog.loadBoardCatalog(self.vendors_directory,
+                                             self.manifest)
+
+    # This test confirms that the catalog lists the boards of the vendors
+    # directory sorted by vendor with the libraries their defaults enable
+    def test_loadBoardCatalog(self):
+        catalog = self.loadCatalog()
+
+        self.assertEqual(list(catalog), ["espressif", "pc"])
+        esp32 = catalog["espressif"]["esp32"]
+        self.assertEqual(esp32.enabled_libraries,
+                         ["MQTT_ENABLED", "TCP_ENABLED"])
+        self.assertEqual(esp32.defaults_filename, os.path.join(
+            self.vendors_directory, "espressif", "esp32", "KConfig"))
+        self.assertEqual(catalog["pc"]["linux"].enabled_libraries,
+                         ["OTA_ENABLED"])
+
+    # This test confirms that an unchanged catalog is loaded from the cache
+    # without being rebuilt, and that adding or editing a board rebuilds it
+    def test_invalidation(self):
+        self.loadCatalog()
+        boardCatalog.clearBoardCatalogs()
+        with mock.patch("boardCatalog.buildBoardCatalog") as build:
+            self.loadCatalog()
+        build.assert_not_called()
+
+        self.writeDefaults("pc", "windows", ["CONFIG_TCP_ENABLED=y"])
+        self.assertEqual(list(self.loadCatalog()["pc"]), ["linux", "windows"])
+
+        defaults_filename = os.path.join(self.vendors_directory, "pc",
+                                         "linux", "KConfig")
+        self.writeDefaults("pc", "linux", ["CONFIG_WIFI_ENABLED=y"])
+        os.utime(defaults_filename, ns=(0, 0))
+        self.assertEqual(self.loadCatalog()["pc"]["linux"].enabled_libraries,
+                         [])
+
+    # This test confirms that the menus get every vendor and board of the
+    # vendors directory, including ones that a hand written list missed
+    def test_getBoardsDict(self):
+        boards_dict = fetchSource.getBoardsDict()
+
+        self.assertEqual(len(boards_dict), 14)
+        self.assertEqual(boards_dict["ti"], ["stm32l475_discovery"])
+        self.assertEqual(boards_dict["pc"], ["linux", "windows"])
+
+
+class TestDirectoryIndex(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.addCleanup(directoryIndex.clearDirectoryIndexes)
+
+    # This test confirms that there is one index per tree, that it only lists
+    # the directories that are looked up, matches files like glob does and
+    # lists a directory again once it changed
+    def test_findFiles(self):
+        board_directory = os.path.join(self.temp_dir.name, "esp32")
+        os.makedirs(os.path.join(board_directory, "Kconfig.d"))
+        for filename in ["Kconfig", "mqtt_Kconfig", ".hidden_Kconfig",
+                         "README"]:
+            open(os.path.join(board_directory, filename), "w").close()
+
+        vendors_index = directoryIndex.getDirectoryIndex(self.temp_dir.name)
+        self.assertIs(directoryIndex.getDirectoryIndex(self.temp_dir.name),
+                      vendors_index)
+        self.assertEqual(vendors_index.findFiles("esp32", "*Kconfig"),
+                         ["Kconfig", "mqtt_Kconfig"])
+        self.assertEqual(vendors_index.findFiles("missing", "*Kconfig"), [])
+        self.assertEqual(list(vendors_index._directories), ["esp32"])
+
+        # Pretend the directory changed a second later so coarse file system
+        # timestamps can't hide the change
+        open(os.path.join(board_directory, "ota_Kconfig"), "w").close()
+        stat = os.stat(board_directory)
+        os.utime(board_directory, ns=(stat.st_atime_ns,
+                                      stat.st_mtime_ns + 1000000000))
+        self.assertEqual(vendors_index.findFiles("esp32", "*Kconfig"),
+                         ["Kconfig", "mqtt_Kconfig", "ota_Kconfig"])
+
+
 if __name__ == '__main__':
     unittest.main()
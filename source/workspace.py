@@ -0,0 +1,128 @@
+import os
+
+from gitUtils import runGit, runGitWithRetry, getGitDirectory, isMissingRef
+from gitUtils import getDepthArguments
+import mirrorCache
+
+
+# A workspace lets the checkouts of several boards on one host share their
+# downloads. It holds one bare, blobless store of the FreeRTOS repository and
+# one like it per submodule. Every checkout is a git worktree of the store
+# with its own sparse checkout, HEAD and .config, and the submodules of every
+# checkout are worktrees of the submodule stores. Adding a board
+# only downloads the blobs of directories that no other checkout of the
+# workspace has checked out yet, and what its working tree holds. Unlike the
+# mirror cache the stores are never evicted, the checkouts depend on them.
+
+
+# Directory of the store of the FreeRTOS repository, inside of the workspace
+STORE_DIRECTORY = "freertos.git"
+
+# Directory of the submodule stores, inside of the workspace. Every store is
+# named like a mirror of the mirror cache (see mirrorCache.py).
+SUBMODULE_STORES_DIRECTORY = "modules"
+
+
+# getStoreDirectory: Returns: the store of the FreeRTOS repository
+def getStoreDirectory(workspace_directory):
+    return os.path.join(workspace_directory, STORE_DIRECTORY)
+
+
+# getSubmoduleStoresDirectory: Returns: the directory of the submodule stores
+def getSubmoduleStoresDirectory(workspace_directory):
+    return os.path.join(workspace_directory, SUBMODULE_STORES_DIRECTORY)
+
+
+# getCheckoutWorkspace: The private git directory of a worktree is
+# "<store>/worktrees/<name>".
+# Returns: the workspace that the checkout in "repo_directory" belongs to,
+# or None if it is a checkout of its own
+def getCheckoutWorkspace(repo_directory):
+    if not os.path.isfile(os.path.join(repo_directory, ".git")):
+        return None
+    store_directory = os.path.dirname(os.path.dirname(
+        getGitDirectory(repo_directory)))
+    if os.path.basename(store_directory) != STORE_DIRECTORY:
+        return None
+    return os.path.dirname(store_directory)
+
+
+# getSubmoduleStoreDirectory: Every submodule url gets its own store, named
+# like a mirror of the mirror cache (see mirrorCache.getMirrorDirectory).
+# Returns: the store of the submodule at "url"
+def getSubmoduleStoreDirectory(url, workspace_directory):
+    return mirrorCache.getMirrorDirectory(
+        url, getSubmoduleStoresDirectory(workspace_directory))
+
+
+# fetchIntoStore: Creates the bare store in "store_directory" the first time
+# it is needed and fetches "ref" from "url" into it, "depth" commits deep (0
+# fetches the full history). Only commits and trees are fetched, the blobs
+# are fetched by the worktrees once they need them.
+# Returns: the commit that "ref" points at
+def fetchIntoStore(url, store_directory, ref, depth):
+    os.makedirs(os.path.dirname(store_directory), exist_ok=True)
+
+    with mirrorCache.lockMirror(store_directory):
+        if not os.path.isdir(store_directory):
+            runGit(["init", "-q", "--bare", store_directory], cwd=None,
+                   check=True)
+        for key, value in [("remote.origin.url", url),
+                           ("remote.origin.promisor", "true"),
+                           ("remote.origin.partialclonefilter", "blob:none")]:
+            runGit(["config", key, value], cwd=store_directory, check=True)
+        runGitWithRetry(["fetch", "--filter=blob:none"] +
+                        getDepthArguments(depth) + ["origin", ref],
+                        cwd=store_directory,
+                        should_retry=lambda error: not isMissingRef(
+                            "origin", ref, store_directory))
+        commit = runGit(["rev-parse", "FETCH_HEAD^{commit}"],
+                        cwd=store_directory, capture_output=True,
+                        check=True).stdout.strip()
+
+        # The store has no branches of its own. Its HEAD keeps the commit
+        # fetched last from being pruned while no checkout uses it.
+        runGit(["update-ref", "--no-deref", "HEAD", commit],
+               cwd=store_directory, check=True)
+    return commit
+
+
+# updateStore: Fetches "ref" into the store of the workspace (see
+# fetchIntoStore)
+# Returns: the commit that "ref" points at
+def updateStore(url, workspace_directory, ref, depth):
+    return fetchIntoStore(url, getStoreDirectory(workspace_directory), ref,
+                          depth)
+
+
+# updateSubmoduleStore: Fetches the submodule commit "commit" into the store
+# of the submodule at "url" (see fetchIntoStore)
+# Returns: the path of the store
+def updateSubmoduleStore(url, workspace_directory, commit, depth):
+    store_directory = getSubmoduleStoreDirectory(url, workspace_directory)
+    fetchIntoStore(url, store_directory, commit, depth)
+    return store_directory
+
+
+# isWorktreeOf: Returns: whether "directory" is a worktree of the store in
+# "store_directory"
+def isWorktreeOf(directory, store_directory):
+    if not os.path.isfile(os.path.join(directory, ".git")):
+        return False
+    return os.path.realpath(os.path.dirname(os.path.dirname(
+        getGitDirectory(directory)))) == os.path.realpath(store_directory)
+
+
+# addCheckout: Adds "directory" as a worktree of the store in
+# "store_directory" with "commit" as its detached HEAD. Nothing is checked
+# out yet so the sparse checkout can be set first. A worktree of the store
+# that an interrupted run left in "directory" is kept as it is, worktrees
+# whose directory was deleted are forgotten.
+def addCheckout(store_directory, directory, commit):
+    with mirrorCache.lockMirror(store_directory):
+        if isWorktreeOf(directory, store_directory):
+            return
+        runGit(["worktree", "prune"], cwd=store_directory, check=True)
+        runGit(["worktree", "add", "-q", "--no-checkout", "--detach",
+                os.path.abspath(directory), commit],
+               cwd=store_directory, check=True)